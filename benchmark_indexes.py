@@ -0,0 +1,131 @@
+import argparse
+import datetime
+import random
+import statistics
+import sys
+import time
+import settings
+from modules.models import db, DiscordMember, Player, Game, GameSide, Lineup
+from migrations.v004_hot_query_indexes import hot_query_indexes
+
+# Times the queries behind $lb, $player, $games and Game.search() with and without the v004 hot query indexes.
+# Generates its own data, so config.ini psql_db must point at an empty scratch database - never the live one - with
+# migrations applied (python migrator.py):
+# python benchmark_indexes.py --players 5000 --games 100000
+
+bench_guild_id = 1
+
+
+def generate(player_count: int, game_count: int, batch_size: int = 5000):
+    random.seed(1)
+    now = datetime.datetime.now()
+
+    def insert_batched(model, rows):
+        with db.atomic():
+            for start in range(0, len(rows), batch_size):
+                model.insert_many(rows[start:start + batch_size]).execute()
+
+    insert_batched(DiscordMember, [{'id': i, 'discord_id': i, 'name': f'member{i}', 'polytopia_id': f'code{i:08}'} for i in range(1, player_count + 1)])
+    insert_batched(Player, [{'id': i, 'discord_member': i, 'guild_id': bench_guild_id, 'name': f'member{i}', 'elo': int(random.gauss(1000, 150))}
+                            for i in range(1, player_count + 1)])
+
+    games, sides, lineups = [], [], []
+    for game_id in range(1, game_count + 1):
+        team_size = random.choice((1, 1, 1, 2, 3))
+        is_pending = random.random() < 0.02
+        is_completed = not is_pending and random.random() < 0.9
+        date = now - datetime.timedelta(days=random.randint(0, 720))
+        games.append({'id': game_id, 'guild_id': bench_guild_id, 'name': f'Game {game_id}', 'date': date, 'size': [team_size, team_size],
+                      'is_pending': is_pending, 'is_completed': is_completed, 'is_confirmed': is_completed, 'is_ranked': random.random() < 0.8,
+                      'completed_ts': date + datetime.timedelta(days=3) if is_completed else None,
+                      'expiration': now + datetime.timedelta(hours=random.randint(-48, 96)),
+                      'game_chan': 10 ** 17 + game_id if not is_completed and not is_pending else None})
+        roster = random.sample(range(1, player_count + 1), team_size * 2)
+        for position in (1, 2):
+            side_id = game_id * 2 + position - 2
+            sides.append({'id': side_id, 'game': game_id, 'size': team_size, 'position': position,
+                          'team_chan': 10 ** 17 + side_id if team_size > 1 and not is_completed else None})
+            members = roster[:team_size] if position == 1 else roster[team_size:]
+            if is_pending and position == 2:
+                members = members[:-1]  # leave an open slot
+            lineups.extend({'game': game_id, 'gameside': side_id, 'player': player_id} for player_id in members)
+
+    insert_batched(Game, games)
+    insert_batched(GameSide, sides)
+    # the winner FK has to point at an existing side, so is set once the sides are in
+    db.execute_sql('UPDATE game SET winner_id = id * 2 - 1 + (id %% 2) WHERE is_completed;')
+    insert_batched(Lineup, lineups)
+    for table in ('discordmember', 'player', 'game', 'gameside', 'lineup'):
+        db.execute_sql(f"SELECT setval('{table}_id_seq', (SELECT MAX(id) FROM {table}));")
+
+
+def best_of(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t)
+    return min(timings), statistics.median(timings)
+
+
+def benchmark_queries(repeat: int):
+    player = Player.select().order_by(-Player.games_played_count).first()
+    opponent = Player.select().where(Player.id != player.id).order_by(-Player.games_played_count).first()
+
+    # get_record() is left out - it reads the record materialized views, which the v004 indexes do not affect
+    def lb():
+        list(Player.leaderboard(date_cutoff=settings.date_cutoff, guild_id=bench_guild_id)[:50])
+
+    def player_card():
+        list(Game.search(player_filter=[player]).limit(10))
+        list(Game.search(player_filter=[player, opponent], size_filter=[1, 1]).limit(1))
+
+    def open_games():
+        game_list = list(Game.search_pending(status_filter=2, guild_id=bench_guild_id))
+        Game.load_rosters(game_list)
+
+    def game_search():
+        list(Game.search(status_filter=2, guild_id=bench_guild_id)[:500])
+        list(Game.search(status_filter=3, player_filter=[player], guild_id=bench_guild_id)[:500])
+
+    def channel_lookup():
+        GameSide.select().where(GameSide.team_chan == 10 ** 17 + 5).first()
+        Game.select().where(Game.game_chan == 10 ** 17 + 5).first()
+
+    return {name: best_of(func, repeat) for name, func in
+            [('$lb', lb), ('$player', player_card), ('$games', open_games), ('Game.search', game_search), ('channel lookup', channel_lookup)]}
+
+
+def set_indexes(present: bool):
+    for name, definition in hot_query_indexes:
+        if present:
+            db.execute_sql(f'CREATE INDEX IF NOT EXISTS {name} ON {definition};')
+        else:
+            db.execute_sql(f'DROP INDEX IF EXISTS {name};')
+    db.execute_sql('ANALYZE;')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, default=5000)
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db.connect(reuse_if_open=True)
+    if Game.select().where(Game.guild_id != bench_guild_id).exists() or DiscordMember.select().where(DiscordMember.discord_id > args.players).exists():
+        sys.exit(f'Database {settings.psql_db} contains data that this benchmark did not generate. Point psql_db at an empty scratch database.')
+
+    if not Game.select().exists():
+        t = time.perf_counter()
+        generate(args.players, args.games)
+        print(f'Generated {args.players} players and {args.games} games in {time.perf_counter() - t:.1f}s')
+
+    set_indexes(present=False)
+    before = benchmark_queries(args.repeat)
+    set_indexes(present=True)
+    after = benchmark_queries(args.repeat)
+
+    print(f'{"":<16}{"without indexes (best / median)":>34}{"with indexes (best / median)":>34}')
+    for name in before:
+        print(f'{name:<16}{before[name][0] * 1000:>19.1f}ms / {before[name][1] * 1000:>7.1f}ms{after[name][0] * 1000:>19.1f}ms / {after[name][1] * 1000:>7.1f}ms')
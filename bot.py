@@ -5,54 +5,20 @@
 from modules import models
 from modules import initialize_data
 from modules import utilities
+from modules import exceptions
+from modules import schema
+from modules import perf
+from modules import metrics
+from modules import watchdog
+from modules import logqueue
 import settings
 import logging
-import sys
-from logging.handlers import RotatingFileHandler
 from timeit import default_timer as timer
 # import peewee
 
 
-# Logger config is a bit of a mess and probably could be simplified a lot, but works. debug and above sent to file / error above sent to stderr
-handler = RotatingFileHandler(filename='logs/full_bot.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=10)
-partial_handler = RotatingFileHandler(filename='logs/discord.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=10)  # without peewee logging
-elo_handler = RotatingFileHandler(filename='logs/elo.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=5)
-
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-partial_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-elo_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-
-my_logger = logging.getLogger('polybot')
-my_logger.setLevel(logging.DEBUG)
-my_logger.addHandler(handler)  # root handler for app. module-specific loggers will inherit this
-my_logger.addHandler(partial_handler)
-
-elo_logger = logging.getLogger('polybot.elo')
-elo_logger.setLevel(logging.DEBUG)
-elo_logger.addHandler(elo_handler)
-
-err = logging.StreamHandler(sys.stderr)
-err.setLevel(logging.ERROR)
-err.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-my_logger.addHandler(err)
-
-
-discord_logger = logging.getLogger('discord')
-discord_logger.setLevel(logging.INFO)
-
-if (discord_logger.hasHandlers()):
-    discord_logger.handlers.clear()
-
-discord_logger.addHandler(handler)
-discord_logger.addHandler(partial_handler)
-
-logger_peewee = logging.getLogger('peewee')
-logger_peewee.setLevel(logging.DEBUG)
-
-if (logger_peewee.hasHandlers()):
-    logger_peewee.handlers.clear()
-
-logger_peewee.addHandler(handler)
+# Log records are queued by whichever thread logs them and written to file by a single listener thread - see modules/logqueue.py
+log_listener = logqueue.configure_logging(peewee_sample_rate=settings.peewee_log_sample_rate)
 
 logger = logging.getLogger('polybot.' + __name__)
 
@@ -65,6 +31,12 @@ def main():
     parser.add_argument('--game_export', action='store_true')
     parser.add_argument('--skip_tasks', action='store_true')
     args = parser.parse_args()
+
+    current_version, latest_version = schema.verify_schema_version()
+    if current_version != latest_version:
+        logger.critical(f'Database schema is at version {current_version} but this code expects {latest_version}. Run migrator.py first.')
+        exit(1)
+
     if args.add_default_data:
         initialize_data.initialize_data()
         exit(0)
@@ -168,6 +140,10 @@ async def on_command_error(ctx, exc):
 
         ignored = (commands.CommandNotFound, commands.UserInputError, commands.CheckFailure)
 
+        if isinstance(getattr(exc, 'original', None), exceptions.ServerBusyError):
+            # raised by the DB executor (possibly from inside a converter) when a guild has too much work queued
+            return await ctx.send(f'{exc.original}')
+
         if isinstance(exc, commands.CommandNotFound) and ctx.invoked_with[:4] == 'join':
             await ctx.send(f'Cannot understand command. Make sure to include a space and a numeric game ID.\n*Example:* `{ctx.prefix}join 11234`')
 
@@ -186,13 +162,27 @@ async def on_command_error(ctx, exc):
 
     @bot.before_invoke
     async def pre_invoke_setup(ctx):
-        utilities.connect()
+        perf.command_started(ctx.command.qualified_name)
         logger.debug(f'Command invoked: {ctx.message.clean_content}. By {ctx.message.author.name} in {ctx.channel.id} {ctx.channel.name} on {ctx.guild.name}')
 
-    initial_extensions = ['modules.games', 'modules.customhelp', 'modules.matchmaking', 'modules.administration', 'modules.misc', 'modules.league']
+    @bot.after_invoke
+    async def post_invoke_cleanup(ctx):
+        stats = perf.command_finished(failed=ctx.command_failed)
+        if stats:
+            logger.debug(f'Command finished: {stats.name} - {stats.queries} queries / {stats.rows} rows, {stats.db_time * 1000:.0f}ms db, '
+                         f'{stats.executor_wait * 1000:.0f}ms executor wait, {stats.wall_time * 1000:.0f}ms total')
+
+    initial_extensions = ['modules.games', 'modules.customhelp', 'modules.matchmaking', 'modules.administration', 'modules.misc', 'modules.league', 'modules.tournaments']
     for extension in initial_extensions:
         bot.load_extension(extension)
 
+    metrics.instrument_discord_http(bot)
+    bot.loop.create_task(watchdog.LoopWatchdog(threshold=settings.loop_lag_threshold).run(bot))
+    if settings.asyncio_debug:
+        watchdog.enable_asyncio_debug(bot.loop, slow_callback_duration=settings.loop_lag_threshold)
+    if settings.metrics_port:
+        bot.loop.create_task(metrics.start_server(bot, settings.metrics_port))
+
     @bot.event
     async def on_ready():
         """http://discordpy.readthedocs.io/en/rewrite/api.html#discord.on_ready"""
@@ -208,3 +198,8 @@ async def on_ready():
                 await g.leave()
 
     bot.run(settings.discord_key, bot=True, reconnect=True)
+
+    if models.gamelog_buffer:
+        # bot was stopped without using $quit - write out anything still buffered
+        with models.db.connection_context():
+            models.GameLog.flush_buffer()
@@ -0,0 +1 @@
+# Versioned schema migrations, applied in order by migrator.py. See modules/schema.py
@@ -0,0 +1,35 @@
+from psycopg2.errors import DuplicateObject
+from peewee import ProgrammingError
+import modules.models as models
+from modules.schema import Sql, Python
+
+# Schema as of the switch to versioned migrations. Previously created by models.py at import time on every start,
+# so on an existing database this only creates anything that is missing.
+
+
+def create_tables(db):
+    db.create_tables([models.Configuration, models.Team, models.DiscordMember, models.Game, models.Player, models.Tribe, models.Squad,
+                      models.GameSide, models.SquadMember, models.Lineup, models.GameLog, models.GameChannel,
+                      models.Tournament, models.TournamentParticipant, models.TournamentRound, models.TournamentGame])
+
+
+def create_game_winner_fk(db):
+    # Creates deferred FK http://docs.peewee-orm.com/en/latest/peewee/models.html#circular-foreign-key-dependencies
+    # Run outside a transaction, since the exception raised when the FK already exists would roll the transaction back
+    try:
+        models.Game._schema.create_foreign_key(models.Game.winner)
+    except (ProgrammingError, DuplicateObject):
+        pass
+
+
+steps = [
+    Python(create_tables, 'create_tables() for all models (only creates missing tables and indexes)'),
+    Python(create_game_winner_fk, 'ALTER TABLE game ADD CONSTRAINT ... FOREIGN KEY (winner_id) REFERENCES gameside', transactional=False),
+
+    # trigram indexes used by the fuzzy matching in Player.string_matches()
+    Sql('CREATE EXTENSION IF NOT EXISTS pg_trgm;'),
+    Sql('CREATE INDEX IF NOT EXISTS discordmember_name_trgm ON discordmember USING gin (name gin_trgm_ops);'),
+    Sql('CREATE INDEX IF NOT EXISTS discordmember_polytopia_name_trgm ON discordmember USING gin (polytopia_name gin_trgm_ops);'),
+    Sql('CREATE INDEX IF NOT EXISTS discordmember_polytopia_id_trgm ON discordmember USING gin (polytopia_id gin_trgm_ops);'),
+    Sql('CREATE INDEX IF NOT EXISTS player_nick_trgm ON player USING gin (nick gin_trgm_ops);'),
+]
@@ -0,0 +1,96 @@
+from modules.schema import Sql, Backfill, ConcurrentIndex
+
+# Denormalized counters and rosters maintained by triggers: Player.games_played_count, GameSide.roster_signature and
+# GameSide.filled, Game.open_slots, plus Squad.member_key/member_ids.
+# Triggers are created before the backfills so rows written while a backfill is running are kept in step.
+
+steps = [
+    Sql('ALTER TABLE player ADD COLUMN IF NOT EXISTS games_played_count INTEGER NOT NULL DEFAULT 0;'),
+    Sql('ALTER TABLE gameside ADD COLUMN IF NOT EXISTS roster_signature TEXT;'),
+    Sql('ALTER TABLE gameside ADD COLUMN IF NOT EXISTS filled SMALLINT NOT NULL DEFAULT 0;'),
+    Sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS open_slots SMALLINT NOT NULL DEFAULT 0;'),
+    Sql('ALTER TABLE squad ADD COLUMN IF NOT EXISTS member_key TEXT;'),
+    Sql('ALTER TABLE squad ADD COLUMN IF NOT EXISTS member_ids INTEGER[];'),
+
+    # keep Player.games_played_count in step with the lineup table, including cascading deletes of games
+    Sql("""
+        CREATE OR REPLACE FUNCTION lineup_games_played() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE player SET games_played_count = games_played_count + 1 WHERE id = NEW.player_id;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE player SET games_played_count = games_played_count - 1 WHERE id = OLD.player_id;
+            ELSIF NEW.player_id <> OLD.player_id THEN
+                UPDATE player SET games_played_count = games_played_count - 1 WHERE id = OLD.player_id;
+                UPDATE player SET games_played_count = games_played_count + 1 WHERE id = NEW.player_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;"""),
+    Sql('DROP TRIGGER IF EXISTS lineup_games_played ON lineup;'),
+    Sql('CREATE TRIGGER lineup_games_played AFTER INSERT OR UPDATE OF player_id OR DELETE ON lineup FOR EACH ROW EXECUTE PROCEDURE lineup_games_played();'),
+
+    # keep GameSide.roster_signature (sorted comma-separated player ids) and GameSide.filled in step with the side's lineup
+    Sql("""
+        CREATE OR REPLACE FUNCTION lineup_roster_signature() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                UPDATE gameside SET (roster_signature, filled) = (
+                    SELECT string_agg(player_id::text, ',' ORDER BY player_id), COUNT(*) FROM lineup WHERE gameside_id = OLD.gameside_id
+                ) WHERE id = OLD.gameside_id;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                UPDATE gameside SET (roster_signature, filled) = (
+                    SELECT string_agg(player_id::text, ',' ORDER BY player_id), COUNT(*) FROM lineup WHERE gameside_id = NEW.gameside_id
+                ) WHERE id = NEW.gameside_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;"""),
+    Sql('DROP TRIGGER IF EXISTS lineup_roster_signature ON lineup;'),
+    Sql('CREATE TRIGGER lineup_roster_signature AFTER INSERT OR UPDATE OF player_id, gameside_id OR DELETE ON lineup FOR EACH ROW EXECUTE PROCEDURE lineup_roster_signature();'),
+
+    # keep Game.open_slots in step with its gamesides' size and filled counts
+    Sql("""
+        CREATE OR REPLACE FUNCTION gameside_open_slots() RETURNS trigger AS $$
+        BEGIN
+            UPDATE game SET open_slots = (
+                SELECT COALESCE(SUM(GREATEST(size - filled, 0)), 0) FROM gameside WHERE game_id = COALESCE(NEW.game_id, OLD.game_id)
+            ) WHERE id = COALESCE(NEW.game_id, OLD.game_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;"""),
+    Sql('DROP TRIGGER IF EXISTS gameside_open_slots ON gameside;'),
+    Sql('CREATE TRIGGER gameside_open_slots AFTER INSERT OR UPDATE OF size, filled OR DELETE ON gameside FOR EACH ROW EXECUTE PROCEDURE gameside_open_slots();'),
+
+    Backfill('player', 'games_played_count = (SELECT COUNT(*) FROM lineup WHERE lineup.player_id = player.id)'),
+    Backfill('gameside', """(roster_signature, filled) = (
+        SELECT string_agg(player_id::text, ',' ORDER BY player_id), COUNT(*) FROM lineup WHERE lineup.gameside_id = gameside.id)"""),
+    # no game backfill needed for open_slots - the gameside backfill fires the gameside_open_slots trigger for every side
+    # Squad.upsert() never stopped two squads ending up with the same members, and those duplicates have to be merged before
+    # the unique squad_member_key index can be built. The squad with the most games is kept, along with its elo, and the
+    # other squads' games are moved over to it
+    Sql('DROP TABLE IF EXISTS squad_duplicate;'),
+    Sql("""
+        CREATE TEMP TABLE squad_duplicate AS
+        WITH squad_key AS (
+            SELECT squad.id, string_agg(squadmember.player_id::text, ',' ORDER BY squadmember.player_id) AS member_key,
+                   (SELECT COUNT(*) FROM gameside WHERE gameside.squad_id = squad.id) AS games
+            FROM squad JOIN squadmember ON squadmember.squad_id = squad.id GROUP BY squad.id
+        ), ranked AS (
+            SELECT id, first_value(id) OVER (PARTITION BY member_key ORDER BY games DESC, id) AS keep_id FROM squad_key
+        )
+        SELECT id, keep_id FROM ranked WHERE id <> keep_id;"""),
+    Sql('UPDATE gameside SET squad_id = squad_duplicate.keep_id FROM squad_duplicate WHERE gameside.squad_id = squad_duplicate.id;'),
+    Sql('DELETE FROM squadmember WHERE squad_id IN (SELECT id FROM squad_duplicate);'),
+    Sql('DELETE FROM squad WHERE id IN (SELECT id FROM squad_duplicate);'),
+    Sql('DROP TABLE squad_duplicate;'),
+    Backfill('squad', """
+        member_ids = (SELECT array_agg(player_id ORDER BY player_id) FROM squadmember WHERE squadmember.squad_id = squad.id),
+        member_key = (SELECT string_agg(player_id::text, ',' ORDER BY player_id) FROM squadmember WHERE squadmember.squad_id = squad.id)"""),
+
+    ConcurrentIndex('gameside_roster_signature', 'gameside (roster_signature)'),
+    ConcurrentIndex('squad_member_key', 'squad (member_key)', unique=True),
+    ConcurrentIndex('squad_member_ids', 'squad USING gin (member_ids)'),
+    ConcurrentIndex('game_pending_open_slots', 'game (guild_id, id) WHERE is_pending = true AND open_slots > 0'),
+]
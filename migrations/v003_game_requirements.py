@@ -0,0 +1,25 @@
+from modules.schema import Sql, Backfill, ConcurrentIndex
+
+# Game join requirements parsed out of notes into columns, see Game.requirements_from_notes()
+
+steps = [
+    Sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS req_min_elo SMALLINT NOT NULL DEFAULT 0;'),
+    Sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS req_max_elo SMALLINT NOT NULL DEFAULT 3000;'),
+    Sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS req_min_elo_global SMALLINT NOT NULL DEFAULT 0;'),
+    Sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS req_max_elo_global SMALLINT NOT NULL DEFAULT 3000;'),
+    Sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS invited_ids BIGINT[];'),
+    Sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS is_nova BOOLEAN NOT NULL DEFAULT false;'),
+
+    # same parsing as Game.requirements_from_notes()
+    Backfill('game', r"""
+        req_max_elo = COALESCE(LEAST((regexp_match(notes, '(\d+) elo max', 'i'))[1]::bigint, 32767), 3000),
+        req_min_elo = COALESCE(LEAST((regexp_match(notes, '(\d+) elo min', 'i'))[1]::bigint, 32767), 0),
+        req_max_elo_global = COALESCE(LEAST((regexp_match(notes, '(\d+) global elo max', 'i'))[1]::bigint, 32767), 3000),
+        req_min_elo_global = COALESCE(LEAST((regexp_match(notes, '(\d+) global elo min', 'i'))[1]::bigint, 32767), 0),
+        invited_ids = NULLIF(ARRAY(SELECT m[1]::bigint FROM regexp_matches(notes, '<@!?(\d+)>', 'g') AS m), '{}'),
+        is_nova = (notes ILIKE '%%nova%%')""", where='notes IS NOT NULL'),
+
+    ConcurrentIndex('game_pending_elo_requirements', 'game (req_min_elo, req_max_elo, req_min_elo_global, req_max_elo_global) WHERE is_pending = true'),
+    ConcurrentIndex('game_pending_nova', 'game (guild_id) WHERE is_pending = true AND is_nova = true'),
+    ConcurrentIndex('game_invited_ids', 'game USING gin (invited_ids) WHERE is_pending = true'),
+]
@@ -0,0 +1,17 @@
+from modules.schema import ConcurrentIndex
+
+# Indexes for the filters behind $lb, $player, $games, Game.search() and the game channel lookups.
+# game_is_pending_expiration is used by purge_expired_games() and next_expiration(), and has the name create_tables() gave it
+# when it was declared in Game.Meta. See also benchmark_indexes.py
+
+hot_query_indexes = [('game_is_pending_expiration', 'game (is_pending, expiration)'),
+                     ('game_completed_ranked_ts', 'game (is_completed, is_confirmed, is_ranked, completed_ts)'),
+                     ('game_guild_pending', 'game (guild_id, is_pending)'),
+                     ('game_game_chan', 'game (game_chan) WHERE game_chan IS NOT NULL'),
+                     ('gameside_team_chan', 'gameside (team_chan) WHERE team_chan IS NOT NULL'),
+                     ('gameside_game_position', 'gameside (game_id, position)'),
+                     ('lineup_player_game', 'lineup (player_id, game_id)'),
+                     ('gamelog_guild_message_ts', 'gamelog (guild_id, message_ts)'),
+                     ('discordmember_polytopia_id', 'discordmember (polytopia_id)')]
+
+steps = [ConcurrentIndex(name, definition) for name, definition in hot_query_indexes]
@@ -0,0 +1,48 @@
+from modules.schema import Sql
+
+# Win/loss counts for ranked, confirmed games, read by the get_record() methods. Refreshed with
+# REFRESH MATERIALIZED VIEW CONCURRENTLY by RecordView.refresh_all(), which needs a unique index on each view.
+# Views are split by guild or date rather than baking in settings that can change, ie. the global leaderboard server list
+# and the team ELO reset date - those are applied when reading.
+
+steps = [
+    Sql("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS player_record AS
+        SELECT lineup.player_id,
+            (COUNT(*) FILTER (WHERE game.winner_id = lineup.gameside_id))::integer AS wins,
+            (COUNT(*) FILTER (WHERE game.winner_id <> lineup.gameside_id))::integer AS losses
+        FROM lineup JOIN game ON game.id = lineup.game_id
+        WHERE game.is_completed AND game.is_confirmed AND game.is_ranked
+        GROUP BY lineup.player_id;"""),
+    Sql('CREATE UNIQUE INDEX IF NOT EXISTS player_record_player ON player_record (player_id);'),
+
+    Sql("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS discordmember_record AS
+        SELECT player.discord_member_id, game.guild_id,
+            (COUNT(*) FILTER (WHERE game.winner_id = lineup.gameside_id))::integer AS wins,
+            (COUNT(*) FILTER (WHERE game.winner_id <> lineup.gameside_id))::integer AS losses
+        FROM lineup JOIN game ON game.id = lineup.game_id JOIN player ON player.id = lineup.player_id
+        WHERE game.is_completed AND game.is_confirmed AND game.is_ranked
+        GROUP BY player.discord_member_id, game.guild_id;"""),
+    Sql('CREATE UNIQUE INDEX IF NOT EXISTS discordmember_record_member_guild ON discordmember_record (discord_member_id, guild_id);'),
+
+    Sql("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS team_record AS
+        SELECT gameside.team_id, game.date,
+            (COUNT(*) FILTER (WHERE game.winner_id = gameside.id))::integer AS wins,
+            (COUNT(*) FILTER (WHERE game.winner_id <> gameside.id))::integer AS losses
+        FROM gameside JOIN game ON game.id = gameside.game_id
+        WHERE gameside.team_id IS NOT NULL AND gameside.size > 1 AND game.is_completed AND game.is_confirmed AND game.is_ranked
+        GROUP BY gameside.team_id, game.date;"""),
+    Sql('CREATE UNIQUE INDEX IF NOT EXISTS team_record_team_date ON team_record (team_id, date);'),
+
+    Sql("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS squad_record AS
+        SELECT gameside.squad_id,
+            (COUNT(*) FILTER (WHERE game.winner_id = gameside.id))::integer AS wins,
+            (COUNT(*) FILTER (WHERE game.winner_id <> gameside.id))::integer AS losses
+        FROM gameside JOIN game ON game.id = gameside.game_id
+        WHERE gameside.squad_id IS NOT NULL AND game.is_completed AND game.is_confirmed AND game.is_ranked
+        GROUP BY gameside.squad_id;"""),
+    Sql('CREATE UNIQUE INDEX IF NOT EXISTS squad_record_squad ON squad_record (squad_id);'),
+]
@@ -0,0 +1,10 @@
+from modules.schema import Sql
+
+# Fills the gamechannel registry (GameChannel, used by Game.by_channel_id()) from the channel references on existing games.
+# Channels created from now on are registered as they are made, so this only matters for databases with games from before
+# the registry existed. Safe to re-run.
+
+steps = [
+    Sql('INSERT INTO gamechannel (channel_id, game_id, gameside_id) SELECT team_chan, game_id, id FROM gameside WHERE team_chan IS NOT NULL ON CONFLICT DO NOTHING;'),
+    Sql('INSERT INTO gamechannel (channel_id, game_id) SELECT game_chan, id FROM game WHERE game_chan IS NOT NULL ON CONFLICT DO NOTHING;'),
+]
@@ -5,6 +5,9 @@
 import logging
 import peewee
 import modules.exceptions as exceptions
+from modules import perf
+from modules import dbexecutor
+from modules import logqueue
 import datetime
 import asyncio
 import discord
@@ -18,6 +21,7 @@
 class administration(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.perf_task = bot.loop.create_task(self.task_log_perf_summary())
         if settings.run_tasks:
             self.bg_task = bot.loop.create_task(self.task_confirm_auto())
             self.bg_task2 = bot.loop.create_task(self.task_purge_incomplete())
@@ -39,11 +43,14 @@ async def restart(self, ctx):
         """ *Owner*: Close database connection and quit bot gracefully """
 
         logger.debug(f'Purging message list {self.bot.purgable_messages}')
+        models.gamelog_buffer_enabled = False  # any further log writes go directly to db
+        logger.info(f'Flushed {await utilities.run_in_db_thread(models.GameLog.flush_buffer)} buffered GameLog entries')
         try:
             if models.db.close():
                 close_message = 'db connection closing normally'
             else:
                 close_message = 'db connection was already closed'
+            models.db.close_all()  # also close idle pooled connections rather than leaving them for the server to time out
 
         except peewee.PeeweeException as e:
             message = f'Error during post_invoke_cleanup db.close(): {e}'
@@ -173,9 +180,8 @@ async def confirm(self, ctx, *, arg: str = None):
             return await ctx.send(f'Game with ID {winning_game.id} is already confirmed as completed with winner **{winning_game.winner.name()}**')
 
         winning_game.declare_winner(winning_side=winning_game.winner, confirm=True)
-        winner_name = winning_game.winner.name()  # storing here trying to solve cursor closed error
         await post_win_messaging(ctx.guild, ctx.prefix, ctx.channel, winning_game)
-        await ctx.send(f'**Game {winning_game.id}** winner has been confirmed as **{winner_name}**')  # Added here to try to fix InterfaceError Cursor Closed - seems to fix if there is output at the end
+        await ctx.send(f'**Game {winning_game.id}** winner has been confirmed as **{winning_game.winner.name()}**')
 
     async def confirm_auto(self, guild, prefix, current_channel):
         logger.debug('in confirm_auto')
@@ -222,21 +228,33 @@ async def task_confirm_auto(self):
 
         while not self.bot.is_closed():
             await asyncio.sleep(8)
-            logger.debug('Task running: task_confirm_auto')
+            with perf.timed_task('task_confirm_auto'):
+                logger.debug('Task running: task_confirm_auto')
 
-            utilities.connect()
-            for guild in self.bot.guilds:
-                staff_output_channel = guild.get_channel(settings.guild_setting(guild.id, 'game_request_channel'))
-                if not staff_output_channel:
-                    logger.debug(f'Could not load game_request_channel for server {guild.id} - skipping')
-                    continue
+                for guild in self.bot.guilds:
+                    staff_output_channel = guild.get_channel(settings.guild_setting(guild.id, 'game_request_channel'))
+                    if not staff_output_channel:
+                        logger.debug(f'Could not load game_request_channel for server {guild.id} - skipping')
+                        continue
+
+                    prefix = settings.guild_setting(guild.id, 'command_prefix')
+                    (unconfirmed_count, games_confirmed) = await self.confirm_auto(guild, prefix, staff_output_channel)
+                    if games_confirmed:
+                        await staff_output_channel.send(f'Autoconfirm process complete. {games_confirmed} games auto-confirmed. {unconfirmed_count - games_confirmed} games left unconfirmed.')
 
-                prefix = settings.guild_setting(guild.id, 'command_prefix')
-                (unconfirmed_count, games_confirmed) = await self.confirm_auto(guild, prefix, staff_output_channel)
-                if games_confirmed:
-                    await staff_output_channel.send(f'Autoconfirm process complete. {games_confirmed} games auto-confirmed. {unconfirmed_count - games_confirmed} games left unconfirmed.')
+            await asyncio.sleep(sleep_cycle)
 
+    async def task_log_perf_summary(self):
+        # one line per busy command, so slow commands can be found in the log without the peewee SQL dump
+        sleep_cycle = (60 * 15)  # 15 minute cycle
+        while not self.bot.is_closed():
             await asyncio.sleep(sleep_cycle)
+            top = perf.top_commands(limit=5)
+            if not top:
+                continue
+            logger.info(f'Command performance since {datetime.datetime.fromtimestamp(perf.summaries_since):%Y-%m-%d %H:%M}, DB executor {dbexecutor.db_executor.stats()}')
+            for name, summary in top:
+                logger.info(f'perf {name}: {summary.describe()}')
 
     async def task_purge_incomplete(self):
         await self.bot.wait_until_ready()
@@ -244,82 +262,87 @@ async def task_purge_incomplete(self):
 
         while not self.bot.is_closed():
             await asyncio.sleep(20)
-            logger.debug('Task running: task_purge_incomplete')
-
-            old_60d = (datetime.date.today() + datetime.timedelta(days=-60))
-            old_90d = (datetime.date.today() + datetime.timedelta(days=-90))
-            old_120d = (datetime.date.today() + datetime.timedelta(days=-120))
-            old_150d = (datetime.date.today() + datetime.timedelta(days=-150))
-
-            for guild in self.bot.guilds:
-                staff_output_channel = guild.get_channel(settings.guild_setting(guild.id, 'game_request_channel'))
-
-                utilities.connect()
-
-                def async_game_search():
-                    utilities.connect()
-                    query = models.Game.search(status_filter=2, guild_id=guild.id)
-                    query = list(query)  # reversing 'Incomplete' queries so oldest is at top
-                    query.reverse()
-                    return query
-
-                game_list = await self.bot.loop.run_in_executor(None, async_game_search)
-
-                delete_result = []
-                for game in game_list[:500]:
-                    game_size = len(game.lineup)
-                    rank_str = ' - *Unranked*' if not game.is_ranked else ''
-                    if game_size == 2 and game.date < old_60d and not game.is_completed:
-                        delete_result.append(f'Deleting incomplete 1v1 game older than 60 days. - {game.get_headline()} - {game.date}{rank_str}')
-                        # await self.bot.loop.run_in_executor(None, game.delete_game)
-                        models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
-                        game.delete_game()
-
-                    if game_size == 3 and game.date < old_90d and not game.is_completed:
-                        delete_result.append(f'Deleting incomplete 3-player game older than 90 days. - {game.get_headline()} - {game.date}{rank_str}')
-                        await game.delete_game_channels(self.bot.guilds, guild.id)
-                        # await self.bot.loop.run_in_executor(None, game.delete_game)
-                        models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
-                        game.delete_game()
-
-                    if game_size == 4:
-                        if game.date < old_90d and not game.is_completed and not game.is_ranked:
-                            delete_result.append(f'Deleting incomplete 4-player game older than 90 days. - {game.get_headline()} - {game.date}{rank_str}')
+            with perf.timed_task('task_purge_incomplete'):
+                logger.debug('Task running: task_purge_incomplete')
+
+                old_60d = (datetime.date.today() + datetime.timedelta(days=-60))
+                old_90d = (datetime.date.today() + datetime.timedelta(days=-90))
+                old_120d = (datetime.date.today() + datetime.timedelta(days=-120))
+                old_150d = (datetime.date.today() + datetime.timedelta(days=-150))
+
+                for guild in self.bot.guilds:
+                    staff_output_channel = guild.get_channel(settings.guild_setting(guild.id, 'game_request_channel'))
+
+                    def async_game_search():
+                        query = models.Game.search(status_filter=2, guild_id=guild.id)
+                        query = list(query)  # reversing 'Incomplete' queries so oldest is at top
+                        query.reverse()
+                        return query
+
+                    try:
+                        game_list = await utilities.run_in_db_thread(async_game_search, guild_id=guild.id)
+                    except exceptions.ServerBusyError:
+                        logger.info(f'task_purge_incomplete: skipping guild {guild.id} this pass, its DB queue is full')
+                        continue
+
+                    delete_result = []
+                    for game in game_list[:500]:
+                        game_size = len(game.lineup)
+                        rank_str = ' - *Unranked*' if not game.is_ranked else ''
+                        if game_size == 2 and game.date < old_60d and not game.is_completed:
+                            delete_result.append(f'Deleting incomplete 1v1 game older than 60 days. - {game.get_headline()} - {game.date}{rank_str}')
+                            # await utilities.run_in_db_thread(game.delete_game)
+                            models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
+                            game.delete_game()
+
+                        if game_size == 3 and game.date < old_90d and not game.is_completed:
+                            delete_result.append(f'Deleting incomplete 3-player game older than 90 days. - {game.get_headline()} - {game.date}{rank_str}')
                             await game.delete_game_channels(self.bot.guilds, guild.id)
-                            await self.bot.loop.run_in_executor(None, game.delete_game)
+                            # await utilities.run_in_db_thread(game.delete_game)
                             models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
                             game.delete_game()
-                        if game.date < old_120d and not game.is_completed and game.is_ranked:
-                            delete_result.append(f'Deleting incomplete ranked 4-player game older than 120 days. - {game.get_headline()} - {game.date}{rank_str}')
+
+                        if game_size == 4:
+                            if game.date < old_90d and not game.is_completed and not game.is_ranked:
+                                delete_result.append(f'Deleting incomplete 4-player game older than 90 days. - {game.get_headline()} - {game.date}{rank_str}')
+                                await game.delete_game_channels(self.bot.guilds, guild.id)
+                                try:
+                                    await utilities.run_in_db_thread(game.delete_game, guild_id=guild.id)
+                                except exceptions.ServerBusyError:
+                                    pass  # game.delete_game() below still runs
+                                models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
+                                game.delete_game()
+                            if game.date < old_120d and not game.is_completed and game.is_ranked:
+                                delete_result.append(f'Deleting incomplete ranked 4-player game older than 120 days. - {game.get_headline()} - {game.date}{rank_str}')
+                                await game.delete_game_channels(self.bot.guilds, guild.id)
+                                models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
+                                # await utilities.run_in_db_thread(game.delete_game)
+                                game.delete_game()
+
+                        if (game_size == 5 or game_size == 6) and game.is_ranked and game.date < old_150d and not game.is_completed:
+                            # Max out ranked game deletion at game_size==6
+                            delete_result.append(f'Deleting incomplete ranked {game_size}-player game older than 150 days. - {game.get_headline()} - {game.date}{rank_str}')
                             await game.delete_game_channels(self.bot.guilds, guild.id)
+                            # await utilities.run_in_db_thread(game.delete_game)
                             models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
-                            # await self.bot.loop.run_in_executor(None, game.delete_game)
                             game.delete_game()
 
-                    if (game_size == 5 or game_size == 6) and game.is_ranked and game.date < old_150d and not game.is_completed:
-                        # Max out ranked game deletion at game_size==6
-                        delete_result.append(f'Deleting incomplete ranked {game_size}-player game older than 150 days. - {game.get_headline()} - {game.date}{rank_str}')
-                        await game.delete_game_channels(self.bot.guilds, guild.id)
-                        # await self.bot.loop.run_in_executor(None, game.delete_game)
-                        models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
-                        game.delete_game()
-
-                    if game_size >= 5 and not game.is_ranked and game.date < old_120d and not game.is_completed:
-                        # no cap on unranked game deletion above 120 days old
-                        delete_result.append(f'Deleting incomplete unranked {game_size}-player game older than 120 days. - {game.get_headline()} - {game.date}{rank_str}')
-                        await game.delete_game_channels(self.bot.guilds, guild.id)
-                        # await self.bot.loop.run_in_executor(None, game.delete_game)
-                        models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
-                        game.delete_game()
-
-                delete_str = '\n'.join(delete_result)
-                logger.info(f'Purging incomplete games for guild {guild.name}:\n{delete_str}')
-                if len(delete_result):
-
-                    if staff_output_channel:
-                        await staff_output_channel.send(f'{delete_str[:1900]}\nFinished - purged {len(delete_result)} games')
-                    else:
-                        logger.debug(f'Could not load game_request_channel for server {guild.id} {guild.name} - performing task silently')
+                        if game_size >= 5 and not game.is_ranked and game.date < old_120d and not game.is_completed:
+                            # no cap on unranked game deletion above 120 days old
+                            delete_result.append(f'Deleting incomplete unranked {game_size}-player game older than 120 days. - {game.get_headline()} - {game.date}{rank_str}')
+                            await game.delete_game_channels(self.bot.guilds, guild.id)
+                            # await utilities.run_in_db_thread(game.delete_game)
+                            models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I purged the game during cleanup of old incomplete games.')
+                            game.delete_game()
+
+                    delete_str = '\n'.join(delete_result)
+                    logger.info(f'Purging incomplete games for guild {guild.name}:\n{delete_str}')
+                    if len(delete_result):
+
+                        if staff_output_channel:
+                            await staff_output_channel.send(f'{delete_str[:1900]}\nFinished - purged {len(delete_result)} games')
+                        else:
+                            logger.debug(f'Could not load game_request_channel for server {guild.id} {guild.name} - performing task silently')
 
             await asyncio.sleep(sleep_cycle)
 
@@ -451,7 +474,10 @@ async def logs(self, ctx, *, search_term: str = None):
             else:
                 return await ctx.send('Only the bot owner can search global logs.')
 
-        entries = models.GameLog.search(keywords=search_term, negative_keyword=negative_term, guild_id=guild_id)
+        def async_log_search():
+            return list(models.GameLog.search(keywords=search_term, negative_keyword=negative_term, guild_id=guild_id))
+
+        entries = await utilities.run_in_db_thread(async_log_search, guild_id=ctx.guild.id)
         for entry in entries:
             paginated_message_list.append((f'`{entry.message_ts.strftime("%Y-%m-%d %H:%M:%S")}`', entry.message[:500]))
 
@@ -905,6 +931,65 @@ async def backup_db(self, ctx):
                 logger.error('Error during execution')
                 return await ctx.send(f'Error during execution: {str(process.stderr)}')
 
+    @commands.command(usage='[wall | db | count | reset]')
+    @commands.is_owner()
+    async def perf(self, ctx, arg: str = 'wall'):
+        """*Owner*: Show per-command timings
+
+        Commands are listed by total wall time, total database time or number of calls since the bot started or stats were reset.
+        p50/p95 are the upper bounds of the histogram buckets the median and 95th percentile fall in.
+        **Examples**
+        `[p]perf` - Most expensive commands by total wall time
+        `[p]perf db` - By total database time
+        `[p]perf reset` - Clear the collected stats
+        """
+        arg = arg.lower()
+        if arg == 'reset':
+            perf.reset()
+            return await ctx.send('Command performance stats have been reset.')
+        if arg not in ('wall', 'db', 'count'):
+            return await ctx.send(f'Unknown sort order "{arg}". **Usage:** `{ctx.prefix}{ctx.command.name} {ctx.command.usage}`')
+
+        top = perf.top_commands(sort_by=arg, limit=15)
+        if not top:
+            return await ctx.send('No commands have finished since stats were collected.')
+
+        since = datetime.datetime.fromtimestamp(perf.summaries_since)
+        executor_stats = dbexecutor.db_executor.stats()
+        message = [f'**Command performance since {since:%Y-%m-%d %H:%M}**, sorted by {arg}',
+                   f'DB executor: {executor_stats["running"]}/{executor_stats["workers"]} workers busy, {executor_stats["queued"]} queued '
+                   f'(peak {executor_stats["peak_queued"]}), {executor_stats["rejected"]} rejected']
+        message.extend(f'`{name}` {summary.describe()}' for name, summary in top)
+        await utilities.buffered_send(destination=ctx, content='\n'.join(message))
+
+    @commands.command(usage='[logger] [level or sample rate]')
+    @commands.is_owner()
+    async def loglevel(self, ctx, logger_name: str = None, value: str = None):
+        """*Owner*: Show or change log levels without restarting
+
+        A level (DEBUG, INFO, WARNING, ERROR) sets the level of that logger. A number between 0 and 1 logs that fraction of the logger's records below WARNING.
+        Changes last until the bot restarts.
+        **Examples**
+        `[p]loglevel` - Show current levels
+        `[p]loglevel peewee 0.1` - Log one SQL statement in ten
+        `[p]loglevel peewee INFO` - Stop logging SQL statements
+        `[p]loglevel polybot.modules.matchmaking DEBUG`
+        """
+        if logger_name and value:
+            try:
+                if value.replace('.', '', 1).isdigit():
+                    logqueue.set_sample_rate(logger_name, float(value))
+                else:
+                    logqueue.set_level(logger_name, value)
+            except ValueError as e:
+                return await ctx.send(f'{e}. **Usage:** `{ctx.prefix}{ctx.command.name} {ctx.command.usage}`')
+            logger.warning(f'Logger {logger_name} set to {value} by {ctx.author.name}')
+        elif logger_name:
+            return await ctx.send(f'Include a level or sample rate. **Usage:** `{ctx.prefix}{ctx.command.name} {ctx.command.usage}`')
+
+        message = [f'`{name}` {level}{f" (sampling {rate:g})" if rate < 1 else ""}' for name, level, rate in logqueue.describe_loggers()]
+        await ctx.send('\n'.join(message))
+
 
 def setup(bot):
     bot.add_cog(administration(bot))
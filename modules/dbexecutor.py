@@ -0,0 +1,89 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import time
+import settings
+import modules.models as models
+import modules.exceptions as exceptions
+from modules import perf
+
+logger = logging.getLogger('polybot.' + __name__)
+
+
+class DBExecutor:
+    # Runs blocking database work on a fixed set of worker threads, each holding a pooled connection only while it works.
+    # Work waits in a queue per guild and free workers take from the guilds in turn, so a guild with a long queue
+    # (someone spamming $lb) only delays its own work and not a $win or $delete elsewhere.
+
+    def __init__(self, workers: int, max_queued_per_guild: int = 8):
+        self.workers = workers
+        self.max_queued_per_guild = max_queued_per_guild
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='polybot-db')
+        self.queues = collections.OrderedDict()  # guild_id -> deque of (func, args, future, context, queued at). Key order is the turn order
+        self.running = 0
+        self.submitted, self.rejected, self.peak_depth = 0, 0, 0
+
+    def depth(self, guild_id=None):
+        # work waiting for a free worker, for one guild or in total
+        if guild_id is not None:
+            return len(self.queues.get(guild_id, ()))
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self):
+        return {'workers': self.workers, 'running': self.running, 'queued': self.depth(), 'queued_guilds': len(self.queues),
+                'peak_queued': self.peak_depth, 'submitted': self.submitted, 'rejected': self.rejected}
+
+    def submit(self, guild_id, func, *args):
+        # Returns a future for func(*args). Raises ServerBusyError if guild_id already has max_queued_per_guild items waiting
+        queue = self.queues.get(guild_id, None)
+        if queue and len(queue) >= self.max_queued_per_guild:
+            self.rejected += 1
+            logger.warning(f'DBExecutor rejected {getattr(func, "__name__", func)} for guild {guild_id}: {len(queue)} items already queued')
+            raise exceptions.ServerBusyError('The bot is still working through earlier requests from this server. Try again in a moment.')
+
+        future = asyncio.get_event_loop().create_future()
+        # the caller's context goes with the work so its queries are counted against the command that submitted it
+        self.queues.setdefault(guild_id, collections.deque()).append((func, args, future, contextvars.copy_context(), time.perf_counter()))
+        self.submitted += 1
+        self.peak_depth = max(self.peak_depth, self.depth())
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        loop = asyncio.get_event_loop()
+        while self.running < self.workers and self.queues:
+            guild_id, queue = self.queues.popitem(last=False)
+            func, args, future, context, queued_at = queue.popleft()
+            if queue:
+                self.queues[guild_id] = queue  # back of the turn order
+            if future.cancelled():
+                continue
+            self.running += 1
+            work = loop.run_in_executor(self.pool, context.run, pooled_call, func, args, queued_at)
+            work.add_done_callback(functools.partial(self.finished, future))
+
+    def finished(self, future, work):
+        self.running -= 1
+        if not future.cancelled():
+            if work.cancelled():
+                future.cancel()
+            elif work.exception():
+                future.set_exception(work.exception())
+            else:
+                future.set_result(work.result())
+        self.dispatch()
+
+
+def pooled_call(func, args, queued_at: float):
+    # The worker thread checks its own connection out of the pool for the duration of func and hands it back afterwards,
+    # so it never shares a connection (or its cursors) with the event loop thread
+    perf.record_executor_wait(time.perf_counter() - queued_at)
+    with models.db.connection_context():
+        return func(*args)
+
+
+# one connection in the pool is held by the event loop thread
+db_executor = DBExecutor(workers=max(settings.psql_max_connections - 1, 1))
@@ -7,6 +7,11 @@ class CheckFailedError(MyBaseException):
     pass
 
 
+class ServerBusyError(MyBaseException):
+    """ Custom exception for when database work is refused because too much is already queued for the guild """
+    pass
+
+
 class NoSingleMatch(MyBaseException):
     """ Custom exception for when a single matching record cannot be found (zero or >1 found) """
     pass
@@ -4,6 +4,7 @@
 import settings
 import modules.exceptions as exceptions
 import modules.achievements as achievements
+from modules import perf
 import peewee
 import modules.models as models
 from modules.models import Game, db, Player, Team, DiscordMember, Squad, GameSide, Tribe, Lineup
@@ -25,9 +26,8 @@
 class PolyGame(commands.Converter):
     async def convert(self, ctx, game_id, allow_cross_guild=False):
 
-        utilities.connect()
         try:
-            game = Game.get(id=int(game_id))
+            game = await utilities.run_in_db_thread(Game.get_by_id, int(game_id), guild_id=ctx.guild.id)
         except (ValueError, peewee.DataError):
             await ctx.send(f'Invalid game ID "{game_id}".')
             raise commands.UserInputError()
@@ -62,12 +62,19 @@ class polygames(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.gamelog_task = bot.loop.create_task(self.task_flush_gamelog())  # runs regardless of run_tasks so the log buffer always drains
+        self.records_task = bot.loop.create_task(self.task_refresh_records())  # likewise, or records would go stale while tasks are off
         if settings.run_tasks:
             self.bg_task = bot.loop.create_task(self.task_purge_game_channels())
             self.bg_task2 = bot.loop.create_task(self.task_set_champion_role())
 
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
+        if not models.GameChannel.is_game_channel(channel.id):
+            return
+
+        models.GameChannel.unregister(channel.id)
+
         query = GameSide.update(team_chan=None).where(GameSide.team_chan == channel.id)
         res = query.execute()
         if res:
@@ -78,12 +85,20 @@ async def on_guild_channel_delete(self, channel):
         if res:
             logger.debug(f'on_guild_channel_delete: detected deletion of game channel {channel.id} {channel.name} and removed reference from db')
 
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        utilities.index_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        utilities.unindex_member(member)
+
     @commands.Cog.listener()
     async def on_user_update(self, before, after):
         if before.name != after.name:
+            utilities.reindex_user(after)
             logger.debug(f'Attempting to change member discordname for {before.name} to {after.name}')
             # update Discord Member Name, and update display name for each Guild/Player they share with the bot
-            utilities.connect()
             try:
                 discord_member = DiscordMember.select().where(DiscordMember.discord_id == after.id).get()
             except peewee.DoesNotExist:
@@ -92,13 +107,15 @@ async def on_user_update(self, before, after):
 
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
+        if before.nick != after.nick or before.name != after.name:
+            utilities.index_member(after)
+
         player_query = Player.select().join(DiscordMember).where(
             (DiscordMember.discord_id == after.id) & (Player.guild_id == after.guild.id)
         )
 
         banned_role = discord.utils.get(before.guild.roles, name='ELO Banned')
         if banned_role not in before.roles and banned_role in after.roles:
-            utilities.connect()
             try:
                 player = player_query.get()
             except peewee.DoesNotExist:
@@ -109,7 +126,6 @@ async def on_member_update(self, before, after):
             models.GameLog.write(game_id=0, guild_id=after.guild.id, message=f'{models.GameLog.member_string(after)} had *ELO Banned* role applied.')
 
         if banned_role in before.roles and banned_role not in after.roles:
-            utilities.connect()
             try:
                 player = player_query.get()
             except peewee.DoesNotExist:
@@ -121,7 +137,6 @@ async def on_member_update(self, before, after):
 
         inactive_role = discord.utils.get(before.guild.roles, name=settings.guild_setting(before.guild.id, 'inactive_role'))
         if inactive_role not in before.roles and inactive_role in after.roles:
-            utilities.connect()
             try:
                 player = player_query.get()
             except peewee.DoesNotExist:
@@ -130,7 +145,6 @@ async def on_member_update(self, before, after):
             models.GameLog.write(game_id=0, guild_id=after.guild.id, message=f'{models.GameLog.member_string(after)} had *{inactive_role.name}* role applied.')
 
         if inactive_role in before.roles and inactive_role not in after.roles:
-            utilities.connect()
             try:
                 player = player_query.get()
             except peewee.DoesNotExist:
@@ -144,7 +158,6 @@ async def on_member_update(self, before, after):
 
         if before.nick != after.nick:
             logger.debug(f'Attempting to change member nick for {before.name}({before.nick}) to {after.name}({after.nick})')
-            utilities.connect()
             # update nick in guild's Player record
             try:
                 player = player_query.get()
@@ -246,7 +259,6 @@ async def lb(self, ctx, *, filters: str = ''):
             lb_title += ' - Maximum ELO Achieved'
 
         def process_leaderboard():
-            utilities.connect()
             leaderboard_query = target_model.leaderboard(date_cutoff=date_cutoff, guild_id=ctx.guild.id, max_flag=max_flag)
 
             for counter, player in enumerate(leaderboard_query[:2000]):
@@ -258,7 +270,7 @@ def process_leaderboard():
             return leaderboard, leaderboard_query.count()
 
         async with ctx.typing():
-            leaderboard, leaderboard_size = await self.bot.loop.run_in_executor(None, process_leaderboard)
+            leaderboard, leaderboard_size = await utilities.run_in_db_thread(process_leaderboard, guild_id=ctx.guild.id)
 
         # if ctx.guild.id != settings.server_ids['polychampions']:
         #     await ctx.send('Powered by PolyChampions. League server with a team focus and competitive players.\n'
@@ -279,26 +291,30 @@ async def lbrecent(self, ctx):
             (Lineup.player == Player.id) & ((Game.date > last_month) | (Game.completed_ts > last_month)) & (Game.guild_id == ctx.guild.id)
         ).group_by(Player.id).order_by(-peewee.SQL('count'))
 
-        if ctx.invoked_with == 'lbactivealltime':
-            # special command to see all time active list by discord member
-            query = DiscordMember.select(DiscordMember, peewee.fn.COUNT(Lineup.id).alias('count')).join(Player).join(Lineup).join(Game).where(
-                (Lineup.player.discord_member == DiscordMember.id) & (Game.is_pending == 0)
-            ).group_by(DiscordMember.id).order_by(-peewee.SQL('count'))
+        def async_process_leaderboard():
+            if ctx.invoked_with == 'lbactivealltime':
+                # special command to see all time active list by discord member
+                member_query = DiscordMember.select(DiscordMember, peewee.fn.COUNT(Lineup.id).alias('count')).join(Player).join(Lineup).join(Game).where(
+                    (Lineup.player.discord_member == DiscordMember.id) & (Game.is_pending == 0)
+                ).group_by(DiscordMember.id).order_by(-peewee.SQL('count'))
+
+                for counter, discord_member in enumerate(member_query[:1000]):
+                    wins, losses = discord_member.get_record()
+                    leaderboard.append(
+                        (f'{(counter + 1):>3}. {discord_member.name}', f'`ELO {discord_member.elo}\u00A0\u00A0\u00A0\u00A0Games Played {discord_member.count}`')
+                    )
+                return '**Most active players of all time**'
+            else:
+                for counter, player in enumerate(query[:500]):
+                    wins, losses = player.get_record()
+                    emoji_str = player.team.emoji if player.team else ''
+                    leaderboard.append(
+                        (f'{(counter + 1):>3}. {emoji_str}{player.name}', f'`ELO {player.elo}\u00A0\u00A0\u00A0\u00A0Recent Games {player.count}`')
+                    )
+                return f'**Most Active Recent Players**\n{query.count()} players in past 30 days'
 
-            for counter, discord_member in enumerate(query[:1000]):
-                wins, losses = discord_member.get_record()
-                leaderboard.append(
-                    (f'{(counter + 1):>3}. {discord_member.name}', f'`ELO {discord_member.elo}\u00A0\u00A0\u00A0\u00A0Games Played {discord_member.count}`')
-                )
-            title = '**Most active players of all time**'
-        else:
-            for counter, player in enumerate(query[:500]):
-                wins, losses = player.get_record()
-                emoji_str = player.team.emoji if player.team else ''
-                leaderboard.append(
-                    (f'{(counter + 1):>3}. {emoji_str}{player.name}', f'`ELO {player.elo}\u00A0\u00A0\u00A0\u00A0Recent Games {player.count}`')
-                )
-            title = f'**Most Active Recent Players**\n{query.count()} players in past 30 days'
+        async with ctx.typing():
+            title = await utilities.run_in_db_thread(async_process_leaderboard, guild_id=ctx.guild.id)
 
         # if ctx.guild.id != settings.server_ids['polychampions']:
         #     await ctx.send('Powered by PolyChampions. League server with a team focus and competitive players.\n'
@@ -415,15 +431,12 @@ async def lbsquad(self, ctx):
         """
 
         leaderboard = []
-        squads = Squad.leaderboard(date_cutoff=settings.date_cutoff, guild_id=ctx.guild.id)
-        for counter, sq in enumerate(squads[:200]):
-            wins, losses = sq.get_record()
-            squad_members = sq.get_members()
-            emoji_list = [p.team.emoji for p in squad_members if p.team is not None]
+        squads = await utilities.run_in_db_thread(Squad.leaderboard_summary, settings.date_cutoff, ctx.guild.id, 200, guild_id=ctx.guild.id)
+        for counter, (squad_id, elo, wins, losses, member_names, emoji_list) in enumerate(squads):
             emoji_string = ' '.join(emoji_list)
-            squad_names = ' / '.join(sq.get_names())
+            squad_names = ' / '.join(member_names)
             leaderboard.append(
-                (f'{(counter + 1):>3}. {emoji_string}{squad_names}', f'`#{sq.id} (ELO: {sq.elo:4}) W {wins} / L {losses}`')
+                (f'{(counter + 1):>3}. {emoji_string}{squad_names}', f'`#{squad_id} (ELO: {elo:4}) W {wins} / L {losses}`')
             )
         await utilities.paginate(self.bot, ctx, title='**Squad Leaderboards**', message_list=leaderboard, page_start=0, page_end=10, page_size=10)
 
@@ -530,7 +543,7 @@ async def player(self, ctx, *, args=None):
             # Helps in a scenario where there are two existing players in the DB with the same name, but only one is actively on the server
             player_mention = str(guild_matches[0].id)
 
-        player_results = Player.string_matches(player_string=player_mention, guild_id=ctx.guild.id)
+        player_results = Player.string_matches(player_string=player_mention, guild_id=ctx.guild.id, fuzzy=True)
 
         if len(player_results) > 1:
             p_names = [p.name for p in player_results]
@@ -555,7 +568,6 @@ async def player(self, ctx, *, args=None):
             player = player_results[0]
 
         def async_create_player_embed():
-            utilities.connect()
             wins, losses = player.get_record()
             rank, lb_length = player.leaderboard_rank(settings.date_cutoff)
 
@@ -717,7 +729,7 @@ def async_create_player_embed():
             return content_str, embed, image, matchup_games
 
         async with ctx.typing():
-            content_str, embed, image, matchup_games = await self.bot.loop.run_in_executor(None, async_create_player_embed)
+            content_str, embed, image, matchup_games = await utilities.run_in_db_thread(async_create_player_embed, guild_id=ctx.guild.id)
 
         await ctx.send(content=content_str, file=image, embed=embed)
 
@@ -1186,7 +1198,8 @@ async def game(self, ctx, *, game_search: str = None):
         # Converting manually here to handle case of user passing a game name so info can be redirected to games() command
         game = await PolyGame().convert(ctx, game_search)
 
-        embed, content = game.embed(guild=ctx.guild, prefix=ctx.prefix)
+        async with ctx.typing():
+            embed, content = await utilities.run_in_db_thread(game.embed, ctx.guild, ctx.prefix, guild_id=ctx.guild.id)
         return await ctx.send(embed=embed, content=content)
 
     @settings.in_bot_channel_strict()
@@ -1479,14 +1492,7 @@ async def win(self, ctx, winning_game: PolyGame = None, *, winning_side_name: st
         else:
             if confirm_win:
                 # Cleanup game channels and announce winners
-                # try/except block is attempt at a bandaid where sometimes an InterfaceError/Cursor Closed exception would hit here, probably due to issues with async code
-
-                try:
-                    await post_win_messaging(ctx.guild, ctx.prefix, ctx.channel, winning_game)
-                except peewee.PeeweeException as e:
-                    logger.error(f'Error during win command triggering post_win_messaging - trying to reopen and run again: {e}')
-                    db.connect(reuse_if_open=True)
-                    await post_win_messaging(ctx.guild, ctx.prefix, ctx.channel, winning_game)
+                await post_win_messaging(ctx.guild, ctx.prefix, ctx.channel, winning_game)
 
     @settings.in_bot_channel()
     @models.is_registered_member()
@@ -1606,6 +1612,7 @@ async def delete(self, ctx, game: PolyGame = None):
                 return await ctx.send(f'Only the game host{host_name} or server staff can do this.')
             models.GameLog.write(game_id=game, guild_id=ctx.guild.id, message=f'{models.GameLog.member_string(ctx.author)} deleted the game.')
             game.delete_game()
+            self.bot.dispatch('pending_game_change', game.id)
             return await ctx.send(f'Deleting open game {game.id}')
 
         if not settings.is_mod(ctx):
@@ -1623,12 +1630,12 @@ async def delete(self, ctx, game: PolyGame = None):
         gid = game.id
         try:
             async with ctx.typing():
-                await self.bot.loop.run_in_executor(None, game.delete_game)
+                await utilities.run_in_db_thread(game.delete_game, guild_id=ctx.guild.id)
                 # Allows bot to remain responsive while this large operation is running.
                 await ctx.send(f'Game with ID {gid} has been deleted and team/player ELO changes have been reverted, if applicable.')
         except discord.errors.NotFound:
             logger.warning('Game deleted while in game-related channel')
-            await self.bot.loop.run_in_executor(None, game.delete_game)
+            await utilities.run_in_db_thread(game.delete_game, guild_id=ctx.guild.id)
 
     @commands.command(usage='game_id "New Name"')
     @models.is_registered_member()
@@ -1808,7 +1815,6 @@ async def game_search(self, ctx, mode: str, arg_list):
             results_str = f'All {status_str}s'
 
             def async_game_search():
-                utilities.connect()
                 query = Game.search(status_filter=status_filter, guild_id=ctx.guild.id)
                 if status_filter == 2:
                     query = list(query)  # reversing 'Incomplete' queries so oldest is at top
@@ -1819,7 +1825,7 @@ def async_game_search():
                 game_list = utilities.summarize_game_list(query[:500])
                 return game_list, list_name
 
-            game_list, list_name = await self.bot.loop.run_in_executor(None, async_game_search)
+            game_list, list_name = await utilities.run_in_db_thread(async_game_search, guild_id=ctx.guild.id)
         else:
             if not target_list:
                 # Target is person issuing command
@@ -1857,7 +1863,6 @@ def async_game_search():
                 results_str = 'No filters applied'
 
             def async_game_search():
-                utilities.connect()
                 query = Game.search(status_filter=status_filter, player_filter=player_matches, team_filter=team_matches, title_filter=remaining_args, guild_id=ctx.guild.id, size_filter=team_sizes)
                 logger.debug(f'Searching games, status filter: {status_filter}, player_filter: {player_matches}, team_filter: {team_matches}, title_filter: {remaining_args}')
                 logger.debug(f'Returned {len(query)} results')
@@ -1865,32 +1870,65 @@ def async_game_search():
                 list_name = f'{len(query)} {status_str}{"s" if len(query) != 1 else ""}\n{results_str}'
                 return game_list, list_name
 
-            game_list, list_name = await self.bot.loop.run_in_executor(None, async_game_search)
+            game_list, list_name = await utilities.run_in_db_thread(async_game_search, guild_id=ctx.guild.id)
 
         if len(game_list) == 0:
             return await ctx.send(f'No results. See `{ctx.prefix}help {ctx.invoked_with}` for usage examples. Searched for:\n{results_str}')
         await utilities.paginate(self.bot, ctx, title=list_name, message_list=game_list, page_start=0, page_end=15, page_size=15)
 
+    async def task_flush_gamelog(self):
+        # write buffered GameLog entries in batches once enough have queued up or the oldest has waited long enough
+        models.gamelog_buffer_enabled = True
+        try:
+            while not self.bot.is_closed():
+                await asyncio.sleep(1)
+                if not models.GameLog.flush_is_due():
+                    continue
+                with perf.timed_task('task_flush_gamelog'):
+                    try:
+                        await utilities.run_in_db_thread(models.GameLog.flush_buffer)
+                    except exceptions.ServerBusyError:
+                        pass  # entries stay buffered until the next pass
+        finally:
+            models.gamelog_buffer_enabled = False
+            if models.gamelog_buffer:
+                models.GameLog.flush_buffer()
+
+    async def task_refresh_records(self):
+        # refresh the win/loss record views once confirmations have stopped coming in, see models.RecordView
+        while not self.bot.is_closed():
+            await asyncio.sleep(5)
+            if not models.RecordView.refresh_is_due():
+                continue
+            with perf.timed_task('task_refresh_records'):
+                logger.debug('Task running: task_refresh_records')
+                try:
+                    await utilities.run_in_db_thread(models.RecordView.refresh_all)
+                except exceptions.ServerBusyError:
+                    pass  # views stay stale until the next pass
+                except peewee.PeeweeException as e:
+                    logger.error(f'task_refresh_records: refresh failed, will retry: {e}')
+
     async def task_purge_game_channels(self):
         await self.bot.wait_until_ready()
         while not self.bot.is_closed():
             # purge game channels from games that were concluded at least 24 hours ago
 
             await asyncio.sleep(60)
-            logger.debug('Task running: task_purge_game_channels')
-            yesterday = (datetime.datetime.now() + datetime.timedelta(hours=-24))
+            with perf.timed_task('task_purge_game_channels'):
+                logger.debug('Task running: task_purge_game_channels')
+                yesterday = (datetime.datetime.now() + datetime.timedelta(hours=-24))
 
-            utilities.connect()
-            old_games = Game.select().join(GameSide, on=(GameSide.game == Game.id)).where(
-                (Game.is_confirmed == 1) & (Game.completed_ts < yesterday) &
-                ((GameSide.team_chan.is_null(False)) | (Game.game_chan.is_null(False)))
-            )
+                old_games = Game.select().join(GameSide, on=(GameSide.game == Game.id)).where(
+                    (Game.is_confirmed == 1) & (Game.completed_ts < yesterday) &
+                    ((GameSide.team_chan.is_null(False)) | (Game.game_chan.is_null(False)))
+                )
 
-            logger.info(f'running task_purge_game_channels on {len(old_games)} games')
-            for game in old_games:
-                guild = discord.utils.get(self.bot.guilds, id=game.guild_id)
-                if guild:
-                    await game.delete_game_channels(self.bot.guilds, game.guild_id)
+                logger.info(f'running task_purge_game_channels on {len(old_games)} games')
+                for game in old_games:
+                    guild = discord.utils.get(self.bot.guilds, id=game.guild_id)
+                    if guild:
+                        await game.delete_game_channels(self.bot.guilds, game.guild_id)
 
             await asyncio.sleep(60 * 60 * 2)
 
@@ -1899,9 +1937,9 @@ async def task_set_champion_role(self):
         while not self.bot.is_closed():
 
             await asyncio.sleep(7)
-            logger.debug('Task running: task_set_champion_role')
-            utilities.connect()
-            await achievements.set_champion_role()
+            with perf.timed_task('task_set_champion_role'):
+                logger.debug('Task running: task_set_champion_role')
+                await achievements.set_champion_role()
 
             await asyncio.sleep(60 * 60 * 2)
 
@@ -38,7 +38,7 @@
     ('Jalapenos', ['', 'The Jalapenos'])
 ]
 
-league_team_channels = []
+league_team_channels = set()
 next_nova_newbie = 'Nova Red'  # Alternates between Red/Blue. Seeded randomly by Cog.on_ready()
 
 
@@ -162,7 +162,6 @@ async def on_member_update(self, before, after):
 
     @commands.Cog.listener()
     async def on_ready(self):
-        utilities.connect()
         # assume polychampions
         self.announcement_message = self.get_draft_config(settings.server_ids['polychampions'])['announcement_message']
         if self.bot.user.id == 479029527553638401:
@@ -914,7 +913,7 @@ def async_call_export_func():
                 return filename
 
             async with ctx.typing():
-                filename = await self.bot.loop.run_in_executor(None, async_call_export_func)
+                filename = await utilities.run_in_db_thread(async_call_export_func, guild_id=ctx.guild.id)
                 with open(filename, 'rb') as f:
                     file = io.BytesIO(f.read())
                 file = discord.File(file, filename=filename)
@@ -957,7 +956,7 @@ def async_call_export_func():
             return await ctx.send(f'No matching games found.')
 
         async with ctx.typing():
-            filename = await self.bot.loop.run_in_executor(None, async_call_export_func)
+            filename = await utilities.run_in_db_thread(async_call_export_func, guild_id=ctx.guild.id)
             with open(filename, 'rb') as f:
                 file = io.BytesIO(f.read())
             file = discord.File(file, filename=filename)
@@ -1046,14 +1045,13 @@ def populate_league_team_channels():
     league_teams = models.Team.select(models.Team.id).where(
         (models.Team.guild_id == settings.server_ids['polychampions']) & (models.Team.is_hidden == 0)
     )
-    query = models.GameSide.select(models.GameSide.team_chan).join(models.Game).where(
-        (models.GameSide.team_chan.is_null(False)) &
-        (models.GameSide.game.guild_id == settings.server_ids['polychampions']) &
-        (models.GameSide.game.is_confirmed == 0) &
+    query = models.GameChannel.select(models.GameChannel.channel_id).join(models.GameSide).join(models.Game).where(
+        (models.Game.guild_id == settings.server_ids['polychampions']) &
+        (models.Game.is_confirmed == 0) &
         (models.GameSide.team.in_(league_teams))
     ).tuples()
 
-    league_team_channels = [tc[0] for tc in query]
+    league_team_channels = {tc[0] for tc in query}
     logger.debug(f'updating league_team_channels, len {len(league_team_channels)}')
     return len(league_team_channels)
 
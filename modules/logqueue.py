@@ -0,0 +1,92 @@
+import atexit
+import logging
+import queue
+import random
+import sys
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# Logging goes through a queue to a single writer thread, so the event loop (or a DB executor thread logging peewee SQL)
+# only pays for putting a record on the queue. Formatting and file writes happen on the writer thread.
+#
+# full_bot.log - everything. discord.log - everything except peewee. elo.log - polybot.elo only. stderr - polybot errors
+
+log_format = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+configured_loggers = {'polybot': logging.DEBUG, 'polybot.elo': logging.DEBUG, 'discord': logging.INFO, 'peewee': logging.DEBUG,
+                      'asyncio': logging.WARNING}  # asyncio only logs slow callbacks when asyncio_debug is set in config.ini
+samplers = {}  # logger name -> SamplingFilter
+
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock QueueHandler formats each record on the calling thread so it can be pickled.
+    # This queue never leaves the process, so records are passed through untouched and formatted by the writer thread
+
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    # Passes a random fraction of a logger's records below WARNING, ie. rate=0.1 logs about one SQL statement in ten
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return self.rate >= 1 or record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def exclude_peewee(record):
+    return not record.name.startswith('peewee')
+
+
+def configure_logging(peewee_sample_rate: float = 1.0):
+    handler = RotatingFileHandler(filename='logs/full_bot.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=10)
+    partial_handler = RotatingFileHandler(filename='logs/discord.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=10)
+    partial_handler.addFilter(exclude_peewee)
+    elo_handler = RotatingFileHandler(filename='logs/elo.log', encoding='utf-8', maxBytes=1024 * 1024 * 2, backupCount=5)
+    elo_handler.addFilter(logging.Filter('polybot.elo'))
+    err = logging.StreamHandler(sys.stderr)
+    err.setLevel(logging.ERROR)
+    err.addFilter(logging.Filter('polybot'))
+    for file_handler in (handler, partial_handler, elo_handler, err):
+        file_handler.setFormatter(logging.Formatter(log_format))
+
+    log_queue = queue.Queue(-1)
+    queue_handler = DeferredQueueHandler(log_queue)
+    for name, level in configured_loggers.items():
+        named_logger = logging.getLogger(name)
+        named_logger.setLevel(level)
+        named_logger.handlers.clear()
+        if name != 'polybot.elo':  # propagates to polybot
+            named_logger.addHandler(queue_handler)
+    set_sample_rate('peewee', peewee_sample_rate)
+
+    listener = QueueListener(log_queue, handler, partial_handler, elo_handler, err, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # writes out whatever is still queued
+    return listener
+
+
+def set_level(name: str, level: str):
+    # Raises ValueError for an unknown level name
+    level_number = logging.getLevelName(level.upper())
+    if not isinstance(level_number, int):
+        raise ValueError(f'Unknown log level {level}')
+    logging.getLogger(name).setLevel(level_number)
+
+
+def set_sample_rate(name: str, rate: float):
+    if not 0 <= rate <= 1:
+        raise ValueError('Sample rate must be between 0 and 1')
+    if name not in samplers:
+        samplers[name] = SamplingFilter(rate)
+        logging.getLogger(name).addFilter(samplers[name])
+    samplers[name].rate = rate
+
+
+def describe_loggers():
+    # [(logger name, effective level name, sample rate)] for the loggers configured here and any whose level has been changed
+    names = set(configured_loggers) | set(name for name, named_logger in logging.Logger.manager.loggerDict.items()
+                                          if isinstance(named_logger, logging.Logger) and named_logger.level != logging.NOTSET)
+    return [(name, logging.getLevelName(logging.getLogger(name).getEffectiveLevel()), samplers[name].rate if name in samplers else 1.0)
+            for name in sorted(names)]
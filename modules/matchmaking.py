@@ -4,6 +4,8 @@
 import modules.utilities as utilities
 import settings
 import modules.exceptions as exceptions
+import modules.matchqueue as matchqueue
+from modules import perf
 from modules.games import post_newgame_messaging
 import peewee
 import re
@@ -15,14 +17,20 @@
 logger = logging.getLogger('polybot.' + __name__)
 
 
+def load_waitlist(guild_id: int, discord_id: int):
+    # (IDs of full games hosted by discord_id, IDs of started games waiting for discord_id to create them)
+    hosting = [f'{g.id}' for g in models.Game.search_pending(status_filter=1, guild_id=guild_id, host_discord_id=discord_id)]
+    creating = [f'{g.game}' for g in models.Game.waiting_for_creator(creator_discord_id=discord_id)]
+    return hosting, creating
+
+
 class PolyMatch(commands.Converter):
     async def convert(self, ctx, match_id: int):
 
         match_id = match_id.strip('#')
 
-        utilities.connect()
         try:
-            match = models.Game.get(id=match_id)
+            match = await utilities.run_in_db_thread(models.Game.get_by_id, match_id, guild_id=ctx.guild.id)
             logger.debug(f'Game with ID {match_id} found.')
 
             if match.guild_id != ctx.guild.id:
@@ -40,6 +48,11 @@ async def convert(self, ctx, match_id: int):
             raise commands.UserInputError()
 
 
+def lobby_key(guild_id: int, size, is_ranked: bool, notes: str):
+    # Key shared by an entry in settings.lobbies and the unhosted games that can satisfy it
+    return (guild_id, tuple(size), bool(is_ranked), notes or '')
+
+
 class matchmaking(commands.Cog):
     """
     Host open and find open games.
@@ -47,11 +60,60 @@ class matchmaking(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.lobby_index = {}  # lobby_key() -> {game_id: players joined} for unhosted games with open slots
+        self.lobby_games = {}  # game_id -> lobby_key(), for every game in lobby_index
+        self.lobby_wakeup = asyncio.Event()
+        self.expiry_wakeup = asyncio.Event()
+        self.match_queue = matchqueue.MatchQueue()
+        self.queue_task = bot.loop.create_task(self.task_match_queue())  # runs regardless of run_tasks since $queue is always available
+        self.expiry_task = bot.loop.create_task(self.task_purge_expired_games())  # likewise, since $games no longer purges expired games itself
         if settings.run_tasks:
             self.bg_task = bot.loop.create_task(self.task_print_matchlist())
             self.bg_task2 = bot.loop.create_task(self.task_dm_game_creators())
             self.bg_task3 = bot.loop.create_task(self.task_create_empty_matchmaking_lobbies())
 
+    @commands.Cog.listener()
+    async def on_pending_game_change(self, game_id: int):
+        # Dispatched when players join or leave a pending game, or it is started or deleted.
+        # Only games already in lobby_index matter - everything else is picked up by the periodic reconcile.
+        if game_id not in self.lobby_games:
+            return
+        self.refresh_lobby(game_id)
+        self.lobby_wakeup.set()
+
+    @commands.Cog.listener('on_pending_game_change')
+    async def wake_expiry_scheduler(self, game_id: int):
+        # A new game or a newly opened slot can move the next expiration earlier than the one task_purge_expired_games is sleeping until
+        self.expiry_wakeup.set()
+
+    def index_lobby(self, game):
+        key = lobby_key(game.guild_id, game.size, game.is_ranked, game.notes)
+        self.lobby_index.setdefault(key, {})[game.id] = sum(game.size) - game.open_slots
+        self.lobby_games[game.id] = key
+
+    def refresh_lobby(self, game_id: int):
+        key = self.lobby_games.pop(game_id, None)
+        if key:
+            self.lobby_index[key].pop(game_id, None)
+        for game in models.Game.open_lobbies(game_id=game_id):
+            self.index_lobby(game)
+
+    def reconcile_lobbies(self):
+        self.lobby_index, self.lobby_games = {}, {}
+        for game in models.Game.open_lobbies():
+            self.index_lobby(game)
+        logger.debug(f'reconcile_lobbies: indexed {len(self.lobby_games)} unhosted games')
+
+    def lobby_is_stocked(self, lobby):
+        # if remake_partial == True, lobby will be regenerated if anybody is in it.
+        # if remake_partial == False, lobby will only be regenerated once it is full
+        key = lobby_key(lobby['guild'], lobby['size'], lobby['ranked'], lobby['notes'])
+        perf.record_cache_lookup('lobby_index', hit=key in self.lobby_index)  # miss = no open game indexed for this lobby
+        games = self.lobby_index.get(key, {})
+        if lobby['remake_partial']:
+            return any(players == 0 for players in games.values())
+        return len(games) > 0
+
     @settings.in_bot_channel()
     @models.is_registered_member()
     @commands.command(aliases=['openmatch', 'open', 'opensteam'], usage='size expiration rules')
@@ -281,7 +343,8 @@ async def opengame(self, ctx, *, args=None):
             host.team = player_team
             host.save()
 
-            opengame = models.Game.create(host=host, expiration=expiration_timestamp, notes=game_notes, guild_id=ctx.guild.id, is_pending=True, is_ranked=is_ranked, size=team_sizes, is_mobile=is_mobile)
+            opengame = models.Game.create(host=host, expiration=expiration_timestamp, notes=game_notes, guild_id=ctx.guild.id, is_pending=True, is_ranked=is_ranked, size=team_sizes, is_mobile=is_mobile,
+                                          **models.Game.requirements_from_notes(game_notes))
             for count, size in enumerate(team_sizes):
                 models.GameSide.create(game=opengame, size=size, position=count + 1, required_role_id=required_roles[count], sidename=required_role_names[count])
 
@@ -306,9 +369,142 @@ async def opengame(self, ctx, *, args=None):
             await ctx.send(warning_message)
 
         models.GameLog.write(game_id=opengame, guild_id=ctx.guild.id, message=f'{models.GameLog.member_string(ctx.author)} opened new {team_size_str} game. Notes: *{discord.utils.escape_markdown(notes_str)}*')
+        self.bot.dispatch('pending_game_change', opengame.id)
         await ctx.send(f'Starting new {"__Steam__ " if not is_mobile else ""}{"unranked " if not is_ranked else ""}open game ID {opengame.id}. Size: {team_size_str}. Expiration: {expiration_hours} hours.\nNotes: *{notes_str}*\n'
             f'Other players can join this game with `{ctx.prefix}join {opengame.id}`.')
 
+    @settings.in_bot_channel()
+    @models.is_registered_member()
+    @commands.command(usage='format [unranked] [steam]', aliases=['autojoin'])
+    async def queue(self, ctx, *args):
+        """
+        Queue to be matched into a game automatically
+        You will be put in a game with players of similar ELO. The longer you wait, the wider the ELO range that is accepted.
+        Formats are 1v1, 2v2, 3v3, and FFA (three players). Games are ranked and mobile unless you add *unranked* or *steam*.
+        When enough players are matched a full game is opened, and the game creator must create it in Polytopia and use `[p]start`.
+
+        **Examples:**
+        `[p]queue 1v1` - Queue for a ranked 1v1 game
+        `[p]queue 2v2 unranked steam` - Queue for an unranked 2v2 Steam game
+        `[p]queue` - See where you are in the queue
+        `[p]queue leave` - Leave the queue
+        """
+
+        syntax = f'**Example usage**:\n__`{ctx.prefix}queue 1v1`__ - Queue for a ranked 1v1 game\n__`{ctx.prefix}queue 2v2 unranked`__ - Queue for an unranked 2v2 game'
+        entry = self.match_queue.get(ctx.guild.id, ctx.author.id)
+
+        if not args:
+            if not entry:
+                return await ctx.send(f'You are not in the matchmaking queue.\n{syntax}')
+            ahead, total = self.match_queue.position(entry)
+            minutes = int((datetime.datetime.now() - entry.joined).total_seconds() / 60)
+            return await ctx.send(f'You have been queued for a {"ranked" if entry.is_ranked else "unranked"} **{entry.format.upper()}** game for {minutes} minutes. '
+                f'{ahead} of the {total} players waiting for that format joined before you.')
+
+        if args[0].lower() in ['leave', 'exit', 'cancel']:
+            if not self.match_queue.remove(ctx.guild.id, ctx.author.id):
+                return await ctx.send('You are not in the matchmaking queue.')
+            return await ctx.send('You have left the matchmaking queue.')
+
+        if entry:
+            return await ctx.send(f'You are already queued for a **{entry.format.upper()}** game. Use `{ctx.prefix}queue leave` first to change your queue.')
+
+        queue_format, is_ranked = None, True
+        is_mobile = not (settings.guild_setting(ctx.guild.id, 'steam_game_channel') and ctx.channel.id == settings.guild_setting(ctx.guild.id, 'steam_game_channel'))
+        for arg in args:
+            if arg.lower() in matchqueue.queue_formats:
+                queue_format = arg.lower()
+            elif arg.lower()[:8] == 'unranked':
+                is_ranked = False
+            elif arg.lower() == 'steam':
+                is_mobile = False
+            elif arg.lower() == 'mobile':
+                is_mobile = True
+            else:
+                return await ctx.send(f'Unrecognized argument *{arg}*.\n{syntax}')
+
+        if not queue_format:
+            return await ctx.send(f'Game format is required. Options are: {", ".join(f.upper() for f in matchqueue.queue_formats)}\n{syntax}')
+
+        player, _ = models.Player.get_by_discord_id(discord_id=ctx.author.id, discord_name=ctx.author.name, discord_nick=ctx.author.nick, guild_id=ctx.guild.id)
+        if not player:
+            return await ctx.send(f'You must be a registered player before joining the queue. Try `{ctx.prefix}setcode POLYCODE`')
+
+        if player.is_banned or player.discord_member.is_banned:
+            return await ctx.send(f'**{player.name}** has been **ELO Banned** and cannot join any new games. :cry:')
+
+        if is_mobile and not player.discord_member.polytopia_id:
+            return await ctx.send(f'You do not have a Polytopia game code on file. Use `{ctx.prefix}setcode` to set one.')
+        if not is_mobile and not player.discord_member.name_steam:
+            return await ctx.send(f'You do not have a Steam username on file. Use `{ctx.prefix}steamname` to set one.')
+
+        on_team, _ = models.Player.is_in_team(guild_id=ctx.guild.id, discord_member=ctx.author)
+        if settings.guild_setting(ctx.guild.id, 'require_teams') and not on_team:
+            return await ctx.send(f'You must join a Team in order to participate in games on this server.')
+
+        game_allowed, join_error_message = settings.can_user_join_game(user_level=settings.get_user_level(ctx), game_size=sum(matchqueue.queue_formats[queue_format]), is_ranked=is_ranked, is_host=False)
+        if not game_allowed:
+            return await ctx.send(join_error_message)
+
+        self.match_queue.add(matchqueue.QueueEntry(discord_id=ctx.author.id, guild_id=ctx.guild.id, elo=player.elo, format=queue_format,
+                                                   is_ranked=is_ranked, is_mobile=is_mobile, channel_id=ctx.channel.id))
+        logger.info(f'Queued {ctx.author.id} for {queue_format} ranked: {is_ranked} mobile: {is_mobile} with elo {player.elo}')
+        await ctx.send(f'You are queued for a {"ranked" if is_ranked else "unranked"} {"" if is_mobile else "__Steam__ "}**{queue_format.upper()}** game. '
+            f'You will be mentioned here when a game is found. Leave the queue with `{ctx.prefix}queue leave`.')
+
+    @settings.in_bot_channel()
+    @commands.command(usage='player1 player2 player3 player4 ...', aliases=['teamsplit', 'fairteams'])
+    async def splitteams(self, ctx, *args):
+        """
+        Find the fairest way to split players into two teams
+        Lists the splits with win chances closest to 50/50, based on each player's ELO on this server.
+
+        **Examples:**
+        `[p]splitteams @Nelluk @koric @rickdaheals @Anarcho` - Fairest 2v2 splits of four players
+        `[p]splitteams 3 Nelluk koric rickdaheals Anarcho frodakcin jd` - Show the top 3 splits for a 3v3
+        """
+
+        top_k = 5
+        args = list(args)
+        if args and args[0].isdigit() and len(args[0]) < 3:
+            top_k = min(int(args.pop(0)), 10)
+
+        if len(args) < 2 or len(args) % 2 != 0:
+            return await ctx.send(f'An even number of players is required. **Example:** `{ctx.prefix}splitteams @Player1 @Player2 @Player3 @Player4`')
+        if len(args) > 24:
+            return await ctx.send('Splitting teams is limited to 24 players.')
+
+        discord_members = []
+        for arg in args:
+            guild_matches = await utilities.get_guild_member(ctx, arg)
+            if len(guild_matches) == 0:
+                return await ctx.send(f'Could not match "**{arg}**" to a server member. Try using an @Mention.')
+            if len(guild_matches) > 1:
+                return await ctx.send(f'More than one server matches found for "**{arg}**". Try being more specific or using an @Mention.')
+            if guild_matches[0] in discord_members:
+                return await ctx.send(f'Duplicate player **{guild_matches[0].name}** detected.')
+            discord_members.append(guild_matches[0])
+
+        # one query for every player's ELO, reused for each candidate split
+        players = {p.discord_member.discord_id: p for p in models.Player.select(models.Player, models.DiscordMember).join(models.DiscordMember).where(
+            (models.DiscordMember.discord_id.in_([m.id for m in discord_members])) & (models.Player.guild_id == ctx.guild.id)
+        )}
+        unregistered = [m.name for m in discord_members if m.id not in players]
+        if unregistered:
+            return await ctx.send(f'These players are not registered on this server: **{", ".join(unregistered)}**')
+
+        player_list = [players[m.id] for m in discord_members]
+        team_size = len(player_list) // 2
+        splits = models.Game.balanced_splits([p.elo for p in player_list], team_size=team_size, top_k=top_k)
+
+        output = [f'__Fairest {team_size}v{team_size} splits__']
+        for count, (side1, side2, win_chances) in enumerate(splits):
+            side1_str = ', '.join(f'{player_list[i].name} ({player_list[i].elo})' for i in side1)
+            side2_str = ', '.join(f'{player_list[i].name} ({player_list[i].elo})' for i in side2)
+            output.append(f'**{count + 1}.** {side1_str} **vs** {side2_str} - *{int(round(win_chances[0] * 100))}% / {int(round(win_chances[1] * 100))}%*')
+
+        await utilities.buffered_send(destination=ctx, content='\n'.join(output).replace('@', '@\u200b'))
+
     @settings.in_bot_channel()
     @commands.command(aliases=['matchside', 'sidename'], usage='match_id side_number Side Name', hidden=True)
     async def gameside(self, ctx, game: PolyMatch, side_lookup: str, *, args=None):
@@ -370,8 +566,7 @@ async def join(self, ctx, game: PolyMatch = None, *args):
         if not game.is_pending:
             return await ctx.send(f'The game has already started and can no longer be joined.')
 
-        waitlist_hosting = [f'{g.id}' for g in models.Game.search_pending(status_filter=1, guild_id=ctx.guild.id, host_discord_id=ctx.author.id)]
-        waitlist_creating = [f'{g.game}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
+        waitlist_hosting, waitlist_creating = await utilities.run_in_db_thread(load_waitlist, ctx.guild.id, ctx.author.id, guild_id=ctx.guild.id)
         waitlist = set(waitlist_hosting + waitlist_creating)
 
         if len(waitlist) > 2 and settings.get_user_level(ctx) < 3:
@@ -481,7 +676,6 @@ async def join(self, ctx, game: PolyMatch = None, *args):
         #     if (game.is_ranked and game_size) > 6 or (not game.is_ranked and game_size > 12):
         #         return await ctx.send(f'You are a restricted user (*level 2*) - complete a few more ELO games to have more permissions.\n{settings.levels_info}')
 
-        notes = game.notes if game.notes else ''
         (min_elo, max_elo, min_elo_g, max_elo_g) = game.elo_requirements()
 
         if player.elo < min_elo or player.elo > max_elo:
@@ -495,7 +689,7 @@ async def join(self, ctx, game: PolyMatch = None, *args):
             await ctx.send(f'This game has an ELO restriction of {min_elo_g} - {max_elo_g}. Bypassing because you are game host or a mod.')
 
         # list of ID strings that are allowed to join game, e.g. ['272510639124250625', '481527584107003904']
-        player_restricted_list = re.findall(r'<@!?(\d+)>', notes)
+        player_restricted_list = [str(i) for i in game.invited_ids] if game.invited_ids else []
 
         if player_restricted_list and str(joining_member.id) not in player_restricted_list and (len(player_restricted_list) >= game_size - 1):
             # checking length of player_restricted_list compared to game capacity.. only using restriction if capacity is at least game_size - 1
@@ -510,6 +704,7 @@ async def join(self, ctx, game: PolyMatch = None, *args):
             player.team = player_team  # update player record with detected team in case its changed since last game.
             logger.debug(f'Associating team {player_team} with player {player.id} {player.name}')
             player.save()
+        self.bot.dispatch('pending_game_change', game.id)
         await ctx.send(f'Joining {joining_member.mention} to side {side.position} of game {game.id}')
         models.GameLog.write(game_id=game, guild_id=ctx.guild.id, message=f'Side {side.position} joined by {models.GameLog.member_string(player.discord_member)} {log_by_str}')
         players, capacity = game.capacity()
@@ -530,8 +725,7 @@ async def join(self, ctx, game: PolyMatch = None, *args):
             await ctx.send(f':warning: Use `{ctx.prefix}setname Your Mobile Name` to set your in-game name. This will replace your friend code in the near future.')
 
         # Alert user if they have >1 games ready to start
-        waitlist_hosting = [f'{g.id}' for g in models.Game.search_pending(status_filter=1, guild_id=ctx.guild.id, host_discord_id=ctx.author.id)]
-        waitlist_creating = [f'{g.game}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
+        waitlist_hosting, waitlist_creating = await utilities.run_in_db_thread(load_waitlist, ctx.guild.id, ctx.author.id, guild_id=ctx.guild.id)
         waitlist = set(waitlist_hosting + waitlist_creating)
 
         if len(waitlist) > 1:
@@ -570,6 +764,7 @@ async def leave(self, ctx, game: PolyMatch = None):
 
         models.GameLog.write(game_id=game, guild_id=ctx.guild.id, message=f'{models.GameLog.member_string(ctx.author)} left the game.')
         lineup.delete_instance()
+        self.bot.dispatch('pending_game_change', game.id)
         await ctx.send('Removing you from the game.')
 
     @settings.in_bot_channel()
@@ -598,7 +793,7 @@ async def gamenotes(self, ctx, game: PolyMatch, *, notes: discord.ext.commands.c
         elif not game.is_pending and not settings.is_staff(ctx):
             return await ctx.send(f'Only server staff can edit notes of an in-progress game.')
 
-        game.notes = notes[:150] if notes else None
+        game.set_notes(notes[:150] if notes else None)
         game.save()
 
         models.GameLog.write(game_id=game, guild_id=ctx.guild.id, message=f'{models.GameLog.member_string(ctx.author)} edited game notes: {game.notes}')
@@ -639,6 +834,7 @@ async def kick(self, ctx, game: PolyMatch, player: str):
         await ctx.send(f'Removing **{lineup.player.name}** from the game.')
         models.GameLog.write(game_id=game, guild_id=ctx.guild.id, message=f'{models.GameLog.member_string(ctx.author)} kicked {models.GameLog.member_string(lineup.player.discord_member)}')
         lineup.delete_instance()
+        self.bot.dispatch('pending_game_change', game.id)
 
         if game.expiration < (datetime.datetime.now() + datetime.timedelta(hours=2)):
             # This catches the case of kicking someone from a full game, so that the game wont immediately get purged due to not being full
@@ -661,8 +857,6 @@ async def games(self, ctx, *args):
         `[p]opengames me` - List unstarted opengames that you have joined
         You can also add keywords **ranked** or **unranked** or **steam** to filter by those types of games.
         """
-        models.Game.purge_expired_games()
-
         ranked_filter, ranked_str = 2, ''
         platform_filter = 2  # mobile==1. 0 is desktop and 2 is any
         platform_str = ''
@@ -689,11 +883,11 @@ async def games(self, ctx, *args):
 
         if len(args) > 0 and args[0].upper() == 'WAITING':
             title_str = f'Open{ranked_str} games waiting to start'
-            game_list = models.Game.search_pending(status_filter=1, guild_id=ctx.guild.id, ranked_filter=ranked_filter)
+            search_args = dict(status_filter=1, guild_id=ctx.guild.id, ranked_filter=ranked_filter)
 
         elif len(args) > 0 and args[0].upper() == 'ME':
             title_str = f'Open games joined by **{ctx.author.name}**'
-            game_list = models.Game.search_pending(guild_id=ctx.guild.id, player_discord_id=ctx.author.id)
+            search_args = dict(guild_id=ctx.guild.id, player_discord_id=ctx.author.id)
 
         elif ctx.invoked_with == 'novagames' or ctx.invoked_with == 'nova':
             if len(args) > 0 and args[0].upper() == 'ALL':
@@ -703,8 +897,8 @@ async def games(self, ctx, *args):
                 title_str = f'Current joinable Nova games\nUse `{ctx.prefix}novagames all` to view all Nova Games or `{ctx.prefix}games` for all joinable games.'
                 filter_unjoinable = True
 
+            search_args = dict(status_filter=2, guild_id=ctx.guild.id, ranked_filter=ranked_filter, novas_only=True)
             novas_only = True
-            game_list = models.Game.search_pending(status_filter=2, guild_id=ctx.guild.id, ranked_filter=ranked_filter)
 
         else:
             if len(args) > 0 and args[0].upper() == 'ALL':
@@ -715,51 +909,27 @@ async def games(self, ctx, *args):
                 filter_unjoinable = True
 
             title_str = f'Current{filter_str}{ranked_str}{platform_str} open games with available spots'
-            game_list = models.Game.search_pending(status_filter=2, guild_id=ctx.guild.id, ranked_filter=ranked_filter, platform_filter=platform_filter)
+            search_args = dict(status_filter=2, guild_id=ctx.guild.id, ranked_filter=ranked_filter, platform_filter=platform_filter)
 
         gamelist_fields = [(f'`{"ID":<8}{"Host":<40} {"Type":<7} {"Capacity":<7} {"Exp":>4}` ', '\u200b')]
 
+        def async_load_game_list():
+            games = list(models.Game.search_pending(**search_args, prefetch=False))
+            rosters = models.Game.load_rosters(games)
+            if filter_unjoinable:
+                player, _ = models.Player.get_by_discord_id(discord_id=ctx.author.id, discord_name=ctx.author.name, discord_nick=ctx.author.nick, guild_id=ctx.guild.id)
+                return games, rosters, evaluate_joinability(games, rosters, member=ctx.author, player=player, user_level=user_level)
+            return games, rosters, None
+
+        game_list, rosters, joinability = await utilities.run_in_db_thread(async_load_game_list, guild_id=ctx.guild.id)
+
         for game in game_list:
 
             notes_str = game.notes if game.notes else '\u200b'
-            players, capacity = game.capacity()
-            player_restricted_list = re.findall(r'<@!?(\d+)>', notes_str)
-
-            if filter_unjoinable and not game.has_player(discord_id=ctx.author.id)[0]:
-
-                game_allowed, _ = settings.can_user_join_game(user_level=user_level, game_size=capacity, is_ranked=game.is_ranked, is_host=False)
-                if not game_allowed:
-                    # skipping games that user level restricts (ie joining a large ranked game for ELO Rookie/level 1)
-                    unjoinable_count += 1
-                    continue
-
-                if player_restricted_list and str(ctx.author.id) not in player_restricted_list and (len(player_restricted_list) >= capacity - 1):
-                    # skipping games that the command issuer is not invited to
-                    unjoinable_count += 1
-                    continue
-                open_side, _ = game.first_open_side(roles=[role.id for role in ctx.author.roles])
-                if not open_side:
-                    # skipping games that are role-locked that player doesn't have role for
-                    unjoinable_count += 1
-                    continue
-                player, _ = models.Player.get_by_discord_id(discord_id=ctx.author.id, discord_name=ctx.author.name, discord_nick=ctx.author.nick, guild_id=ctx.guild.id)
-                if player:
-                    # skip any games for which player does not meet ELO requirements, IF player is registered (unless ctx.author is already in game)
-                    (min_elo, max_elo, min_elo_g, max_elo_g) = game.elo_requirements()
-                    if player.elo < min_elo or player.elo > max_elo or player.discord_member.elo < min_elo_g or player.discord_member.elo > max_elo_g:
-                        unjoinable_count += 1
-                        continue
-                    if game.is_mobile:
-                        if not player.discord_member.polytopia_id:
-                            unjoinable_count += 1
-                            continue
-                    else:
-                        if not player.discord_member.name_steam:
-                            unjoinable_count += 1
-                            continue
+            sides, lineups = rosters[game.id]
+            players, capacity = len(lineups), sum(game.size)
 
-            if (novas_only and not game.notes) or (novas_only and game.notes and 'NOVA' not in game.notes.upper()):
-                # skip all non-nova league template games, (will also include anything with "nova" in the game notes)
+            if filter_unjoinable and not joinability[game.id][0]:
                 unjoinable_count += 1
                 continue
 
@@ -768,8 +938,8 @@ async def games(self, ctx, *args):
             expiration = 'Exp' if expiration < 0 else f'{expiration}H'
             ranked_str = '*Unranked*' if not game.is_ranked else ''
             ranked_str = ranked_str + ' - ' if game.notes and ranked_str else ranked_str
-            creating_player = game.creating_player()
-            host_name = creating_player.name[:35] if creating_player else '<Vacant>'
+            creating_lineups = [l for l in lineups if sides and l.gameside_id == sides[0].id]
+            host_name = creating_lineups[0].player.name[:35] if creating_lineups else '<Vacant>'
             gamelist_fields.append((f'`{f"{game.id}":<8}{host_name:<40} {game.size_string():<7} {capacity_str:<7} {expiration:>5}`',
                 f'{game.platform_emoji()} {ranked_str}{notes_str}\n \u200b'))
 
@@ -785,8 +955,7 @@ async def games(self, ctx, *args):
         # paginator done as a task because otherwise it will not let the waitlist message send until after pagination is complete (20+ seconds)
 
         # Alert user if a game they are hosting OR should be creating is waiting to be created
-        waitlist_hosting = [f'{g.id}' for g in models.Game.search_pending(status_filter=1, guild_id=ctx.guild.id, host_discord_id=ctx.author.id)]
-        waitlist_creating = [f'{g.game}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
+        waitlist_hosting, waitlist_creating = await utilities.run_in_db_thread(load_waitlist, ctx.guild.id, ctx.author.id, guild_id=ctx.guild.id)
         waitlist = set(waitlist_hosting + waitlist_creating)
 
         if waitlist:
@@ -889,6 +1058,7 @@ async def start(self, ctx, game: PolyMatch = None, *, name: str = None):
             game.is_pending = False
             game.save()
 
+        self.bot.dispatch('pending_game_change', game.id)
         logger.info(f'Game {game.id} closed and being tracked for ELO')
         models.GameLog.write(game_id=game, guild_id=ctx.guild.id, message=f'{models.GameLog.member_string(ctx.author)} started game with name *{discord.utils.escape_markdown(game.name)}*')
         await post_newgame_messaging(ctx, game=game)
@@ -897,65 +1067,56 @@ async def task_dm_game_creators(self):
         await self.bot.wait_until_ready()
         while not self.bot.is_closed():
             await asyncio.sleep(60 * 60 * 10)
-            logger.debug('Task running: task_dm_game_creators')
-            utilities.connect()
-            full_games = models.Game.search_pending(status_filter=1, ranked_filter=1)
-            logger.debug(f'Starting task_dm_game_creators on {len(full_games)} games')
-            for game in full_games:
-                guild = discord.utils.get(self.bot.guilds, id=game.guild_id)
-                creating_player = game.creating_player()
-                # TOOD: only trigger if game is <23hours til expiration
-                if not guild:
-                    logger.error(f'Couldnt load guild ID {game.guild_id}')
-                    continue
-
-                creating_guild_member = guild.get_member(creating_player.discord_member.discord_id)
-                if not creating_guild_member:
-                    logger.warning(f'Couldnt load creator for game {game.id} in server {guild.name}. Maybe they left the server?')
-                    continue
-
-                bot_channel = settings.guild_setting(guild.id, 'bot_channels_strict')[0]
-                prefix = settings.guild_setting(guild.id, 'command_prefix')
-
-                message = (f'__You have a ranked game on **{guild.name}** that is waiting to be created.__'
-                           f'\nPlease visit the server\'s bot channel at this link: <https://discordapp.com/channels/{guild.id}/{bot_channel}/>'
-                           f'\nType the command __`{prefix}game {game.id}`__ for more details. Remember. you must manually **create the game within Polytopia** using the supplied '
-                           f'friend codes, come back to the channel, and use the command __`{prefix}start {game.id} Name of Game`__ to mark the game as started.'
-                           f'\n\nYou can use the command __`{prefix}codes {game.id}`__ to get each player\'s friend code in an easy-to-copy format.')
-
-                try:
-                    await creating_guild_member.send(message)
-                    await creating_guild_member.send('I do not respond to DMed commands. You must issue commands in the channel linked above.')
-                    logger.info(f'Sending reminder DM to {creating_guild_member.name} {creating_guild_member.id} to start game {game.id}')
-                except discord.DiscordException as e:
-                    logger.warning(f'Error DMing creator of waiting game: {e}')
+            with perf.timed_task('task_dm_game_creators'):
+                logger.debug('Task running: task_dm_game_creators')
+                full_games = models.Game.search_pending(status_filter=1, ranked_filter=1)
+                logger.debug(f'Starting task_dm_game_creators on {len(full_games)} games')
+                for game in full_games:
+                    guild = discord.utils.get(self.bot.guilds, id=game.guild_id)
+                    creating_player = game.creating_player()
+                    # TOOD: only trigger if game is <23hours til expiration
+                    if not guild:
+                        logger.error(f'Couldnt load guild ID {game.guild_id}')
+                        continue
+
+                    creating_guild_member = guild.get_member(creating_player.discord_member.discord_id)
+                    if not creating_guild_member:
+                        logger.warning(f'Couldnt load creator for game {game.id} in server {guild.name}. Maybe they left the server?')
+                        continue
+
+                    bot_channel = settings.guild_setting(guild.id, 'bot_channels_strict')[0]
+                    prefix = settings.guild_setting(guild.id, 'command_prefix')
+
+                    message = (f'__You have a ranked game on **{guild.name}** that is waiting to be created.__'
+                               f'\nPlease visit the server\'s bot channel at this link: <https://discordapp.com/channels/{guild.id}/{bot_channel}/>'
+                               f'\nType the command __`{prefix}game {game.id}`__ for more details. Remember. you must manually **create the game within Polytopia** using the supplied '
+                               f'friend codes, come back to the channel, and use the command __`{prefix}start {game.id} Name of Game`__ to mark the game as started.'
+                               f'\n\nYou can use the command __`{prefix}codes {game.id}`__ to get each player\'s friend code in an easy-to-copy format.')
+
+                    try:
+                        await creating_guild_member.send(message)
+                        await creating_guild_member.send('I do not respond to DMed commands. You must issue commands in the channel linked above.')
+                        logger.info(f'Sending reminder DM to {creating_guild_member.name} {creating_guild_member.id} to start game {game.id}')
+                    except discord.DiscordException as e:
+                        logger.warning(f'Error DMing creator of waiting game: {e}')
 
     async def task_create_empty_matchmaking_lobbies(self):
         # Keep open games list populated with vacant lobbies as specified in settings.lobbies
+        # Wakes when on_pending_game_change sees an indexed lobby change state. lobby_index is rebuilt from the
+        # database every reconcile_interval in case a change happened somewhere that does not dispatch the event.
+
+        reconcile_interval = 60 * 15
+        last_reconcile = None
 
         await self.bot.wait_until_ready()
         while not self.bot.is_closed():
-            await asyncio.sleep(60)
-            logger.debug('Task running: task_create_empty_matchmaking_lobbies')
-            utilities.connect()
-            unhosted_game_list = models.Game.search_pending(status_filter=2, host_discord_id=0)
-            for lobby in settings.lobbies:
-                matching_lobby = False
-                for g in unhosted_game_list:
-                    if (g.guild_id == lobby['guild'] and g.size_string() == lobby['size_str'] and
-                            g.is_ranked == lobby['ranked'] and g.notes == lobby['notes']):
-                        # TODO: could be improved by comparing g.size to lobby['size'] now that Game.size is a field
-
-                        players_in_lobby = g.capacity()[0]
-                        # if remake_partial == True, lobby will be regenerated if anybody is in it.
-                        # if remake_partial == False, lobby will only be regenerated once it is full
-
-                        if lobby['remake_partial'] and players_in_lobby > 0:
-                            pass  # Leave matching_lobby as current value. So it will be remade if no other open games change it
-                        else:
-                            matching_lobby = True  # Lobby meets desired criteria, so nothing new will be created
+            with perf.timed_task('task_create_empty_matchmaking_lobbies'):
+                logger.debug('Task running: task_create_empty_matchmaking_lobbies')
+                if not last_reconcile or last_reconcile < datetime.datetime.now() - datetime.timedelta(seconds=reconcile_interval):
+                    self.reconcile_lobbies()
+                    last_reconcile = datetime.datetime.now()
 
-                if not matching_lobby:
+                for lobby in [lobby for lobby in settings.lobbies if not self.lobby_is_stocked(lobby)]:
                     logger.info(f'creating new lobby {lobby}')
                     guild = discord.utils.get(self.bot.guilds, id=lobby['guild'])
                     if not guild:
@@ -967,7 +1128,8 @@ async def task_create_empty_matchmaking_lobbies(self):
                     with models.db.atomic():
                         opengame = models.Game.create(host=None, notes=lobby['notes'],
                                                       guild_id=lobby['guild'], is_pending=True,
-                                                      is_ranked=lobby['ranked'], expiration=expiration_timestamp, size=lobby['size'])
+                                                      is_ranked=lobby['ranked'], expiration=expiration_timestamp, size=lobby['size'],
+                                                      **models.Game.requirements_from_notes(lobby['notes']))
                         notes_str = f'*{discord.utils.escape_markdown(opengame.notes)}*' if opengame.notes else ''
                         models.GameLog.write(game_id=opengame, guild_id=guild.id, message=f'I created an empty {lobby["size_str"]} lobby. {notes_str}')
                         for count, size in enumerate(lobby['size']):
@@ -983,6 +1145,117 @@ async def task_create_empty_matchmaking_lobbies(self):
                                     role_lock_name = role_lock.name
 
                             models.GameSide.create(game=opengame, size=size, position=count + 1, required_role_id=role_lock_id, sidename=role_lock_name)
+                    self.refresh_lobby(opengame.id)
+
+            self.lobby_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.lobby_wakeup.wait(), timeout=reconcile_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def task_purge_expired_games(self):
+        # Sleeps until the next pending game expires (or an hour at most), then deletes expired games in batches
+        # Woken early by wake_expiry_scheduler when a pending game changes
+
+        max_sleep, batch_size = 60 * 60, 100
+
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            with perf.timed_task('task_purge_expired_games'):
+                logger.debug('Task running: task_purge_expired_games')
+                self.expiry_wakeup.clear()
+                while True:
+                    purged_ids = models.Game.purge_expired_games(batch_size=batch_size)
+                    for game_id in purged_ids:
+                        self.bot.dispatch('pending_game_change', game_id)
+                    if len(purged_ids) < batch_size:
+                        break
+                    await asyncio.sleep(1)  # let other tasks run between batches
+
+                next_expiration = models.Game.next_expiration()
+                if next_expiration:
+                    sleep_seconds = min(max(1, (next_expiration - datetime.datetime.now()).total_seconds() + 1), max_sleep)
+                else:
+                    sleep_seconds = max_sleep
+            try:
+                await asyncio.wait_for(self.expiry_wakeup.wait(), timeout=sleep_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def create_queue_game(self, group):
+        # Opens a full pending game for a group of QueueEntry matched by task_match_queue. Returns the Game, or None if it could not be created.
+        first = group[0]
+        guild = discord.utils.get(self.bot.guilds, id=first.guild_id)
+        if not guild:
+            logger.warning(f'Bot not a member of guild {first.guild_id}')
+            return None
+
+        sizes = matchqueue.queue_formats[first.format]
+        members = {}
+        for entry in group:
+            member = guild.get_member(entry.discord_id)
+            if not member:
+                logger.warning(f'Queued member {entry.discord_id} not found in guild {guild.id}')
+                return None
+            player, _ = models.Player.get_by_discord_id(discord_id=member.id, discord_name=member.name, discord_nick=member.nick, guild_id=guild.id)
+            if not player:
+                return None
+            members[entry.discord_id] = member
+
+        if len(sizes) == 2:
+            side1, side2, _ = models.Game.balanced_splits([e.elo for e in group], team_size=sizes[0], top_k=1)[0]
+            sides = [[group[i] for i in side1], [group[i] for i in side2]]
+        else:
+            sides = matchqueue.snake_draft(group, sizes)
+        expiration_timestamp = (datetime.datetime.now() + datetime.timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            game = models.Game.create_game([[members[entry.discord_id] for entry in side_entries] for side_entries in sides], guild_id=guild.id,
+                                           require_teams=settings.guild_setting(guild.id, 'require_teams'), is_ranked=first.is_ranked,
+                                           is_pending=True, expiration=expiration_timestamp, is_mobile=first.is_mobile)
+        except (peewee.PeeweeException, exceptions.CheckFailedError) as e:
+            logger.warning(f'Error creating queue game: {e}')
+            return None
+
+        elo_list = ', '.join(str(e.elo) for e in group)
+        models.GameLog.write(game_id=game, guild_id=guild.id, message=f'I opened the game from the matchmaking queue for players with ELO {elo_list}.')
+        self.bot.dispatch('pending_game_change', game.id)
+        return game
+
+    async def task_match_queue(self):
+        # Matches queued players into games, and drops players who have waited longer than max_wait
+        max_wait = datetime.timedelta(hours=2)
+
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            await asyncio.sleep(15)
+            if not len(self.match_queue):
+                continue
+            with perf.timed_task('task_match_queue'):
+                logger.debug('Task running: task_match_queue')
+
+                for entry in self.match_queue.expire(max_wait=max_wait):
+                    channel = self.bot.get_channel(entry.channel_id)
+                    if channel:
+                        await channel.send(f'<@{entry.discord_id}>, no {entry.format.upper()} game was found for you in the matchmaking queue. You have been removed from the queue.')
+
+                for group in self.match_queue.match():
+                    game = await self.create_queue_game(group)
+                    channel = self.bot.get_channel(group[0].channel_id)
+                    if not game:
+                        logger.warning(f'Could not open game for matched queue group {[e.discord_id for e in group]}')
+                        if channel:
+                            await channel.send(f'{" ".join(f"<@{e.discord_id}>" for e in group)}: a game was matched for you but could not be opened. Please queue again.')
+                        continue
+
+                    logger.info(f'Opened game {game.id} for matched queue group {[e.discord_id for e in group]}')
+                    if not channel:
+                        continue
+                    prefix = settings.guild_setting(game.guild_id, 'command_prefix')
+                    creating_player = game.creating_player()
+                    embed, content = game.embed(guild=channel.guild, prefix=prefix)
+                    await channel.send(f'{" ".join(f"<@{e.discord_id}>" for e in group)}: the matchmaking queue found you a game! '
+                        f'Game {game.id} is full and <@{creating_player.discord_member.discord_id}> should create the game in Polytopia, then use `{prefix}start {game.id} Name of Game`.')
+                    await channel.send(embed=embed, content=content)
 
     async def task_print_matchlist(self):
         await self.bot.wait_until_ready()
@@ -990,67 +1263,117 @@ async def task_print_matchlist(self):
 
         while not self.bot.is_closed():
             await asyncio.sleep(5)
-            logger.debug('Task running: task_print_matchlist')
-            utilities.connect()
-            models.Game.purge_expired_games()
-            for guild in self.bot.guilds:
-                broadcast_channels = [guild.get_channel(chan) for chan in settings.guild_setting(guild.id, 'match_challenge_channels')]
-                if not broadcast_channels:
-                    continue
-
-                ranked_chan = settings.guild_setting(guild.id, 'ranked_game_channel')
-                unranked_chan = settings.guild_setting(guild.id, 'unranked_game_channel')
-
-                for chan in broadcast_channels:
-                    if not chan:
-                        continue
-                    if chan.id == ranked_chan:
-                        game_list = models.Game.search_pending(status_filter=2, ranked_filter=1, guild_id=chan.guild.id)[:12]
-                        list_title = 'Current ranked open games'
-                    elif chan.id == unranked_chan:
-                        game_list = models.Game.search_pending(status_filter=2, ranked_filter=0, guild_id=chan.guild.id)[:12]
-                        list_title = 'Current unranked open games'
-                    else:
-                        game_list = models.Game.search_pending(status_filter=2, ranked_filter=2, guild_id=chan.guild.id)[:12]
-                        list_title = 'Current open games'
-                    if not game_list:
+            with perf.timed_task('task_print_matchlist'):
+                logger.debug('Task running: task_print_matchlist')
+                for guild in self.bot.guilds:
+                    broadcast_channels = [guild.get_channel(chan) for chan in settings.guild_setting(guild.id, 'match_challenge_channels')]
+                    if not broadcast_channels:
                         continue
 
-                    pfx = settings.guild_setting(guild.id, 'command_prefix')
+                    ranked_chan = settings.guild_setting(guild.id, 'ranked_game_channel')
+                    unranked_chan = settings.guild_setting(guild.id, 'unranked_game_channel')
 
-                    embed = discord.Embed(title=f'{list_title}\n'
-                        f'Use __`{pfx}join ID`__ to join one or __`{pfx}game ID`__ for more details.')
-                    embed.add_field(name=f'`{"ID":<8}{"Host":<40} {"Type":<7} {"Capacity":<7} {"Exp":>4} `', value='\u200b', inline=False)
-                    for game in game_list:
+                    for chan in broadcast_channels:
+                        if not chan:
+                            continue
+                        if chan.id == ranked_chan:
+                            game_list = models.Game.search_pending(status_filter=2, ranked_filter=1, guild_id=chan.guild.id)[:12]
+                            list_title = 'Current ranked open games'
+                        elif chan.id == unranked_chan:
+                            game_list = models.Game.search_pending(status_filter=2, ranked_filter=0, guild_id=chan.guild.id)[:12]
+                            list_title = 'Current unranked open games'
+                        else:
+                            game_list = models.Game.search_pending(status_filter=2, ranked_filter=2, guild_id=chan.guild.id)[:12]
+                            list_title = 'Current open games'
+                        if not game_list:
+                            continue
 
-                        notes_str = game.notes if game.notes else '\u200b'
-                        players, capacity = game.capacity()
-                        player_restricted_list = re.findall(r'<@!?(\d+)>', notes_str)
+                        pfx = settings.guild_setting(guild.id, 'command_prefix')
 
-                        if player_restricted_list and (len(player_restricted_list) >= capacity - 1) and len(game_list) > 15:
-                            # skipping invite-only games IF the games list is large
-                            continue
+                        embed = discord.Embed(title=f'{list_title}\n'
+                            f'Use __`{pfx}join ID`__ to join one or __`{pfx}game ID`__ for more details.')
+                        embed.add_field(name=f'`{"ID":<8}{"Host":<40} {"Type":<7} {"Capacity":<7} {"Exp":>4} `', value='\u200b', inline=False)
+                        for game in game_list:
 
-                        capacity_str = f' {players}/{capacity}'
-                        expiration = int((game.expiration - datetime.datetime.now()).total_seconds() / 3600.0)
-                        expiration = 'Exp' if expiration < 0 else f'{expiration}H'
-                        creating_player = game.creating_player()
-                        host_name = creating_player.name[:35] if creating_player else '<Vacant>'
-                        ranked_str = '*Unranked*' if not game.is_ranked else ''
-                        ranked_str = ranked_str + ' - ' if game.notes and ranked_str else ranked_str
+                            notes_str = game.notes if game.notes else '\u200b'
+                            players, capacity = game.capacity()
+                            player_restricted_list = re.findall(r'<@!?(\d+)>', notes_str)
 
-                        embed.add_field(name=f'`{game.id:<8}{host_name:<40} {game.size_string():<7} {capacity_str:<7} {expiration:>5}`', value=f'{ranked_str}{notes_str}\n \u200b', inline=False)
+                            if player_restricted_list and (len(player_restricted_list) >= capacity - 1) and len(game_list) > 15:
+                                # skipping invite-only games IF the games list is large
+                                continue
 
-                    try:
-                        message = await chan.send(embed=embed, delete_after=sleep_cycle)
-                    except discord.DiscordException as e:
-                        logger.warning(f'Error broadcasting game list: {e}')
-                    else:
-                        logger.info(f'Broadcast game list to channel {chan.id} in message {message.id}')
-                        self.bot.purgable_messages = self.bot.purgable_messages[-20:] + [(guild.id, chan.id, message.id)]
+                            capacity_str = f' {players}/{capacity}'
+                            expiration = int((game.expiration - datetime.datetime.now()).total_seconds() / 3600.0)
+                            expiration = 'Exp' if expiration < 0 else f'{expiration}H'
+                            creating_player = game.creating_player()
+                            host_name = creating_player.name[:35] if creating_player else '<Vacant>'
+                            ranked_str = '*Unranked*' if not game.is_ranked else ''
+                            ranked_str = ranked_str + ' - ' if game.notes and ranked_str else ranked_str
+
+                            embed.add_field(name=f'`{game.id:<8}{host_name:<40} {game.size_string():<7} {capacity_str:<7} {expiration:>5}`', value=f'{ranked_str}{notes_str}\n \u200b', inline=False)
+
+                        try:
+                            message = await chan.send(embed=embed, delete_after=sleep_cycle)
+                        except discord.DiscordException as e:
+                            logger.warning(f'Error broadcasting game list: {e}')
+                        else:
+                            logger.info(f'Broadcast game list to channel {chan.id} in message {message.id}')
+                            self.bot.purgable_messages = self.bot.purgable_messages[-20:] + [(guild.id, chan.id, message.id)]
 
             await asyncio.sleep(sleep_cycle)
 
 
+def evaluate_joinability(game_list, rosters, member, player, user_level: int):
+    # Decide whether discord member can join each pending game, using rosters from Game.load_rosters() and no further queries
+    # player is member's Player in this guild (with discord_member loaded) or None if unregistered
+    # Returns {game_id: (bool joinable, str reason)}
+
+    results = {}
+    role_ids = set(role.id for role in member.roles)
+
+    for game in game_list:
+        sides, lineups = rosters[game.id]
+        capacity = sum(game.size)
+
+        if any(l.player.discord_member.discord_id == member.id for l in lineups):
+            results[game.id] = (True, 'You are already in this game.')
+            continue
+
+        game_allowed, _ = settings.can_user_join_game(user_level=user_level, game_size=capacity, is_ranked=game.is_ranked, is_host=False)
+        if not game_allowed:
+            # user level restricts, ie joining a large ranked game for ELO Rookie/level 1
+            results[game.id] = (False, 'Your user level does not allow joining this game.')
+            continue
+
+        player_restricted_list = game.invited_ids if game.invited_ids else []
+        if player_restricted_list and member.id not in player_restricted_list and (len(player_restricted_list) >= capacity - 1):
+            results[game.id] = (False, 'This game is invite-only.')
+            continue
+
+        # same rules as Game.first_open_side() - a side locked to one of member's roles, else any side without a role lock
+        open_sides = [s for s in sides if s.filled < s.size and (s.required_role_id in role_ids or s.required_role_id is None)]
+        if not open_sides:
+            results[game.id] = (False, 'No open side is available to you.')
+            continue
+
+        if player:
+            # ELO and platform requirements only apply if member is registered
+            (min_elo, max_elo, min_elo_g, max_elo_g) = game.elo_requirements()
+            if player.elo < min_elo or player.elo > max_elo or player.discord_member.elo < min_elo_g or player.discord_member.elo > max_elo_g:
+                results[game.id] = (False, 'You do not meet the ELO requirements of this game.')
+                continue
+            if game.is_mobile and not player.discord_member.polytopia_id:
+                results[game.id] = (False, 'You have no Polytopia code registered.')
+                continue
+            if not game.is_mobile and not player.discord_member.name_steam:
+                results[game.id] = (False, 'You have no Steam name registered.')
+                continue
+
+        results[game.id] = (True, None)
+
+    return results
+
+
 def setup(bot):
     bot.add_cog(matchmaking(bot))
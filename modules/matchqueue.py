@@ -0,0 +1,169 @@
+import bisect
+import datetime
+import itertools
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# formats accepted by $queue and the GameSide sizes each one creates
+queue_formats = {'1v1': [1, 1], '2v2': [2, 2], '3v3': [3, 3], 'ffa': [1, 1, 1]}
+
+
+class QueueEntry:
+    # One player waiting in the matchmaking queue. seq orders entries that have identical ELO, and doubles as join order.
+
+    __slots__ = ('discord_id', 'guild_id', 'elo', 'format', 'is_ranked', 'is_mobile', 'channel_id', 'joined', 'seq')
+
+    def __init__(self, discord_id: int, guild_id: int, elo: int, format: str, is_ranked: bool = True, is_mobile: bool = True, channel_id: int = None, joined=None):
+        self.discord_id = discord_id
+        self.guild_id = guild_id
+        self.elo = elo
+        self.format = format
+        self.is_ranked = is_ranked
+        self.is_mobile = is_mobile
+        self.channel_id = channel_id
+        self.joined = joined if joined else datetime.datetime.now()
+        self.seq = None
+
+    def pool_key(self):
+        return (self.guild_id, self.format, self.is_ranked, self.is_mobile)
+
+    def sort_key(self):
+        return (self.elo, self.seq)
+
+    def elo_band(self, now):
+        # acceptable ELO spread for a game with this entry, widening the longer it has waited
+        minutes_waiting = (now - self.joined).total_seconds() / 60
+        return min(MatchQueue.band_base + MatchQueue.band_growth * minutes_waiting, MatchQueue.band_max)
+
+
+class MatchQueue:
+    # Players queued for automatic matchmaking. Each (guild, format, ranked, platform) pool is a list kept sorted by ELO,
+    # so the closest-ELO group around any entry is found with a bisect and a scan of at most format-size neighbours.
+
+    band_base = 50  # ELO spread accepted immediately
+    band_growth = 20  # extra ELO spread accepted per minute waited
+    band_max = 400
+
+    def __init__(self):
+        self.pools = {}  # pool_key -> [(elo, seq, QueueEntry)] sorted by (elo, seq)
+        self.entries = {}  # (guild_id, discord_id) -> QueueEntry
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, guild_id: int, discord_id: int):
+        return self.entries.get((guild_id, discord_id), None)
+
+    def add(self, entry: QueueEntry):
+        # A player can only be queued once per guild - returns False if they already are
+        if (entry.guild_id, entry.discord_id) in self.entries:
+            return False
+        entry.seq = next(self.counter)
+        bisect.insort(self.pools.setdefault(entry.pool_key(), []), (entry.elo, entry.seq, entry))
+        self.entries[(entry.guild_id, entry.discord_id)] = entry
+        return True
+
+    def remove(self, guild_id: int, discord_id: int):
+        # Returns the removed QueueEntry, or None if the player was not queued
+        entry = self.entries.pop((guild_id, discord_id), None)
+        if not entry:
+            return None
+        pool = self.pools[entry.pool_key()]
+        del pool[bisect.bisect_left(pool, entry.sort_key())]
+        return entry
+
+    def position(self, entry: QueueEntry):
+        # (entries that joined this pool earlier, total entries in the pool)
+        pool = self.pools.get(entry.pool_key(), [])
+        return sum(1 for _, seq, _ in pool if seq < entry.seq), len(pool)
+
+    def expire(self, max_wait: datetime.timedelta, now=None):
+        # Removes and returns entries that have waited longer than max_wait
+        now = now if now else datetime.datetime.now()
+        expired = [e for e in self.entries.values() if now - e.joined > max_wait]
+        for entry in expired:
+            self.remove(entry.guild_id, entry.discord_id)
+        return expired
+
+    def match(self, now=None):
+        # Removes and returns a list of matched groups, each a list of QueueEntry of the size its format needs.
+        # Entries are considered oldest first. Each one is grouped with the neighbours in ELO order that give the smallest
+        # spread, and the group is accepted if that spread fits within the anchoring entry's current ELO band.
+        now = now if now else datetime.datetime.now()
+        groups = []
+
+        for key, pool in self.pools.items():
+            group_size = sum(queue_formats[key[1]])
+            if len(pool) < group_size:
+                continue
+
+            for anchor in sorted([e for _, _, e in pool], key=lambda e: e.seq):
+                if len(pool) < group_size:
+                    break
+                if (anchor.guild_id, anchor.discord_id) not in self.entries:
+                    continue  # already matched into an earlier group this pass
+
+                i = bisect.bisect_left(pool, anchor.sort_key())
+                best_start, best_spread = None, None
+                for start in range(max(0, i - group_size + 1), min(i, len(pool) - group_size) + 1):
+                    spread = pool[start + group_size - 1][0] - pool[start][0]
+                    if best_spread is None or spread < best_spread:
+                        best_start, best_spread = start, spread
+
+                if best_start is None or best_spread > anchor.elo_band(now):
+                    continue
+
+                group = [e for _, _, e in pool[best_start:best_start + group_size]]
+                del pool[best_start:best_start + group_size]
+                for entry in group:
+                    del self.entries[(entry.guild_id, entry.discord_id)]
+                groups.append(group)
+
+        return groups
+
+
+def snake_draft(entries, sizes):
+    # Splits entries into sides of the given sizes, picking from highest ELO down in snake order (A B B A A B...)
+    # Returns a list of sides, each a list of entries
+    sides = [[] for _ in sizes]
+    remaining = sorted(entries, key=lambda e: e.elo, reverse=True)
+    pick_order = list(range(len(sizes)))
+    while remaining:
+        for side in pick_order:
+            if remaining and len(sides[side]) < sizes[side]:
+                sides[side].append(remaining.pop(0))
+        pick_order.reverse()
+    return sides
+
+
+if __name__ == '__main__':
+    # Benchmark: python -m modules.matchqueue
+    import random
+    import time
+
+    random.seed(1)
+    queue = MatchQueue()
+    start_time = datetime.datetime.now()
+    player_count = 5000
+
+    t = time.perf_counter()
+    for discord_id in range(player_count):
+        queue.add(QueueEntry(discord_id=discord_id, guild_id=1, elo=int(random.gauss(1000, 150)),
+                             format=random.choice(list(queue_formats)), is_ranked=random.random() < 0.8,
+                             joined=start_time - datetime.timedelta(seconds=random.randint(0, 600))))
+    print(f'add: {player_count} entries in {(time.perf_counter() - t) * 1000:.1f}ms')
+
+    t = time.perf_counter()
+    matched = queue.match(now=start_time)
+    print(f'match: {len(matched)} groups, {sum(len(g) for g in matched)} players in {(time.perf_counter() - t) * 1000:.1f}ms, {len(queue)} still queued')
+
+    t = time.perf_counter()
+    matched = queue.match(now=start_time + datetime.timedelta(minutes=30))
+    print(f'match after 30 minutes: {len(matched)} groups in {(time.perf_counter() - t) * 1000:.1f}ms, {len(queue)} still queued')
+
+    t = time.perf_counter()
+    for discord_id in range(player_count):
+        queue.remove(1, discord_id)
+    print(f'remove: {player_count} lookups in {(time.perf_counter() - t) * 1000:.1f}ms')
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from aiohttp import web
+from modules import perf
+from modules import dbexecutor
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# Serves the numbers collected in modules/perf.py as Prometheus text format on http://127.0.0.1:<metrics_port>/metrics
+# Only started if metrics_port is set in config.ini. It binds to localhost only - scrape it from the same machine or through a tunnel:
+# curl http://127.0.0.1:9100/metrics
+
+discord_requests = {}  # (method, route path) -> count of Discord API requests
+discord_errors = {}  # HTTP status -> count of Discord API requests that raised
+discord_rate_limits = {'bucket': 0, 'global': 0}
+
+
+class RateLimitCounter(logging.Filter):
+    # discord.py handles 429s itself and only logs them, so rate limit hits are counted from its log records
+
+    def filter(self, record):
+        message = str(record.msg)
+        if 'Retrying in' in message:
+            discord_rate_limits['global' if message.startswith('Global') else 'bucket'] += 1
+        return True
+
+
+def instrument_discord_http(bot):
+    # Counts every Discord API request by route, ie. ('POST', '/channels/{channel_id}/messages')
+    request = bot.http.request
+
+    async def counted_request(route, **kwargs):
+        key = (route.method, route.path)
+        discord_requests[key] = discord_requests.get(key, 0) + 1
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = getattr(e, 'status', 'none')
+            discord_errors[status] = discord_errors.get(status, 0) + 1
+            raise
+
+    bot.http.request = counted_request
+    logging.getLogger('discord.http').addFilter(RateLimitCounter())
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsWriter:
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name: str, metric_type: str, help_str: str):
+        self.lines.append(f'# HELP {name} {help_str}')
+        self.lines.append(f'# TYPE {name} {metric_type}')
+
+    def sample(self, name: str, value, **labels):
+        label_str = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+        value_str = str(value) if isinstance(value, int) else repr(float(value))  # not :g, which rounds large counters to 6 digits
+        self.lines.append(f'{name}{{{label_str}}} {value_str}' if label_str else f'{name} {value_str}')
+
+    def metric(self, name: str, metric_type: str, help_str: str, samples):
+        # samples is [(value, {labels})]
+        self.header(name, metric_type, help_str)
+        for value, labels in samples:
+            self.sample(name, value, **labels)
+
+    def histogram(self, name: str, help_str: str, histograms):
+        # histograms is [(perf.Histogram in ms, {labels})], written out in seconds with cumulative buckets as Prometheus expects
+        self.header(name, 'histogram', help_str)
+        for histogram, labels in histograms:
+            cumulative = 0
+            for bound, count in zip(perf.histogram_bounds_ms, histogram.counts):
+                cumulative += count
+                self.sample(f'{name}_bucket', cumulative, le='+Inf' if bound == float('inf') else f'{bound / 1000:g}', **labels)
+            self.sample(f'{name}_sum', histogram.total / 1000, **labels)
+            self.sample(f'{name}_count', cumulative, **labels)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render(bot=None):
+    out = MetricsWriter()
+    commands = sorted(perf.summaries.items())
+
+    out.histogram('polybot_command_duration_seconds', 'Wall time of bot commands.',
+                  [(summary.wall, {'command': name}) for name, summary in commands])
+    out.histogram('polybot_command_db_seconds', 'Database time of bot commands.',
+                  [(summary.db, {'command': name}) for name, summary in commands])
+    out.metric('polybot_command_errors_total', 'counter', 'Bot commands that raised.',
+               [(summary.errors, {'command': name}) for name, summary in commands])
+    out.metric('polybot_command_queries_total', 'counter', 'Database queries run by bot commands.',
+               [(summary.queries, {'command': name}) for name, summary in commands])
+    out.metric('polybot_command_executor_wait_seconds_total', 'counter', 'Time bot commands spent queued for a DB executor worker.',
+               [(summary.executor_wait, {'command': name}) for name, summary in commands])
+
+    with perf.totals_lock:
+        db_totals = dict(perf.db_totals)
+        cache_lookups = {name: list(counts) for name, counts in perf.cache_lookups.items()}
+    out.metric('polybot_db_queries_total', 'counter', 'Database queries, including those from background tasks.', [(db_totals['queries'], {})])
+    out.metric('polybot_db_query_seconds_total', 'counter', 'Time spent executing database queries.', [(db_totals['seconds'], {})])
+    out.metric('polybot_db_rows_total', 'counter', 'Rows returned or affected by database queries.', [(db_totals['rows'], {})])
+
+    executor_stats = dbexecutor.db_executor.stats()
+    out.metric('polybot_db_executor_workers', 'gauge', 'DB executor worker threads.', [(executor_stats['workers'], {})])
+    out.metric('polybot_db_executor_running', 'gauge', 'DB executor workers currently busy.', [(executor_stats['running'], {})])
+    out.metric('polybot_db_executor_queued', 'gauge', 'Database calls waiting for a DB executor worker.', [(executor_stats['queued'], {})])
+    out.metric('polybot_db_executor_queued_peak', 'gauge', 'Most database calls ever waiting at once.', [(executor_stats['peak_queued'], {})])
+    out.metric('polybot_db_executor_submitted_total', 'counter', 'Database calls submitted to the DB executor.', [(executor_stats['submitted'], {})])
+    out.metric('polybot_db_executor_rejected_total', 'counter', 'Database calls refused because their server had too many queued.', [(executor_stats['rejected'], {})])
+
+    out.histogram('polybot_event_loop_lag_seconds', 'How late the event loop was to wake a sleeping coroutine.', [(perf.loop_lag, {})])
+    out.metric('polybot_event_loop_lag_max_seconds', 'gauge', 'Worst event loop lag seen.', [(perf.loop_lag_max, {})])
+
+    tasks = sorted(perf.task_summaries.items())
+    out.metric('polybot_task_runs_total', 'counter', 'Completed passes of each background task.', [(summary.runs, {'task': name}) for name, summary in tasks])
+    out.metric('polybot_task_errors_total', 'counter', 'Background task passes that raised.', [(summary.errors, {'task': name}) for name, summary in tasks])
+    out.metric('polybot_task_duration_seconds_total', 'counter', 'Time spent in background task passes.', [(summary.total_time, {'task': name}) for name, summary in tasks])
+    out.metric('polybot_task_last_duration_seconds', 'gauge', 'Duration of the most recent pass of each background task.',
+               [(summary.last_duration, {'task': name}) for name, summary in tasks])
+    out.metric('polybot_task_last_finished_timestamp_seconds', 'gauge', 'Unix time the most recent pass of each background task finished.',
+               [(summary.last_finished, {'task': name}) for name, summary in tasks])
+
+    out.metric('polybot_discord_requests_total', 'counter', 'Discord API requests.',
+               [(count, {'method': method, 'route': path}) for (method, path), count in sorted(discord_requests.items())])
+    out.metric('polybot_discord_errors_total', 'counter', 'Discord API requests that raised, by HTTP status.',
+               [(count, {'status': status}) for status, count in sorted(discord_errors.items(), key=str)])
+    out.metric('polybot_discord_rate_limits_total', 'counter', 'Discord API rate limits hit.',
+               [(count, {'scope': scope}) for scope, count in discord_rate_limits.items()])
+
+    out.metric('polybot_cache_lookups_total', 'counter', 'Cache lookups by result.',
+               [(counts[i], {'cache': name, 'result': result}) for name, counts in sorted(cache_lookups.items()) for i, result in enumerate(('hit', 'miss'))])
+
+    if bot:
+        out.metric('polybot_guilds', 'gauge', 'Servers the bot is in.', [(len(bot.guilds), {})])
+        if bot.latency == bot.latency:  # NaN until the first heartbeat
+            out.metric('polybot_gateway_latency_seconds', 'gauge', 'Discord gateway heartbeat latency.', [(bot.latency, {})])
+    return out.text()
+
+
+async def start_server(bot, port: int):
+    async def metrics_handler(request):
+        return web.Response(text=render(bot), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    logger.info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+    return runner
+
+
+if __name__ == '__main__':
+    # Serve the endpoint without connecting to Discord, to check the output:
+    # python -m modules.metrics 9100 & curl http://127.0.0.1:9100/metrics
+    import sys
+
+    loop = asyncio.get_event_loop()
+    with perf.timed_task('example_task'):
+        perf.record_cache_lookup('example_cache', hit=True)
+    loop.run_until_complete(start_server(None, int(sys.argv[1]) if len(sys.argv) > 1 else 9100))
+    loop.run_forever()
@@ -6,6 +6,7 @@
 import logging
 import asyncio
 import modules.exceptions as exceptions
+from modules import perf
 import re
 import datetime
 import random
@@ -399,42 +400,42 @@ async def task_send_polychamps_invite(self):
         while not self.bot.is_closed():
             sleep_cycle = (60 * 60 * 6)
             await asyncio.sleep(30)
-            logger.info('Running task task_send_polychamps_invite')
-            guild = discord.utils.get(self.bot.guilds, id=settings.server_ids['main'])
-            if not guild:
-                logger.warning('Could not load guild via server_id')
-                break
-            utilities.connect()
-            dms = models.DiscordMember.members_not_on_polychamps()
-            logger.info(f'{len(dms)} discordmember results')
-            for dm in dms:
-                wins_count, losses_count = dm.wins().count(), dm.losses().count()
-                if wins_count < 5:
-                    logger.debug(f'Skipping {dm.name} - insufficient winning games')
-                    continue
-                if dm.games_played(in_days=15).count() < 1:
-                    logger.debug(f'Skipping {dm.name} - insufficient recent games')
-                    continue
-                if dm.elo_max > 1150:
-                    logger.debug(f'{dm.name} qualifies due to higher ELO > 1150')
-                elif wins_count > losses_count:
-                    logger.debug(f'{dm.name} qualifies due to positive win ratio')
-                else:
-                    logger.debug(f'Skipping {dm.name} - ELO or W/L record insufficient')
-                    continue
-
-                logger.debug(f'Sending invite to {dm.name}')
-                guild_member = guild.get_member(dm.discord_id)
-                if not guild_member:
-                    logger.debug(f'Could not load {dm.name} from guild {guild.id}')
-                    continue
-                try:
-                    await guild_member.send(message)
-                except discord.DiscordException as e:
-                    logger.warning(f'Error DMing member: {e}')
-                else:
-                    dm.date_polychamps_invite_sent = datetime.datetime.today()
-                    dm.save()
+            with perf.timed_task('task_send_polychamps_invite'):
+                logger.info('Running task task_send_polychamps_invite')
+                guild = discord.utils.get(self.bot.guilds, id=settings.server_ids['main'])
+                if not guild:
+                    logger.warning('Could not load guild via server_id')
+                    break
+                dms = models.DiscordMember.members_not_on_polychamps()
+                logger.info(f'{len(dms)} discordmember results')
+                for dm in dms:
+                    wins_count, losses_count = dm.get_record()
+                    if wins_count < 5:
+                        logger.debug(f'Skipping {dm.name} - insufficient winning games')
+                        continue
+                    if dm.games_played(in_days=15).count() < 1:
+                        logger.debug(f'Skipping {dm.name} - insufficient recent games')
+                        continue
+                    if dm.elo_max > 1150:
+                        logger.debug(f'{dm.name} qualifies due to higher ELO > 1150')
+                    elif wins_count > losses_count:
+                        logger.debug(f'{dm.name} qualifies due to positive win ratio')
+                    else:
+                        logger.debug(f'Skipping {dm.name} - ELO or W/L record insufficient')
+                        continue
+
+                    logger.debug(f'Sending invite to {dm.name}')
+                    guild_member = guild.get_member(dm.discord_id)
+                    if not guild_member:
+                        logger.debug(f'Could not load {dm.name} from guild {guild.id}')
+                        continue
+                    try:
+                        await guild_member.send(message)
+                    except discord.DiscordException as e:
+                        logger.warning(f'Error DMing member: {e}')
+                    else:
+                        dm.date_polychamps_invite_sent = datetime.datetime.today()
+                        dm.save()
             await asyncio.sleep(sleep_cycle)
 
     async def task_broadcast_newbie_message(self):
@@ -443,25 +444,26 @@ async def task_broadcast_newbie_message(self):
             sleep_cycle = (60 * 60 * 3)
             await asyncio.sleep(10)
 
-            for guild in self.bot.guilds:
-                broadcast_channels = [guild.get_channel(chan) for chan in settings.guild_setting(guild.id, 'newbie_message_channels')]
-                if not broadcast_channels:
-                    continue
+            with perf.timed_task('task_broadcast_newbie_message'):
+                for guild in self.bot.guilds:
+                    broadcast_channels = [guild.get_channel(chan) for chan in settings.guild_setting(guild.id, 'newbie_message_channels')]
+                    if not broadcast_channels:
+                        continue
 
-                prefix = settings.guild_setting(guild.id, 'command_prefix')
-                # ranked_chan = settings.guild_setting(guild.id, 'ranked_game_channel')
-                # unranked_chan = settings.guild_setting(guild.id, 'unranked_game_channel')
-                bot_spam_chan = settings.guild_setting(guild.id, 'bot_channels_strict')[0]
-                elo_guide_channel = 533391050014720040
+                    prefix = settings.guild_setting(guild.id, 'command_prefix')
+                    # ranked_chan = settings.guild_setting(guild.id, 'ranked_game_channel')
+                    # unranked_chan = settings.guild_setting(guild.id, 'unranked_game_channel')
+                    bot_spam_chan = settings.guild_setting(guild.id, 'bot_channels_strict')[0]
+                    elo_guide_channel = 533391050014720040
 
-                broadcast_message = (f'To register for ELO leaderboards and matchmaking use the command __`{prefix}setcode YOURCODEHERE`__')
-                broadcast_message += f'\nTo get started with joining an open game, go to <#{bot_spam_chan}> and type __`{prefix}games`__'
-                broadcast_message += f'\nFor full information go read <#{elo_guide_channel}>.'
+                    broadcast_message = (f'To register for ELO leaderboards and matchmaking use the command __`{prefix}setcode YOURCODEHERE`__')
+                    broadcast_message += f'\nTo get started with joining an open game, go to <#{bot_spam_chan}> and type __`{prefix}games`__'
+                    broadcast_message += f'\nFor full information go read <#{elo_guide_channel}>.'
 
-                for broadcast_channel in broadcast_channels:
-                    if broadcast_channel:
-                        message = await broadcast_channel.send(broadcast_message, delete_after=(sleep_cycle - 5))
-                        self.bot.purgable_messages = self.bot.purgable_messages[-20:] + [(guild.id, broadcast_channel.id, message.id)]
+                    for broadcast_channel in broadcast_channels:
+                        if broadcast_channel:
+                            message = await broadcast_channel.send(broadcast_message, delete_after=(sleep_cycle - 5))
+                            self.bot.purgable_messages = self.bot.purgable_messages[-20:] + [(guild.id, broadcast_channel.id, message.id)]
 
             await asyncio.sleep(sleep_cycle)
 
@@ -471,20 +473,21 @@ async def task_broadcast_newbie_steam_message(self):
             sleep_cycle = (60 * 60 * 6)
             await asyncio.sleep(10)
 
-            for guild in self.bot.guilds:
-                broadcast_channel = guild.get_channel(settings.guild_setting(guild.id, 'steam_game_channel'))
-                if not broadcast_channel:
-                    continue
+            with perf.timed_task('task_broadcast_newbie_steam_message'):
+                for guild in self.bot.guilds:
+                    broadcast_channel = guild.get_channel(settings.guild_setting(guild.id, 'steam_game_channel'))
+                    if not broadcast_channel:
+                        continue
 
-                prefix = settings.guild_setting(guild.id, 'command_prefix')
-                elo_guide_channel = 533391050014720040
+                    prefix = settings.guild_setting(guild.id, 'command_prefix')
+                    elo_guide_channel = 533391050014720040
 
-                broadcast_message = (f'To register for ELO leaderboards and matchmaking use the command __`{prefix}steamname Your Steam Name`__')
-                broadcast_message += f'\nTo get started with joining an open game, type __`{prefix}games`__ or open your own with __`{prefix}opensteam`__'
-                broadcast_message += f'\nFor full information go read <#{elo_guide_channel}>.'
+                    broadcast_message = (f'To register for ELO leaderboards and matchmaking use the command __`{prefix}steamname Your Steam Name`__')
+                    broadcast_message += f'\nTo get started with joining an open game, type __`{prefix}games`__ or open your own with __`{prefix}opensteam`__'
+                    broadcast_message += f'\nFor full information go read <#{elo_guide_channel}>.'
 
-                message = await broadcast_channel.send(broadcast_message, delete_after=(sleep_cycle - 5))
-                self.bot.purgable_messages = self.bot.purgable_messages[-20:] + [(guild.id, broadcast_channel.id, message.id)]
+                    message = await broadcast_channel.send(broadcast_message, delete_after=(sleep_cycle - 5))
+                    self.bot.purgable_messages = self.bot.purgable_messages[-20:] + [(guild.id, broadcast_channel.id, message.id)]
 
             await asyncio.sleep(sleep_cycle)
 
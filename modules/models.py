@@ -3,21 +3,66 @@
 from discord.ext import commands
 import re
 # import psycopg2
-from psycopg2.errors import DuplicateObject
 from peewee import *
 from playhouse.postgres_ext import *
+from playhouse.pool import PooledPostgresqlExtDatabase
 import modules.exceptions as exceptions
 # from modules import utilities
 # import modules.utilities as utilities
 from modules import channels
+from modules import perf
 import statistics
 import settings
 import logging
+import threading
+import time
+import itertools
+import bisect
+import heapq
 
 logger = logging.getLogger('polybot.' + __name__)
 elo_logger = logging.getLogger('polybot.elo')
 
-db = PostgresqlExtDatabase(settings.psql_db, autorollback=True, user=settings.psql_user, autoconnect=False)
+
+class InstrumentedDatabase(PooledPostgresqlExtDatabase):
+    # reports the time and row count of every query to the command that ran it, see modules/perf.py
+    # and runs after_commit() callbacks once the current thread's transaction commits
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commit_callbacks = threading.local()
+
+    def execute_sql(self, sql, *args, **kwargs):
+        started = time.perf_counter()
+        cursor = super().execute_sql(sql, *args, **kwargs)
+        perf.record_query(time.perf_counter() - started, cursor.rowcount)
+        return cursor
+
+    def after_commit(self, callback):
+        # For in-memory caches of database state: runs callback once the enclosing db.atomic() block commits, or straight away
+        # outside of one. Clearing a cache any earlier would let another connection refill it from the uncommitted state
+        if not self.in_transaction():
+            return callback()
+        if not hasattr(self.commit_callbacks, 'pending'):
+            self.commit_callbacks.pending = []
+        self.commit_callbacks.pending.append(callback)
+
+    def commit(self):
+        result = super().commit()
+        callbacks, self.commit_callbacks.pending = getattr(self.commit_callbacks, 'pending', []), []
+        for callback in callbacks:
+            callback()
+        return result
+
+    def rollback(self):
+        self.commit_callbacks.pending = []
+        return super().rollback()
+
+
+# Each thread gets its own connection from the pool, opened on first use. The event loop thread keeps its connection for the life
+# of the bot; executor threads check one out only for the duration of their work (see utilities.run_in_db_thread)
+db = InstrumentedDatabase(settings.psql_db, autorollback=True, user=settings.psql_user,
+                           max_connections=settings.psql_max_connections, stale_timeout=settings.psql_stale_timeout)
 
 
 def tomorrow():
@@ -37,9 +82,15 @@ def string_to_user_id(input):
         return None
 
 
+def roster_signature(players):
+    # canonical string identifying a set of players, ie '12,57,340'. Matches GameSide.roster_signature as maintained by the lineup_roster_signature trigger
+    # accepts Player objects or player ids
+    player_ids = sorted(p if isinstance(p, int) else p.id for p in players)
+    return ','.join(str(p_id) for p_id in player_ids)
+
+
 def is_registered_member():
     async def predicate(ctx):
-        db.connect(reuse_if_open=True)
         member_match = DiscordMember.select(DiscordMember.discord_id).where(
             (DiscordMember.discord_id == ctx.author.id)
         ).count()
@@ -58,6 +109,14 @@ class BaseModel(Model):
     class Meta:
         database = db
 
+    trigger_fields = ()  # names of fields maintained by database triggers
+
+    def save(self, *args, **kwargs):
+        # leave trigger-maintained fields out of updates so a stale value loaded earlier cannot overwrite them
+        if self.trigger_fields and self._pk is not None and not kwargs.get('force_insert') and not kwargs.get('only'):
+            kwargs['only'] = [f for f in self._meta.sorted_fields if f.name not in self.trigger_fields]
+        return super().save(*args, **kwargs)
+
 
 class Configuration(BaseModel):
     def draft_config_defaults():
@@ -83,6 +142,13 @@ class Meta:
         indexes = ((('name', 'guild_id'), True),)   # Trailing comma is required
         # http://docs.peewee-orm.com/en/3.6.0/peewee/models.html#multi-column-indexes
 
+    def save(self, *args, **kwargs):
+        clear_squad_cache = self._pk is not None and 'emoji' in self._dirty  # team emoji are in Squad.leaderboard_cache
+        result = super().save(*args, **kwargs)
+        if clear_squad_cache:
+            Squad.clear_leaderboard_cache(self.guild_id)
+        return result
+
     def get_by_name(team_name: str, guild_id: int):
         teams = Team.select().where((Team.name.contains(team_name)) & (Team.guild_id == guild_id))
         return teams
@@ -124,24 +190,12 @@ def change_elo_after_game(self, chance_of_winning: float, is_winner: bool):
 
     def get_record(self, alltime=True):
 
-        if alltime:
-            date_cutoff = datetime.date.min
-        else:
+        query = TeamRecord.select(fn.COALESCE(fn.SUM(TeamRecord.wins), 0), fn.COALESCE(fn.SUM(TeamRecord.losses), 0)).where(TeamRecord.team_id == self.id)
+        if not alltime:
             date_cutoff = datetime.datetime.strptime(settings.team_elo_reset_date, "%m/%d/%Y").date()
+            query = query.where(TeamRecord.date > date_cutoff)
 
-        wins = GameSide.select().join(Game).where(
-            (GameSide.size > 1) & (Game.is_completed == 1) & (Game.is_confirmed == 1) &
-            (Game.is_ranked == 1) & (GameSide.team == self) &
-            (GameSide.id == Game.winner) & (Game.date > date_cutoff)
-        ).count()
-
-        losses = GameSide.select().join(Game).where(
-            (GameSide.size > 1) & (Game.is_completed == 1) & (Game.is_confirmed == 1) &
-            (Game.is_ranked == 1) & (GameSide.team == self) &
-            (GameSide.id != Game.winner) & (Game.date > date_cutoff)
-        ).count()
-
-        return (wins, losses)
+        return query.tuples().get()
 
     def get_season_record(self, season=None):
 
@@ -284,7 +338,9 @@ def losses(self):
 
     def get_record(self):
 
-        return (self.wins().count(), self.losses().count())
+        return DiscordMemberRecord.select(fn.COALESCE(fn.SUM(DiscordMemberRecord.wins), 0), fn.COALESCE(fn.SUM(DiscordMemberRecord.losses), 0)).where(
+            (DiscordMemberRecord.discord_member_id == self.id) & (DiscordMemberRecord.guild_id.in_(settings.servers_included_in_global_lb()))
+        ).tuples().get()
 
     def get_polychamps_record(self):
 
@@ -421,6 +477,16 @@ class Player(BaseModel):
     elo_max = SmallIntegerField(default=1000)
     trophies = ArrayField(CharField, null=True)
     is_banned = BooleanField(default=False)
+    games_played_count = IntegerField(default=0)  # count of all lineups for player, maintained by lineup_games_played trigger
+
+    trigger_fields = ('games_played_count',)
+
+    def save(self, *args, **kwargs):
+        clear_squad_cache = self._pk is not None and bool(self._dirty & {'name', 'team'})  # names and team emoji are in Squad.leaderboard_cache
+        result = super().save(*args, **kwargs)
+        if clear_squad_cache:
+            Squad.clear_leaderboard_cache(self.guild_id)
+        return result
 
     def generate_display_name(self=None, player_name=None, player_nick=None):
 
@@ -514,9 +580,11 @@ def is_in_team(guild_id, discord_member):
         logger.debug(f'is_in_team: True / {list_of_teams[0].id} {list_of_teams[0].name}')
         return (True, list_of_teams[0])
 
-    def string_matches(player_string: str, guild_id: int, include_poly_info: bool = True):
-        # Returns QuerySet containing players in current guild matching string. Searches against discord mention ID first, then exact discord name match,
-        # then falls back to substring match on name/nick, then a lastly a substring match of polytopia ID or polytopia in-game name
+    def string_matches(player_string: str, guild_id: int, include_poly_info: bool = True, fuzzy: bool = False):
+        # Returns list of players in current guild matching string. Searches against discord mention ID first, then a single ranked query:
+        # exact discord name > prefix of name/nick > substring of name/nick > substring of polytopia ID/name > trigram similarity of name/nick
+        # The trigram similarity tier is only used with fuzzy=True, for lookups where the string is known to be meant as a player
+        # Only the players in the best-ranked tier are returned, ordered by number of games played
 
         player_string = str(player_string)
         p_id = string_to_user_id(player_string)
@@ -526,7 +594,7 @@ def string_matches(player_string: str, guild_id: int, include_poly_info: bool =
                 (DiscordMember.discord_id == p_id) & (Player.guild_id == guild_id)
             )
             if query_by_id.count() > 0:
-                return query_by_id
+                return list(query_by_id)
 
         if len(player_string.split('#', 1)[0]) > 2:
             discord_str = player_string.split('#', 1)[0]
@@ -535,35 +603,39 @@ def string_matches(player_string: str, guild_id: int, include_poly_info: bool =
         else:
             discord_str = player_string
 
-        name_exact_match = Player.select(Player, DiscordMember).join(DiscordMember).where(
-            (DiscordMember.name ** discord_str) & (Player.guild_id == guild_id)  # ** is case-insensitive
-        )
+        exact_match = (DiscordMember.name ** discord_str)  # ** is case-insensitive
+        prefix_match = (DiscordMember.name.startswith(discord_str)) | (Player.nick.startswith(player_string))
+        substring_match = (DiscordMember.name.contains(discord_str)) | (Player.nick.contains(player_string))
+        poly_match = (DiscordMember.polytopia_id.contains(player_string)) | (DiscordMember.polytopia_name.contains(player_string))
+        # pg_trgm similarity operator, can use the gin_trgm_ops indexes. %% since psycopg2 treats a single % as a placeholder
+        similar_match = (NodeList((DiscordMember.name, SQL('%%'), discord_str))) | (NodeList((Player.nick, SQL('%%'), player_string)))
 
-        if name_exact_match.count() == 1:
-            # String matches DiscordUser.name exactly
-            return name_exact_match
+        tiers = [(exact_match, 0), (prefix_match, 1), (substring_match, 2)]
+        if include_poly_info:
+            tiers.append((poly_match, 3))
+        if fuzzy:
+            tiers.append((similar_match, 4))
 
-        # If no exact match, return any substring matches - prioritized by number of games played
+        match_condition = tiers[0][0]
+        for condition, _ in tiers[1:]:
+            match_condition = match_condition | condition
 
-        name_substring_match = Lineup.select(Lineup.player, fn.COUNT('*').alias('games_played')).join(Player).join(DiscordMember).where(
-            ((Player.nick.contains(player_string)) | (DiscordMember.name.contains(discord_str))) & (Player.guild_id == guild_id)
-        ).group_by(Lineup.player).order_by(-SQL('games_played'))
+        match_rank = Case(None, tiers, 5)
+        similarity = fn.GREATEST(fn.similarity(DiscordMember.name, discord_str), fn.similarity(Player.nick, player_string))
 
-        if name_substring_match.count() > 0:
-            return [l.player for l in name_substring_match]
+        ranked_matches = Player.select(Player, DiscordMember, match_rank.alias('match_rank')).join(DiscordMember).where(
+            (match_condition) & (Player.guild_id == guild_id)
+        ).order_by(match_rank, -similarity, -Player.games_played_count)
 
-        if include_poly_info:
-            # If no substring name matches, return anything with matching polytopia name or code
-            poly_fields_match = Player.select(Player, DiscordMember).join(DiscordMember).where(
-                ((DiscordMember.polytopia_id.contains(player_string)) | (DiscordMember.polytopia_name.contains(player_string))) & (Player.guild_id == guild_id)
-            )
-            return poly_fields_match
-        else:
-            # if include_poly_info == False, then do not fall back to searching by polytopia_id or polytopia_name
+        results = list(ranked_matches)
+        if not results:
             return []
 
+        best_rank = results[0].match_rank
+        return [p for p in results if p.match_rank == best_rank]
+
     def get_or_except(player_string: str, guild_id: int):
-        results = Player.string_matches(player_string=player_string, guild_id=guild_id)
+        results = Player.string_matches(player_string=player_string, guild_id=guild_id, fuzzy=True)
         if len(results) == 0:
             raise exceptions.NoMatches(f'No matching player was found for "{player_string}"')
         if len(results) > 1:
@@ -650,7 +722,8 @@ def losses(self):
 
     def get_record(self):
 
-        return (self.wins().count(), self.losses().count())
+        record = PlayerRecord.get_or_none(PlayerRecord.player_id == self.id)
+        return (record.wins, record.losses) if record else (0, 0)
 
     def leaderboard_rank(self, date_cutoff):
         # TODO: This could be replaced with Postgresql Window functions to have the DB calculate the rank.
@@ -789,6 +862,17 @@ class Game(BaseModel):
     game_chan = BitField(default=None, null=True)
     size = ArrayField(SmallIntegerField, default=[0])
     is_mobile = BooleanField(default=True)
+    open_slots = SmallIntegerField(default=0)  # sum of unfilled slots across gamesides, maintained by gameside_open_slots trigger
+    # requirements parsed from notes by Game.requirements_from_notes() whenever notes are set by opengame/gamenotes/lobby creation
+    req_min_elo = SmallIntegerField(default=0)
+    req_max_elo = SmallIntegerField(default=3000)
+    req_min_elo_global = SmallIntegerField(default=0)
+    req_max_elo_global = SmallIntegerField(default=3000)
+    invited_ids = ArrayField(BigIntegerField, null=True, default=None)  # discord IDs @Mentioned in notes
+    is_nova = BooleanField(default=False)  # 'nova' appears in notes
+
+    trigger_fields = ('open_slots',)
+    full_game_grace = datetime.timedelta(days=3)  # host has this long after expiration to start a full game before it is purged
 
     def __setattr__(self, name, value):
         if name == 'name':
@@ -850,6 +934,7 @@ async def create_game_channels(self, guild_list, guild_id):
                     # Making sure this is set to None for the edge case of a restarted game that previously had been on a team server
                     # and now no longer needs to be
                 gameside.save()
+                GameChannel.register(chan.id, game=self, gameside=gameside)
 
                 await channels.greet_game_channel(side_guild, chan=chan, player_list=player_list, roster_names=roster_names, game=self, full_game=False)
 
@@ -860,6 +945,7 @@ async def create_game_channels(self, guild_list, guild_id):
             if chan:
                 self.game_chan = chan.id
                 self.save()
+                GameChannel.register(chan.id, game=self)
                 await channels.greet_game_channel(guild, chan=chan, player_list=player_list, roster_names=roster_names, game=self, full_game=True)
 
         if error_message:
@@ -886,11 +972,13 @@ async def delete_game_channels(self, guild_list, guild_id):
                 else:
                     side_guild = guild
                 await channels.delete_game_channel(side_guild, channel_id=gameside.team_chan)
+                GameChannel.unregister(gameside.team_chan)
                 gameside.team_chan = None
                 gameside.save()
 
         if self.game_chan:
             await channels.delete_game_channel(guild, channel_id=self.game_chan)
+            GameChannel.unregister(self.game_chan)
             self.game_chan = None
             self.save()
 
@@ -1301,17 +1389,22 @@ def pregame_check(discord_groups, guild_id, require_teams: bool = False):
         logger.debug(f'pregame_check returning {teams_for_each_discord_member} // {list_of_final_teams}')
         return (teams_for_each_discord_member, list_of_final_teams)
 
-    def create_game(discord_groups, guild_id, name: str = None, require_teams: bool = False, is_ranked: bool = True):
+    def create_game(discord_groups, guild_id, name: str = None, require_teams: bool = False, is_ranked: bool = True,
+                    is_pending: bool = False, expiration=None, is_mobile: bool = True):
         # discord_groups = list of lists [[d1, d2, d3], [d4, d5, d6]]. each item being a discord.Member object
+        # is_pending=True opens a full pending game instead (used by the matchmaking queue), hosted by the first member of the first group.
+        # Its squads are assigned when it is started
 
         teams_for_each_discord_member, list_of_final_teams = Game.pregame_check(discord_groups, guild_id, require_teams)
         logger.debug(f'teams_for_each_discord_member: {teams_for_each_discord_member}\nlist_of_final_teams: {list_of_final_teams}')
 
+        pending_fields = {'is_pending': True, 'expiration': expiration, 'is_mobile': is_mobile, 'notes': ''} if is_pending else {}
         with db.atomic():
             newgame = Game.create(name=name,
                                   guild_id=guild_id,
                                   is_ranked=is_ranked,
-                                  size=[len(g) for g in discord_groups])
+                                  size=[len(g) for g in discord_groups],
+                                  **pending_fields)
 
             side_position = 1
             for team_group, allied_team, discord_group in zip(teams_for_each_discord_member, list_of_final_teams, discord_groups):
@@ -1327,8 +1420,12 @@ def create_game(discord_groups, guild_id, name: str = None, require_teams: bool
                     )
                     logger.debug(f'Player {player_group[-1].id} {player_group[-1].name} added to side')
 
+                if is_pending and side_position == 1:
+                    newgame.host = player_group[0]
+                    newgame.save()
+
                 # Create Squad records if 2+ players are allied
-                if len(player_group) > 1:
+                if len(player_group) > 1 and not is_pending:
                     squad = Squad.upsert(player_list=player_group, guild_id=guild_id)
                     logger.debug(f'Using squad {squad.id}')
                 else:
@@ -1344,6 +1441,9 @@ def create_game(discord_groups, guild_id, name: str = None, require_teams: bool
         return newgame
 
     def reverse_elo_changes(self):
+        Squad.clear_leaderboard_cache(self.guild_id)
+        RecordView.mark_stale()
+        TournamentGame.clear_result(self)
         for lineup in self.lineup:
             lineup.player.elo += lineup.elo_change_player * -1
             lineup.player.save()
@@ -1384,6 +1484,8 @@ def delete_game(self):
         with db.atomic():
             if self.winner:
                 self.winner = None
+                TournamentGame.clear_result(self)
+                RecordView.mark_stale()
 
                 if self.is_confirmed and self.is_ranked:
                     recalculate = True
@@ -1440,6 +1542,57 @@ def get_side_win_chances(largest_team: int, gameside_list, gameside_elo_list, ca
 
         return win_chance_list
 
+    def balanced_splits(elo_list, team_size: int, top_k: int = 5, calc_version: int = 2):
+        # Splits 2 * team_size players into the two sides whose win chances are closest to 50/50
+        # elo_list is the players' ELOs, looked up once by the caller. Returns up to top_k of
+        # [(side 1 indexes into elo_list, side 2 indexes, [side 1 win chance, side 2 win chance])], fairest first
+        #
+        # Meet in the middle: every subset of the first half of the players is paired with the subsets of the second half
+        # whose ELO sums come closest to an even game, found by bisecting the second half's subsets sorted by sum.
+        # That is O(2^(n/2) log) instead of checking all n choose n/2 splits, so 20+ players stay fast.
+
+        n = len(elo_list)
+        if n != team_size * 2:
+            raise ValueError(f'{n} players cannot be split into two sides of {team_size}')
+
+        host_bonus = 50 if (calc_version == 2 and team_size == 1) else 0  # same solo host adjustment as declare_winner()
+        target_sum = (sum(elo_list) - host_bonus) / 2  # side 1 ELO sum for an even game
+
+        half = n // 2
+        left, right = list(range(half)), list(range(half, n))
+
+        right_subsets = {}  # subset size -> sorted [(elo sum, indexes)]
+        for size in range(min(len(right), team_size) + 1):
+            right_subsets[size] = sorted((sum(elo_list[i] for i in combo), combo) for combo in itertools.combinations(right, size))
+
+        best = []  # heap of (-distance from target_sum, side 1 indexes), worst kept on top
+        for size in range(min(len(left), team_size) + 1):
+            candidates = right_subsets.get(team_size - size)
+            if not candidates:
+                continue
+            sums = [c[0] for c in candidates]
+            for combo in itertools.combinations(left, size):
+                if not host_bonus and 0 not in combo:
+                    continue  # sides are interchangeable, so only consider splits with player 0 on side 1
+                left_sum = sum(elo_list[i] for i in combo)
+                pos = bisect.bisect_left(sums, target_sum - left_sum)
+                for right_sum, right_combo in candidates[max(0, pos - top_k):pos + top_k]:
+                    distance = abs(left_sum + right_sum - target_sum)
+                    if len(best) < top_k:
+                        heapq.heappush(best, (-distance, combo + right_combo))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, combo + right_combo))
+
+        results = []
+        for _, side1 in sorted(best, key=lambda b: -b[0]):
+            side2 = tuple(i for i in range(n) if i not in side1)
+            side1_elos, side2_elos = [elo_list[i] for i in side1], [elo_list[i] for i in side2]
+            side_elos = [int(round(sum(side1_elos) / team_size)) + host_bonus, int(round(sum(side2_elos) / team_size))]
+            win_chances = Game.get_side_win_chances(team_size, [SplitSide(side1_elos), SplitSide(side2_elos)], side_elos, calc_version)
+            results.append((side1, side2, win_chances))
+
+        return sorted(results, key=lambda r: abs(r[2][0] - 0.5))
+
     def declare_winner(self, winning_side: 'GameSide', confirm: bool):
         logger.debug(f'Running declare_winner for game {self.id}')
 
@@ -1461,6 +1614,9 @@ def declare_winner(self, winning_side: 'GameSide', confirm: bool):
                     self.completed_ts = datetime.datetime.now()  # will be preserved if ELO is re-calculated after initial win.
 
                 self.is_confirmed = True
+                Squad.clear_leaderboard_cache(self.guild_id)
+                RecordView.mark_stale()
+                TournamentGame.record_result(self, winning_side)
                 if self.is_ranked:
                     # run elo calculations for player, discordmember, team, squad
 
@@ -1626,34 +1782,70 @@ def gameside_by_name(self, name: str):
         else:
             raise exceptions.TooManyMatches(f'{len(matches)} matches found for "{name}" in game {self.id}. Be more specific or use a @Mention.')
 
-    def elo_requirements(self):
+    def load_rosters(game_list):
+        # Returns {game_id: (list of GameSides ordered by position, list of Lineups with Player/DiscordMember ordered by id)}
+        # for all games in game_list using two queries, regardless of how many games are given
+
+        game_ids = [g.id for g in game_list]
+        rosters = {game_id: ([], []) for game_id in game_ids}
+        if not game_ids:
+            return rosters
 
-        min_elo, max_elo = 0, 3000
-        min_elo_g, max_elo_g = 0, 3000
-        notes = self.notes if self.notes else ''
+        for side in GameSide.select().where(GameSide.game.in_(game_ids)).order_by(GameSide.position):
+            rosters[side.game_id][0].append(side)
+
+        lineups = Lineup.select(Lineup, Player, DiscordMember).join(Player).join(DiscordMember).where(
+            Lineup.game.in_(game_ids)
+        ).order_by(Lineup.id)
+        for lineup in lineups:
+            rosters[lineup.game_id][1].append(lineup)
+
+        return rosters
+
+    def requirements_from_notes(notes: str):
+        # parse game requirements out of free-text notes. Returns dict of Game requirement fields, suitable for Game.create(**) or update()
+
+        notes = notes if notes else ''
+        requirements = {'req_min_elo': 0, 'req_max_elo': 3000, 'req_min_elo_global': 0, 'req_max_elo_global': 3000}
 
         m = re.search(r'(\d+) elo max', notes, re.I)
         if m:
-            max_elo = int(m[1])
+            requirements['req_max_elo'] = int(m[1])
         m = re.search(r'(\d+) elo min', notes, re.I)
         if m:
-            min_elo = int(m[1])
+            requirements['req_min_elo'] = int(m[1])
 
         m = re.search(r'(\d+) global elo max', notes, re.I)
         if m:
-            max_elo_g = int(m[1])
+            requirements['req_max_elo_global'] = int(m[1])
         m = re.search(r'(\d+) global elo min', notes, re.I)
         if m:
-            min_elo_g = int(m[1])
+            requirements['req_min_elo_global'] = int(m[1])
+
+        for field, value in requirements.items():
+            requirements[field] = min(value, 32767)  # SmallIntegerField bounds
 
-        return (min_elo, max_elo, min_elo_g, max_elo_g)
+        invited_ids = [int(i) for i in re.findall(r'<@!?(\d+)>', notes)]
+        requirements['invited_ids'] = invited_ids if invited_ids else None
+        requirements['is_nova'] = 'NOVA' in notes.upper()
+
+        return requirements
+
+    def set_notes(self, notes: str):
+        # set notes and the requirement fields parsed from them. Caller must save()
+        self.notes = notes
+        for field, value in Game.requirements_from_notes(notes).items():
+            setattr(self, field, value)
+
+    def elo_requirements(self):
+        return (self.req_min_elo, self.req_max_elo, self.req_min_elo_global, self.req_max_elo_global)
 
     def waiting_for_creator(creator_discord_id: int):
         # Games for which creator_discord_id is in the 'creating player' slot (first player in GameSide.position == 1) and Game is full/waiting to start
 
         # subq = List of all lineup IDs for creating player for full pending games
         subq = GameSide.select(fn.MIN(Lineup.id).alias('game_creator')).join(Lineup).join_from(GameSide, Game).where(
-            (GameSide.position == 1) & (Game.is_pending == 1) & (Game.id.not_in(Game.subq_open_games_with_capacity()))
+            (GameSide.position == 1) & (Game.is_pending == 1) & (Game.open_slots == 0)
         ).group_by(GameSide.game)
 
         q = Lineup.select(Lineup.game).join(Player).join(DiscordMember).where(
@@ -1662,7 +1854,8 @@ def waiting_for_creator(creator_discord_id: int):
 
         return q
 
-    def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int = None, player_discord_id: int = None, host_discord_id: int = None, platform_filter: int = 2):
+    def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int = None, player_discord_id: int = None, host_discord_id: int = None, platform_filter: int = 2,
+                       player_elo: int = None, player_elo_global: int = None, novas_only: bool = False, prefetch: bool = True):
         # status_filter
         # 0 = all open games
         # 1 = full games / waiting to start
@@ -1675,6 +1868,9 @@ def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int
         # 0 = desktop (is_mobile == False)
         # 1 = mobile (is_mobile == True)
         # 2 = any
+        # player_elo / player_elo_global - if given, only games whose ELO requirements allow those ELOs
+        # novas_only - only games with 'nova' in notes
+        # prefetch - if False, returns the unexecuted query without prefetching sides and lineups, ie. for Game.load_rosters()
 
         ranked_filter = [0, 1] if ranked_filter == 2 else [ranked_filter]  # [0] or [1]
         platform_filter = [0, 1] if platform_filter == 2 else [platform_filter]
@@ -1705,46 +1901,65 @@ def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int
             # Pass None to not filter by Game.host
             host_filter = Game.select(Game.id)
 
+        requirement_filter = (Game.is_pending == 1)  # base condition for the optional requirement predicates below to be and-ed onto
+        if player_elo is not None:
+            requirement_filter &= (Game.req_min_elo <= player_elo) & (Game.req_max_elo >= player_elo)
+        if player_elo_global is not None:
+            requirement_filter &= (Game.req_min_elo_global <= player_elo_global) & (Game.req_max_elo_global >= player_elo_global)
+        if novas_only:
+            requirement_filter &= (Game.is_nova == 1)
+
         if status_filter == 1:
             # full games / waiting to start
             q = Game.select().where(
-                (Game.id.not_in(Game.subq_open_games_with_capacity())) &
+                (Game.open_slots == 0) &
                 (Game.is_pending == 1) &
                 (Game.id.in_(guild_filter)) &
                 (Game.id.in_(player_filter)) &
                 (Game.id.in_(host_filter)) &
                 (Game.is_ranked.in_(ranked_filter)) &
-                (Game.is_mobile.in_(platform_filter))
+                (Game.is_mobile.in_(platform_filter)) &
+                (requirement_filter)
             )
-            return q.prefetch(GameSide, Lineup, Player)
 
         elif status_filter == 2:
             # games with open capacity
-            return Game.select().where(
-                (Game.id.in_(Game.subq_open_games_with_capacity())) &
+            q = Game.select().where(
+                (Game.open_slots > 0) &
                 (Game.is_pending == 1) &
                 (Game.id.in_(guild_filter)) &
                 (Game.id.in_(player_filter)) &
                 (Game.id.in_(host_filter)) &
                 (Game.is_ranked.in_(ranked_filter)) &
-                (Game.is_mobile.in_(platform_filter))
-            ).order_by(-Game.id).prefetch(GameSide, Lineup, Player)
+                (Game.is_mobile.in_(platform_filter)) &
+                (requirement_filter)
+            ).order_by(-Game.id)
 
         else:
             # Any kind of open game
-            # sorts by capacity-player_count, so full games are at bottom of list
-            return Game.select(
-                Game, fn.SUM(GameSide.size).alias('player_capacity'), fn.COUNT(Lineup.id).alias('player_count'),
-            ).join(GameSide, on=(GameSide.game == Game.id)).join(Lineup, JOIN.LEFT_OUTER).where(
+            # sorts by open slots, so full games are at bottom of list
+            q = Game.select().where(
                 (Game.is_pending == 1) &
                 (Game.id.in_(guild_filter)) &
                 (Game.id.in_(player_filter)) &
                 (Game.id.in_(host_filter)) &
                 (Game.is_ranked.in_(ranked_filter)) &
-                (Game.is_mobile.in_(platform_filter))
-            ).group_by(Game.id).order_by(
-                -(fn.SUM(GameSide.size) - fn.COUNT(Lineup.id))
-            ).prefetch(GameSide, Lineup, Player)
+                (Game.is_mobile.in_(platform_filter)) &
+                (requirement_filter)
+            ).order_by(-Game.open_slots)
+
+        return q.prefetch(GameSide, Lineup, Player) if prefetch else q
+
+    def open_lobbies(game_id: int = None):
+        # Unhosted pending games with open slots - the games that can satisfy an entry in settings.lobbies
+        # Only the columns needed to match a lobby are selected. Pass game_id to check a single game.
+
+        q = Game.select(Game.id, Game.guild_id, Game.size, Game.is_ranked, Game.notes, Game.open_slots).where(
+            (Game.is_pending == 1) & (Game.host.is_null(True)) & (Game.open_slots > 0)
+        )
+        if game_id:
+            q = q.where(Game.id == game_id)
+        return q
 
     def search(player_filter=None, team_filter=None, title_filter=None, status_filter: int = 0, guild_id: int = None, size_filter=None):
         # Returns Games by almost any combination of player/team participation, and game status
@@ -1865,21 +2080,18 @@ def series_record(self):
 
         player_lists = []
         for side in gamesides:
-            player_lists.append([lineup.player for lineup in side.lineup])
+            player_lists.append([lineup.player_id for lineup in side.lineup])
+        signatures = [roster_signature(player_list) for player_list in player_lists]
 
-        games_with_same_teams = Game.by_opponents(player_lists)
+        games_with_same_teams = Game.by_opponents(player_lists).select(Game.id)
 
-        s1_wins, s2_wins = 0, 0
-        for game in games_with_same_teams:
-            if not game.is_ranked:
-                continue
-            if game.is_confirmed:
-                if game.winner.has_same_players_as(gamesides[0]):
-                    s1_wins += 1
-                    logger.debug(f'series_record(): s1_wins incremented for game {game.id}')
-                else:
-                    s2_wins += 1
-                    logger.debug(f'series_record(): s2_wins incremented for game {game.id}')
+        # count wins per winning roster across all ranked confirmed games between these two rosters
+        wins_query = GameSide.select(GameSide.roster_signature, fn.COUNT(GameSide.id)).join(Game, on=(Game.winner == GameSide.id)).where(
+            (Game.id.in_(games_with_same_teams)) & (Game.is_ranked == 1) & (Game.is_confirmed == 1)
+        ).group_by(GameSide.roster_signature).tuples()
+
+        wins_by_signature = {signature: wins for signature, wins in wins_query}
+        s1_wins, s2_wins = wins_by_signature.get(signatures[0], 0), wins_by_signature.get(signatures[1], 0)
 
         logger.debug(f'series_record(): game {self.id}, side 0, id {gamesides[0].id}, wins {s1_wins}. side 1, id {gamesides[1].id}, wins {s2_wins}')
         if s2_wins > s1_wins:
@@ -1888,19 +2100,18 @@ def series_record(self):
 
     def by_channel_id(chan_id: int):
         # Given a discord channel id (such as 722725679443214347) return a Game that uses that channel as its gameside or game channel ID
-        # Raise exception if no match or more than one match
-
-        query = Game.select().join(GameSide, on=(GameSide.game == Game.id)).where(
-            (GameSide.team_chan == int(chan_id)) | (Game.game_chan == int(chan_id))
-        ).distinct()
+        # Raise exception if no match. Channels with no game are answered from the in-memory GameChannel registry without a query
 
-        if len(query) == 0:
+        game_id = GameChannel.game_id_for_channel(int(chan_id))
+        if not game_id:
             raise exceptions.NoMatches(f'No matching game found for given channel')
-        if len(query) > 1:
-            logger.warning(f'by_channel_id - More than one game matches channel ID {chan_id}')
-            raise exceptions.TooManyMatches(f'More than game found with this associated channel')
 
-        return query[0]
+        try:
+            return Game.get_by_id(game_id)
+        except DoesNotExist:
+            # game was deleted, which cascades to its GameChannel rows
+            GameChannel.forget(int(chan_id))
+            raise exceptions.NoMatches(f'No matching game found for given channel')
 
     def uses_channel_id(self, chan_id: int):
         # Given a discord channel ID, return True if self is associated with that channel
@@ -1952,38 +2163,15 @@ def by_opponents(player_lists):
             raise exceptions.CheckFailedError('At least two sides must be queried, ie: [[p1, p2], [p3, p4]]')
 
         logger.debug(f'by_opponents() with player_lists = {player_lists}')
-        side_games = []
-        for player_list in player_lists:
-            # for this given player_list, find all games that had this exact list on one side
-
-            query = GameSide.select(GameSide.game).join(Lineup).group_by(GameSide.game, GameSide.id).having(
-                (fn.SUM(Lineup.player.in_(player_list).cast('integer')) == len(player_list)) & (fn.SUM(Lineup.player.not_in(player_list).cast('integer')) == 0)
-            )
-            side_games.append(set((res[0] for res in query.tuples())))
-            # side_games will be a list of sets, each set being game_ids for other games with this specific gamesides
-
-        intersection_of_games = set.intersection(*side_games)
-        # this becomes a set of game IDs where -all- the game sides participated
-
-        subq_games_with_same_number_of_sides = GameSide.select(GameSide.game).group_by(GameSide.game).having(fn.COUNT('*') == len(player_lists))
+        signatures = [roster_signature(player_list) for player_list in player_lists]
 
-        query = Game.select().where(
-            (Game.id.in_(intersection_of_games)) & (Game.id.in_(subq_games_with_same_number_of_sides)) & (Game.is_pending == 0)
-        )
+        # games where every side has one of the given rosters, and that have no other sides
+        query = Game.select().join(GameSide, on=(GameSide.game == Game.id)).where(
+            (GameSide.roster_signature.in_(signatures)) & (Game.is_pending == 0) & (fn.array_length(Game.size, 1) == len(signatures))
+        ).group_by(Game.id).having(fn.COUNT(GameSide.id) == len(signatures))
 
         return query
 
-        # Commented out block negated by subq_games_with_same_number_of_sides - which needs to be more thoroughly vetted
-        # games_with_same_number_of_sides = []
-        # for game in query:
-        #     # ugly fix - without this block games without the same number of sides will be mixed together.
-        #     # if game 1 is p1 vs p2, and game 2 is p1 vs p2 vs p3, they would be compared
-        #     # could fix this with better SQL querying but this was a quick fix
-        #     if len(game.gamesides) == len(player_lists):
-        #         games_with_same_number_of_sides.append(game)
-
-        # return games_with_same_number_of_sides
-
     def recalculate_elo_since(timestamp):
         games = Game.select().where(
             (Game.is_completed == 1) & (Game.is_confirmed == 1) & (Game.completed_ts >= timestamp) & (Game.winner.is_null(False)) & (Game.is_ranked == 1)
@@ -2070,42 +2258,33 @@ def get_side(self, lookup):
 
         return None, False
 
-    def subq_open_games_with_capacity(guild_id: int = None):
-        # All games that have open capacity
-        # not restricted by expiration
-
-        # Subq: MatchSides with openings
-        subq = GameSide.select(GameSide.id).join(Lineup, JOIN.LEFT_OUTER).group_by(GameSide.id, GameSide.size).having(
-            fn.COUNT(Lineup.id) < GameSide.size)
-
-        if guild_id:
-            q = GameSide.select(GameSide.game).join(Game).where(
-                (GameSide.id.in_(subq)) & (GameSide.game.guild_id == guild_id) & (GameSide.game.is_pending == 1)
-            ).group_by(GameSide.game).order_by(GameSide.game)
-
-        else:
-            q = GameSide.select(GameSide.game).join(Game).where(
-                (GameSide.id.in_(subq)) & (GameSide.game.is_pending == 1)
-            ).group_by(GameSide.game).order_by(GameSide.game)
-
-        return q
+    def purge_expired_games(batch_size: int = 100):
+        # Deletes up to batch_size expired pending games, oldest expiration first, and returns their IDs.
+        # Callers should call again while a full batch is returned.
+
+        now = datetime.datetime.now()
+        expired_subq = Game.select(Game.id).where(
+            (Game.is_pending == 1) & (
+                # Full matches that expired more than 3 days ago (ie. host has 3 days to start match before it vanishes)
+                (Game.expiration < now - Game.full_game_grace) |
+                # Expired matches that never became full
+                ((Game.expiration < now) & (Game.open_slots > 0))
+            )
+        ).order_by(Game.expiration).limit(batch_size)
 
-    def purge_expired_games():
+        purged_ids = [g.id for g in Game.delete().where(Game.id.in_(expired_subq)).returning(Game.id).execute()]
+        if purged_ids:
+            logger.info(f'purge_expired_games: Purged {len(purged_ids)} games.')
+        return purged_ids
 
-        # Full matches that expired more than 3 days ago (ie. host has 3 days to start match before it vanishes)
-        purge_deadline = (datetime.datetime.now() + datetime.timedelta(days=-3))
+    def next_expiration():
+        # Earliest time at which purge_expired_games() will have something to delete, or None if no games are pending
 
-        delete_query = Game.delete().where(
-            (Game.expiration < purge_deadline) & (Game.is_pending == 1)
-        )
-
-        # Expired matches that never became full
-        delete_query2 = Game.delete().where(
-            (Game.expiration < datetime.datetime.now()) & (Game.id.in_(Game.subq_open_games_with_capacity())) & (Game.is_pending == 1)
-        )
+        next_open = Game.select(fn.MIN(Game.expiration)).where((Game.is_pending == 1) & (Game.open_slots > 0)).scalar()
+        next_full = Game.select(fn.MIN(Game.expiration)).where(Game.is_pending == 1).scalar()
 
-        logger.info(f'purge_expired_games #1: Purged {delete_query.execute()}  games.')
-        logger.info(f'purge_expired_games #2: Purged {delete_query2.execute()}  games.')
+        deadlines = [ts for ts in (next_open, next_full + Game.full_game_grace if next_full else None) if ts]
+        return min(deadlines) if deadlines else None
 
     def confirmations_reset(self):
         with db.atomic():
@@ -2234,6 +2413,8 @@ def is_uncaught_season_game(self):
 class Squad(BaseModel):
     elo = SmallIntegerField(default=1000)
     guild_id = BitField(unique=False, null=False)
+    member_key = TextField(null=True, default=None)  # roster_signature() of members - unique index squad_member_key
+    member_ids = ArrayField(IntegerField, null=True, default=None)  # sorted player ids of members - gin index squad_member_ids
 
     def upsert(player_list, guild_id: int):
 
@@ -2241,9 +2422,10 @@ def upsert(player_list, guild_id: int):
 
         if len(squads) == 0:
             # Insert new squad based on this combination of players
-            sq = Squad.create(guild_id=guild_id)
-            for p in player_list:
-                SquadMember.create(player=p, squad=sq)
+            with db.atomic():
+                sq = Squad.create(guild_id=guild_id, member_key=roster_signature(player_list), member_ids=sorted(p.id for p in player_list))
+                for p in player_list:
+                    SquadMember.create(player=p, squad=sq)
             return sq
 
         return squads[0]
@@ -2329,12 +2511,45 @@ def leaderboard(date_cutoff, guild_id: int):
 
         return q
 
+    leaderboard_cache = {}  # guild_id: {(date_cutoff, limit): leaderboard_summary() results}, cleared whenever a game in the guild is confirmed or unconfirmed
+    # or a player in the guild changes name or team, or a team changes emoji
+
+    def clear_leaderboard_cache(guild_id: int):
+        db.after_commit(lambda: Squad.leaderboard_cache.pop(guild_id, None))
+
+    def leaderboard_summary(date_cutoff, guild_id: int, limit: int = 200):
+        # Returns list of (squad_id, elo, wins, losses, [member names], [member team emojis]) for the squad leaderboard in one query
+
+        cache_key = (date_cutoff, limit)
+        cached = Squad.leaderboard_cache.get(guild_id, {})
+        perf.record_cache_lookup('squad_leaderboard', hit=cache_key in cached)
+        if cache_key in cached:
+            return cached[cache_key]
+
+        leaderboard_squads = Squad.leaderboard(date_cutoff=date_cutoff, guild_id=guild_id).select(Squad.id)
+
+        wins = GameSide.select(fn.COUNT(GameSide.id)).join(Game, on=(GameSide.game == Game.id)).where(
+            (Game.is_completed == 1) & (Game.is_confirmed == 1) & (Game.is_ranked == 1) & (GameSide.squad == Squad.id) & (GameSide.id == Game.winner)
+        )
+        losses = GameSide.select(fn.COUNT(GameSide.id)).join(Game, on=(GameSide.game == Game.id)).where(
+            (Game.is_completed == 1) & (Game.is_confirmed == 1) & (Game.is_ranked == 1) & (GameSide.squad == Squad.id) & (GameSide.id != Game.winner)
+        )
+
+        query = Squad.select(
+            Squad.id, Squad.elo, wins, losses, fn.array_agg(Player.name), fn.array_agg(Team.emoji)
+        ).join(SquadMember).join(Player).join(Team, JOIN.LEFT_OUTER, on=(Player.team == Team.id)).where(
+            Squad.id.in_(leaderboard_squads)
+        ).group_by(Squad.id).order_by(-Squad.elo).limit(limit).tuples()
+
+        summary = [(squad_id, elo, win_count, loss_count, names, [e for e in emojis if e])
+                   for squad_id, elo, win_count, loss_count, names, emojis in query]
+        Squad.leaderboard_cache.setdefault(guild_id, {})[cache_key] = summary
+        return summary
+
     def get_matching_squad(player_list):
         # Takes [List, of, Player, Records] (not names)
-        # Returns squad with exactly the same participating players. See https://stackoverflow.com/q/52010522/1281743
-        query = Squad.select().join(SquadMember).group_by(Squad.id).having(
-            (fn.SUM(SquadMember.player.in_(player_list).cast('integer')) == len(player_list)) & (fn.SUM(SquadMember.player.not_in(player_list).cast('integer')) == 0)
-        )
+        # Returns squad with exactly the same participating players, using unique index on member_key
+        query = Squad.select().where(Squad.member_key == roster_signature(player_list))
 
         return query
 
@@ -2351,29 +2566,22 @@ def get_all_matching_squads(player_list, guild_id: int):
         else:
             min_games = 2
 
-        squad_with_matching_members = Squad.select().join(SquadMember).group_by(Squad.id).having(
-            (fn.SUM(SquadMember.player.in_(player_list).cast('integer')) == len(player_list))
+        # member_ids @> [ids] uses the gin index on member_ids
+        squad_with_matching_members = Squad.select(Squad.id).where(
+            (Squad.member_ids.contains(*[p.id for p in player_list])) & (fn.array_length(Squad.member_ids, 1) >= 2) & (Squad.guild_id == guild_id)
         )
 
         query = GameSide.select(GameSide.squad, fn.COUNT('*').alias('games_played')).where(
-            (GameSide.squad.in_(Squad.subq_squads_by_size(min_size=2))) &
-            (GameSide.squad.in_(Squad.subq_squads_with_completed_games(min_games=min_games))) &
-            (GameSide.squad.in_(squad_with_matching_members))
+            (GameSide.squad.in_(squad_with_matching_members)) &
+            (GameSide.squad.in_(Squad.subq_squads_with_completed_games(min_games=min_games)))
         ).group_by(GameSide.squad).order_by(-SQL('games_played'))
 
         return query
 
     def get_record(self):
 
-        wins = GameSide.select(GameSide.id).join(Game).where(
-            (Game.is_completed == 1) & (Game.is_confirmed == 1) & (Game.is_ranked == 1) & (GameSide.squad == self) & (GameSide.id == Game.winner)
-        ).count()
-
-        losses = GameSide.select(GameSide.id).join(Game).where(
-            (Game.is_completed == 1) & (Game.is_confirmed == 1) & (Game.is_ranked == 1) & (GameSide.squad == self) & (GameSide.id != Game.winner)
-        ).count()
-
-        return (wins, losses)
+        record = SquadRecord.get_or_none(SquadRecord.squad_id == self.id)
+        return (record.wins, record.losses) if record else (0, 0)
 
     def get_members(self):
         members = [member.player for member in self.squadmembers]
@@ -2405,6 +2613,10 @@ class GameSide(BaseModel):
     position = SmallIntegerField(null=False, unique=False, default=1)
     win_confirmed = BooleanField(default=False)
     team_chan_external_server = BitField(unique=False, null=True, default=None)
+    roster_signature = TextField(null=True, default=None)  # see roster_signature(), maintained by lineup_roster_signature trigger
+    filled = SmallIntegerField(default=0)  # number of lineups on this side, maintained by lineup_roster_signature trigger
+
+    trigger_fields = ('roster_signature', 'filled')
 
     def has_same_players_as(self, gameside):
         # Given side1.has_same_players_as(side2)
@@ -2535,6 +2747,59 @@ def ordered_player_list(self):
         return player_list
 
 
+# GameLog entries are buffered in memory and written in batches by polygames.task_flush_gamelog()
+# until that task is running (or if it has stopped) GameLog.write() goes straight to the database
+gamelog_buffer = []  # list of row dicts waiting to be inserted
+gamelog_buffer_lock = threading.Lock()
+gamelog_buffer_enabled = False
+gamelog_flush_size = 50  # flush once this many entries are waiting
+gamelog_flush_interval = 10  # or once the oldest waiting entry is this many seconds old
+
+
+class SplitSide:
+    # Stands in for a GameSide when Game.get_side_win_chances() scores a hypothetical split from Game.balanced_splits()
+    def __init__(self, elo_list):
+        self.lineup = elo_list
+
+    adjusted_elo = GameSide.adjusted_elo
+
+
+class GameChannel(BaseModel):
+    # Maps each discord channel created for a game (GameSide.team_chan or Game.game_chan) to its game
+    channel_id = BitField(unique=True, null=False)
+    game = ForeignKeyField(Game, null=False, backref='channels', on_delete='CASCADE')
+    gameside = ForeignKeyField(GameSide, null=True, backref='channels', on_delete='CASCADE')
+
+    registry = None  # {channel_id: game_id} for all rows, loaded on first use and then kept current by register()/unregister()
+
+    def load_registry():
+        perf.record_cache_lookup('game_channel_registry', hit=GameChannel.registry is not None)  # miss = registry loaded from the database
+        if GameChannel.registry is None:
+            GameChannel.registry = {chan_id: game_id for chan_id, game_id in GameChannel.select(GameChannel.channel_id, GameChannel.game).tuples()}
+            logger.debug(f'Loaded GameChannel registry with {len(GameChannel.registry)} channels')
+        return GameChannel.registry
+
+    def game_id_for_channel(chan_id: int):
+        return GameChannel.load_registry().get(chan_id, None)
+
+    def is_game_channel(chan_id: int):
+        return chan_id in GameChannel.load_registry()
+
+    def register(chan_id: int, game, gameside=None):
+        GameChannel.insert(channel_id=chan_id, game=game, gameside=gameside).on_conflict(
+            conflict_target=[GameChannel.channel_id],
+            update={GameChannel.game: game, GameChannel.gameside: gameside}
+        ).execute()
+        GameChannel.load_registry()[chan_id] = game.id
+
+    def unregister(chan_id: int):
+        GameChannel.delete().where(GameChannel.channel_id == chan_id).execute()
+        GameChannel.forget(chan_id)
+
+    def forget(chan_id: int):
+        GameChannel.load_registry().pop(chan_id, None)
+
+
 class GameLog(BaseModel):
     message = TextField(null=True)
     message_ts = DateTimeField(default=datetime.datetime.now)
@@ -2555,14 +2820,51 @@ def member_string(member):
             d_id = member.discord_id
         return f'**{discord.utils.escape_markdown(name)}** (`{d_id}`)'
 
-    def write(message, guild_id, game_id=0, is_protected=False):
+    def write(message, guild_id, game_id=0, is_protected=False, sync=False):
+        # sync=True writes immediately and returns the new GameLog record, otherwise the entry is queued and None is returned
+        # Entries written inside a db.atomic() block are always written immediately, so they are rolled back along with it
         if game_id:
             message = f'__{str(game_id)}__ - {message}'
 
-        return GameLog.create(guild_id=guild_id, message=message, is_protected=is_protected)
+        if sync or not gamelog_buffer_enabled or db.in_transaction():
+            return GameLog.create(guild_id=guild_id, message=message, is_protected=is_protected)
+
+        with gamelog_buffer_lock:
+            gamelog_buffer.append({'guild_id': guild_id, 'message': message, 'is_protected': is_protected, 'message_ts': datetime.datetime.now()})
+        return None
+
+    def flush_is_due():
+        with gamelog_buffer_lock:
+            if not gamelog_buffer:
+                return False
+            oldest_age = (datetime.datetime.now() - gamelog_buffer[0]['message_ts']).total_seconds()
+            return len(gamelog_buffer) >= gamelog_flush_size or oldest_age >= gamelog_flush_interval
+
+    def flush_buffer():
+        # write all queued entries with one multi-row insert. returns number of entries written
+        with gamelog_buffer_lock:
+            rows = gamelog_buffer.copy()
+            gamelog_buffer.clear()
+
+        if not rows:
+            return 0
+
+        try:
+            with db.atomic():
+                GameLog.insert_many(rows).execute()
+        except DatabaseError as e:
+            logger.error(f'GameLog.flush_buffer: could not write {len(rows)} entries, requeueing: {e}')
+            with gamelog_buffer_lock:
+                gamelog_buffer[:0] = rows
+            return 0
+
+        logger.debug(f'GameLog.flush_buffer: wrote {len(rows)} entries')
+        return len(rows)
 
     def search(keywords=None, negative_keyword=None, guild_id=None, limit=500):
 
+        GameLog.flush_buffer()  # so that very recent entries are included. Blocks, so callers should run search() in a DB thread
+
         if not keywords:
             keywords = '%'  # Wildcard/return all matches
         else:
@@ -2660,15 +2962,232 @@ def emoji_str(self):
             return ''
 
 
-with db.connection_context():
-    db.create_tables([Configuration, Team, DiscordMember, Game, Player, Tribe, Squad, GameSide, SquadMember, Lineup, GameLog])
-    # Only creates missing tables so should be safe to run each time
+class RecordView(BaseModel):
+    # Base for the read-only win/loss materialized views created by migrations/v005_record_views.py. Counts only change when
+    # a ranked result is confirmed or reversed, so those mark the views stale and polygames.task_refresh_records() refreshes
+    # them all once no further changes have come in for refresh_delay seconds
 
-    try:
-        # Creates deferred FK http://docs.peewee-orm.com/en/latest/peewee/models.html#circular-foreign-key-dependencies
-        Game._schema.create_foreign_key(Game.winner)
-    except (ProgrammingError, DuplicateObject):
-        pass
-        # Will throw one of above exceptions if foreign key already exists - exception depends on which version of psycopg2 is running
-        # if exception is caught inside a transaction then the transaction will be rolled back (create_tables reverted),
-        # so using the connection_context() and this section is not run using any transactions
+    views = ['player_record', 'discordmember_record', 'team_record', 'squad_record']
+    stale_since = None  # time of the first result change not yet refreshed into the views
+    last_change = None
+    refresh_delay = 15
+    refresh_max_delay = 120  # refresh anyway if results keep changing for this long
+
+    wins = IntegerField()
+    losses = IntegerField()
+
+    def mark_stale():
+        now = datetime.datetime.now()
+        if RecordView.stale_since is None:
+            RecordView.stale_since = now
+        RecordView.last_change = now
+
+    def refresh_is_due():
+        if RecordView.stale_since is None:
+            return False
+        now = datetime.datetime.now()
+        return ((now - RecordView.last_change).total_seconds() >= RecordView.refresh_delay or
+                (now - RecordView.stale_since).total_seconds() >= RecordView.refresh_max_delay)
+
+    def refresh_all():
+        # CONCURRENTLY so reads of the old contents are not blocked while a view is rebuilt.
+        # Cleared first so that a result changing during the refresh marks the views stale again
+        stale_since, RecordView.stale_since = RecordView.stale_since, None
+        try:
+            for view in RecordView.views:
+                db.execute_sql(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view};')
+        except DatabaseError:
+            if RecordView.stale_since is None:
+                RecordView.stale_since = stale_since
+            raise
+
+
+class PlayerRecord(RecordView):
+    player_id = IntegerField(primary_key=True)
+
+    class Meta:
+        table_name = 'player_record'
+
+
+class DiscordMemberRecord(RecordView):
+    discord_member_id = IntegerField()
+    guild_id = BitField()
+
+    class Meta:
+        table_name = 'discordmember_record'
+        primary_key = False
+
+
+class TeamRecord(RecordView):
+    team_id = IntegerField()
+    date = DateField()
+
+    class Meta:
+        table_name = 'team_record'
+        primary_key = False
+
+
+class SquadRecord(RecordView):
+    squad_id = IntegerField(primary_key=True)
+
+    class Meta:
+        table_name = 'squad_record'
+
+
+class Tournament(BaseModel):
+    name = TextField(null=False)
+    guild_id = BitField(unique=False, null=False)
+    host = ForeignKeyField(Player, null=True, backref='hosted_tournaments', on_delete='SET NULL')
+    format = TextField(default='swiss')  # swiss, single (elimination), double (elimination)
+    rounds = SmallIntegerField(null=True)  # planned number of rounds for swiss. elimination runs until one participant remains
+    current_round = SmallIntegerField(default=0)
+    is_ranked = BooleanField(default=True)
+    is_mobile = BooleanField(default=True)
+    is_completed = BooleanField(default=False)
+    created_ts = DateTimeField(default=datetime.datetime.now)
+
+    formats = ('swiss', 'single', 'double')
+    max_losses = {'swiss': None, 'single': 1, 'double': 2}
+
+    def alive_participants(self):
+        # active participants not yet eliminated, best seed first
+        q = TournamentParticipant.select(TournamentParticipant, Player).join(Player).where(
+            (TournamentParticipant.tournament == self) & (TournamentParticipant.is_active == 1)
+        ).order_by(TournamentParticipant.seed)
+        max_losses = Tournament.max_losses[self.format]
+        return [p for p in q if max_losses is None or p.losses < max_losses]
+
+    def played_signatures(self):
+        # roster_signature() of every pairing so far, so pairing can avoid rematches with set lookups instead of querying each candidate
+        return set(tg.roster_signature for tg in TournamentGame.select(TournamentGame.roster_signature).join(TournamentRound).where(
+            TournamentRound.tournament == self
+        ))
+
+    def round_is_complete(self):
+        if not self.current_round:
+            return True
+        return not TournamentGame.select().join(TournamentRound).where(
+            (TournamentRound.tournament == self) & (TournamentRound.number == self.current_round) & (TournamentGame.winner.is_null(True))
+        ).exists()
+
+    def standings(self):
+        # [(TournamentParticipant, points, buchholz)] best first. Points are wins plus byes, kept current by TournamentGame.record_result()
+        # Buchholz is the sum of each participant's opponents' points, from one query of this tournament's games
+        participants = list(TournamentParticipant.select(TournamentParticipant, Player).join(Player).where(TournamentParticipant.tournament == self))
+        points = {p.id: p.wins + p.byes for p in participants}
+        buchholz = {p.id: 0 for p in participants}
+        for side1_id, side2_id in TournamentGame.select(TournamentGame.side1, TournamentGame.side2).join(TournamentRound).where(
+                TournamentRound.tournament == self).tuples():
+            buchholz[side1_id] += points.get(side2_id, 0)
+            buchholz[side2_id] += points.get(side1_id, 0)
+
+        ranked = [(p, points[p.id], buchholz[p.id]) for p in participants]
+        return sorted(ranked, key=lambda r: (not r[0].is_active, -r[1], -r[2], r[0].seed))
+
+    def create_round(self, pairings, byes=(), expiration_days: int = 7):
+        # pairings = [(TournamentParticipant, TournamentParticipant, bracket), ...] with the higher standing participant first, who hosts the game
+        # Creates the round and one full pending game per pairing with a few multi-row inserts, returns [Game.id] in pairing order
+
+        expiration = datetime.datetime.now() + datetime.timedelta(days=expiration_days)
+        with db.atomic():
+            self.current_round = self.current_round + 1
+            self.save()
+            tournament_round = TournamentRound.create(tournament=self, number=self.current_round)
+            notes = f'{self.name} - round {self.current_round}'
+
+            # RETURNING rows are not guaranteed to come back in VALUES order, so they are matched up by key rather than position.
+            # Each player is in at most one pairing per round, so the host identifies the game
+            game_by_host = {g.host_id: g.id for g in Game.insert_many([
+                {'guild_id': self.guild_id, 'host': p1.player_id, 'is_pending': True, 'is_ranked': self.is_ranked, 'is_mobile': self.is_mobile,
+                 'size': [1, 1], 'notes': notes, 'expiration': expiration} for p1, p2, _ in pairings
+            ]).returning(Game.id, Game.host).execute()}
+            game_ids = [game_by_host[p1.player_id] for p1, p2, _ in pairings]
+
+            side_by_position = {(s.game_id, s.position): s.id for s in GameSide.insert_many([
+                {'game': game_id, 'size': 1, 'position': position}
+                for game_id in game_ids for position in (1, 2)
+            ]).returning(GameSide.id, GameSide.game, GameSide.position).execute()}
+
+            Lineup.insert_many([
+                {'game': game_id, 'gameside': side_by_position[(game_id, position)], 'player': participant.player_id}
+                for game_id, (p1, p2, _) in zip(game_ids, pairings) for position, participant in ((1, p1), (2, p2))
+            ]).execute()
+
+            TournamentGame.insert_many([
+                {'round': tournament_round, 'game': game_id, 'bracket': bracket, 'position': count + 1, 'side1': p1, 'side2': p2,
+                 'roster_signature': roster_signature([p1.player_id, p2.player_id])}
+                for count, (game_id, (p1, p2, bracket)) in enumerate(zip(game_ids, pairings))
+            ]).execute()
+
+            if byes:
+                TournamentParticipant.update(byes=TournamentParticipant.byes + 1).where(TournamentParticipant.id.in_([p.id for p in byes])).execute()
+
+        logger.info(f'Tournament {self.id} round {self.current_round}: created games {game_ids}, byes for {[p.id for p in byes]}')
+        return game_ids
+
+
+class TournamentParticipant(BaseModel):
+    tournament = ForeignKeyField(Tournament, null=False, backref='participants', on_delete='CASCADE')
+    player = ForeignKeyField(Player, null=False, backref='tournament_entries', on_delete='CASCADE')
+    seed = SmallIntegerField(default=0)  # 1 is the top seed. Assigned by ELO when the first round is created
+    wins = SmallIntegerField(default=0)
+    losses = SmallIntegerField(default=0)
+    byes = SmallIntegerField(default=0)
+    bracket_position = SmallIntegerField(null=True)  # winners bracket position for elimination formats, see pairings.elimination_pairings()
+    is_active = BooleanField(default=True)  # False once dropped from the tournament
+
+    class Meta:
+        indexes = ((('tournament', 'player'), True),)   # Trailing comma is required
+
+
+class TournamentRound(BaseModel):
+    tournament = ForeignKeyField(Tournament, null=False, backref='tournament_rounds', on_delete='CASCADE')
+    number = SmallIntegerField(null=False)
+    created_ts = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = ((('tournament', 'number'), True),)   # Trailing comma is required
+
+
+class TournamentGame(BaseModel):
+    round = ForeignKeyField(TournamentRound, null=False, backref='games', on_delete='CASCADE')
+    game = ForeignKeyField(Game, null=False, unique=True, backref='tournament_games', on_delete='CASCADE')
+    bracket = TextField(default='W')  # W = winners/swiss, L = losers bracket, F = grand final
+    position = SmallIntegerField(default=0)  # table number within the round
+    side1 = ForeignKeyField(TournamentParticipant, null=False, backref='games_as_side1', on_delete='CASCADE')
+    side2 = ForeignKeyField(TournamentParticipant, null=False, backref='games_as_side2', on_delete='CASCADE')
+    winner = ForeignKeyField(TournamentParticipant, null=True, backref='games_won', on_delete='SET NULL')
+    roster_signature = TextField(null=False)  # roster_signature() of both players, used to avoid rematches
+
+    def record_result(game, winning_side):
+        # Called by Game.declare_winner() when a win is confirmed. Updates the participants' standings in place
+        tournament_game = TournamentGame.get_or_none(TournamentGame.game == game.id)
+        if not tournament_game:
+            return
+
+        winning_player_ids = [l.player_id for l in winning_side.lineup]
+        if tournament_game.side1.player_id in winning_player_ids:
+            winner, loser = tournament_game.side1_id, tournament_game.side2_id
+        else:
+            winner, loser = tournament_game.side2_id, tournament_game.side1_id
+
+        if tournament_game.winner_id == winner:
+            return
+        with db.atomic():
+            TournamentGame.clear_result(game)
+            TournamentParticipant.update(wins=TournamentParticipant.wins + 1).where(TournamentParticipant.id == winner).execute()
+            TournamentParticipant.update(losses=TournamentParticipant.losses + 1).where(TournamentParticipant.id == loser).execute()
+            TournamentGame.update(winner=winner).where(TournamentGame.id == tournament_game.id).execute()
+        logger.debug(f'Recorded tournament result for game {game.id}: participant {winner} beat {loser}')
+
+    def clear_result(game):
+        # Reverses record_result() when a confirmed win is reversed or the game deleted. Safe to call when no result is recorded
+        tournament_game = TournamentGame.get_or_none((TournamentGame.game == game.id) & (TournamentGame.winner.is_null(False)))
+        if not tournament_game:
+            return
+        winner = tournament_game.winner_id
+        loser = tournament_game.side2_id if winner == tournament_game.side1_id else tournament_game.side1_id
+        with db.atomic():
+            TournamentParticipant.update(wins=TournamentParticipant.wins - 1).where(TournamentParticipant.id == winner).execute()
+            TournamentParticipant.update(losses=TournamentParticipant.losses - 1).where(TournamentParticipant.id == loser).execute()
+            TournamentGame.update(winner=None).where(TournamentGame.id == tournament_game.id).execute()
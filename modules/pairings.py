@@ -0,0 +1,132 @@
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# Pairing engine for tournaments. Works only on player IDs so it can be run and benchmarked without a database:
+# python -m modules.pairings
+
+
+def pair_key(a: int, b: int):
+    # same string as models.roster_signature([a, b]), so the signatures of a tournament's games can be used as the set of pairs already played
+    return f'{a},{b}' if a < b else f'{b},{a}'
+
+
+def swiss_pairings(standings, played, had_bye=frozenset()):
+    # standings - player IDs ordered best first (score, tiebreak, seed)
+    # played - set of pair_key() for pairs that have already met
+    # had_bye - player IDs that have already received a bye
+    # Returns ([(id, id), ...] ordered by standing, bye_id or None)
+    #
+    # Each unpaired participant, best first, is paired with the next-closest participant in the standings they have not
+    # already played. If that leaves the rest unpairable, the search backs up and tries the next opponent.
+    # Almost every round pairs without backing up, so this is close to linear in the number of participants.
+
+    standings = list(standings)
+    bye = None
+    if len(standings) % 2:
+        # lowest ranked participant who has not had one yet gets the bye
+        bye = next((p for p in reversed(standings) if p not in had_bye), standings[-1])
+        standings.remove(bye)
+
+    pairs = _pair_avoiding_rematches(standings, played, budget=len(standings) * 50)
+    if pairs is None:
+        logger.warning(f'swiss_pairings: no pairing of {len(standings)} participants avoids all rematches. Pairing in standings order.')
+        pairs = [(standings[i], standings[i + 1]) for i in range(0, len(standings), 2)]
+    return pairs, bye
+
+
+def _pair_avoiding_rematches(remaining, played, budget: int):
+    # Depth-first search for a perfect pairing of remaining with no pair in played. Returns None if none is found within budget steps
+    pairs, choices = [], []  # choices[i] is (the remaining list before pair i, index of opponent tried)
+    steps = 0
+
+    while remaining:
+        top = remaining[0]
+        start = choices.pop()[1] + 1 if len(choices) > len(pairs) else 1
+        for i in range(start, len(remaining)):
+            steps += 1
+            if pair_key(top, remaining[i]) not in played:
+                choices.append((remaining, i))
+                pairs.append((top, remaining[i]))
+                remaining = remaining[1:i] + remaining[i + 1:]
+                break
+        else:
+            # no opponent left for top - undo the previous pair and have it try its next opponent
+            if not pairs or steps > budget:
+                return None
+            pairs.pop()
+            remaining = choices[-1][0]
+
+    return pairs
+
+
+def bracket_order(bracket_size: int):
+    # Seed numbers (1-based) in bracket order for a power-of-two bracket, ie. 8 -> [1, 8, 4, 5, 2, 7, 3, 6]
+    # so that consecutive pairs are first round games and the top seeds can only meet in later rounds
+    order = [1]
+    while len(order) < bracket_size:
+        size = len(order) * 2
+        order = [seed for s in order for seed in (s, size + 1 - s)]
+    return order
+
+
+def initial_bracket_positions(seeded_ids):
+    # seeded_ids - player IDs, best seed first. Returns {player_id: bracket position}
+    # Positions with no participant (when there are not a power of two of them) are byes for the neighbouring seed
+    bracket_size = 1
+    while bracket_size < len(seeded_ids):
+        bracket_size *= 2
+    return {seeded_ids[seed - 1]: position for position, seed in enumerate(bracket_order(bracket_size)) if seed <= len(seeded_ids)}
+
+
+def elimination_pairings(positions):
+    # positions - {player_id: bracket position} for participants still alive in a bracket
+    # Bracket positions 2k and 2k+1 play each other. Returns ([(id, id), ...], [ids advancing on a bye])
+    # Winners (and byes) take position // 2 into the next round.
+    slots = {}
+    for player_id, position in positions.items():
+        slots.setdefault(position // 2, []).append((position, player_id))
+
+    pairs, byes = [], []
+    for slot in sorted(slots):
+        entrants = [player_id for _, player_id in sorted(slots[slot])]
+        if len(entrants) == 2:
+            pairs.append((entrants[0], entrants[1]))
+        else:
+            byes.extend(entrants)
+    return pairs, byes
+
+
+if __name__ == '__main__':
+    # Benchmark: nine Swiss rounds for 256 participants with random results
+    import random
+    import time
+
+    random.seed(1)
+    participant_count, round_count = 256, 9
+    points = {p: 0 for p in range(participant_count)}
+    played, had_bye = set(), set()
+
+    for round_number in range(1, round_count + 1):
+        standings = sorted(points, key=lambda p: (-points[p], p))
+        t = time.perf_counter()
+        pairs, bye = swiss_pairings(standings, played, had_bye)
+        elapsed = time.perf_counter() - t
+        rematches = sum(1 for a, b in pairs if pair_key(a, b) in played)
+        print(f'round {round_number}: paired {len(pairs)} games in {elapsed * 1000:.1f}ms with {rematches} rematches')
+        for a, b in pairs:
+            played.add(pair_key(a, b))
+            points[random.choice((a, b))] += 1
+        if bye is not None:
+            had_bye.add(bye)
+            points[bye] += 1
+
+    print(f'bracket_order(16): {bracket_order(16)}')
+    positions = initial_bracket_positions(list(range(11)))
+    round_number = 1
+    while len(positions) > 1:
+        pairs, byes = elimination_pairings(positions)
+        print(f'elimination round {round_number}: {len(pairs)} games, byes for {byes}')
+        winners = [random.choice(pair) for pair in pairs] + byes
+        positions = {p: positions[p] // 2 for p in winners}
+        round_number += 1
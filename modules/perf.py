@@ -0,0 +1,186 @@
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# Per-command instrumentation. bot.py starts a CommandStats in its before_invoke hook and records it in after_invoke.
+# models.db reports every query through record_query(), and the DB executor reports queue waits through record_executor_wait().
+# The stats object follows the command through contextvars, including into executor threads (see dbexecutor.DBExecutor.submit)
+# Background task runs, cache lookups and event loop lag are tracked here too, and everything is exported by modules/metrics.py
+
+histogram_bounds_ms = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+current_command = contextvars.ContextVar('current_command', default=None)
+
+
+class CommandStats:
+    # Measurements for one command invocation
+
+    __slots__ = ('name', 'started', 'wall_time', 'db_time', 'queries', 'rows', 'executor_wait', 'lock')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started, self.wall_time = time.perf_counter(), None  # wall_time is set when the command finishes
+        self.db_time, self.queries, self.rows, self.executor_wait = 0.0, 0, 0, 0.0
+        self.lock = threading.Lock()  # executor threads can add queries while the command itself is also running them
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(histogram_bounds_ms)
+        self.total = 0.0
+
+    def add(self, value_ms: float):
+        self.total += value_ms
+        for i, bound in enumerate(histogram_bounds_ms):
+            if value_ms <= bound:
+                self.counts[i] += 1
+                return
+
+    def percentile(self, p: float):
+        # upper bound of the bucket holding the p-th percentile, ie. percentile(0.95) == 250 means 95% took 250ms or less
+        target, seen = sum(self.counts) * p, 0
+        for bound, count in zip(histogram_bounds_ms, self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0
+
+
+class CommandSummary:
+    # Running totals and histograms for every invocation of one command
+
+    def __init__(self):
+        self.count, self.errors = 0, 0
+        self.wall, self.db = Histogram(), Histogram()
+        self.queries, self.max_queries, self.rows, self.executor_wait = 0, 0, 0, 0.0
+
+    def add(self, stats: CommandStats, failed: bool):
+        self.count += 1
+        self.errors += 1 if failed else 0
+        self.wall.add(stats.wall_time * 1000)
+        self.db.add(stats.db_time * 1000)
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.rows += stats.rows
+        self.executor_wait += stats.executor_wait
+
+    def describe(self):
+        return (f'{self.count} calls, p50 {self.wall.percentile(0.5):g}ms p95 {self.wall.percentile(0.95):g}ms, '
+                f'avg {self.wall.total / self.count:.0f}ms wall / {self.db.total / self.count:.0f}ms db / {self.queries / self.count:.1f} queries '
+                f'(max {self.max_queries}) / {self.rows / self.count:.0f} rows / {self.executor_wait * 1000 / self.count:.0f}ms executor wait'
+                f'{f", {self.errors} errors" if self.errors else ""}')
+
+
+class TaskSummary:
+    # Totals for one background task, ie. task_confirm_auto
+
+    def __init__(self):
+        self.runs, self.errors = 0, 0
+        self.total_time, self.last_duration, self.last_finished = 0.0, None, None
+
+    def add(self, elapsed: float, failed: bool):
+        self.runs += 1
+        self.errors += 1 if failed else 0
+        self.total_time += elapsed
+        self.last_duration, self.last_finished = elapsed, time.time()
+
+
+summaries = {}  # command qualified name -> CommandSummary
+summaries_since = time.time()
+task_summaries = {}  # background task name -> TaskSummary
+cache_lookups = {}  # cache name -> [hits, misses]
+loop_lag = Histogram()  # ms the event loop was late to wake a sleeping coroutine, see watchdog.LoopWatchdog
+loop_lag_max = 0.0
+
+in_flight_commands = {}  # id(CommandStats) -> CommandStats for commands that have started but not finished
+in_flight_tasks = {}  # background task name -> perf_counter() its current pass started
+
+db_totals = {'queries': 0, 'seconds': 0.0, 'rows': 0}  # every query, whether or not a command ran it
+totals_lock = threading.Lock()  # db_totals and cache_lookups are updated from executor threads
+
+
+def command_started(name: str):
+    stats = CommandStats(name)
+    in_flight_commands[id(stats)] = stats
+    return current_command.set(stats)
+
+
+def command_finished(failed: bool = False):
+    stats = current_command.get()
+    if not stats:
+        return None
+    current_command.set(None)
+    in_flight_commands.pop(id(stats), None)
+    stats.wall_time = time.perf_counter() - stats.started
+    summaries.setdefault(stats.name, CommandSummary()).add(stats, failed)
+    return stats
+
+
+def record_query(elapsed: float, rows: int):
+    with totals_lock:
+        db_totals['queries'] += 1
+        db_totals['seconds'] += elapsed
+        db_totals['rows'] += max(rows, 0)
+
+    stats = current_command.get()
+    if stats:
+        with stats.lock:
+            stats.db_time += elapsed
+            stats.queries += 1
+            stats.rows += max(rows, 0)  # rowcount is -1 for statements that return no row count
+
+
+def record_executor_wait(elapsed: float):
+    stats = current_command.get()
+    if stats:
+        with stats.lock:
+            stats.executor_wait += elapsed
+
+
+@contextlib.contextmanager
+def timed_task(name: str):
+    # with perf.timed_task('task_confirm_auto'): wrapped around one pass of a background task loop (not its sleeps)
+    started, failed = time.perf_counter(), True
+    in_flight_tasks[name] = started
+    try:
+        yield
+        failed = False
+    finally:
+        in_flight_tasks.pop(name, None)
+        task_summaries.setdefault(name, TaskSummary()).add(time.perf_counter() - started, failed)
+
+
+def record_cache_lookup(name: str, hit: bool):
+    with totals_lock:
+        counts = cache_lookups.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+def record_loop_lag(elapsed: float):
+    global loop_lag_max
+    loop_lag.add(elapsed * 1000)
+    loop_lag_max = max(loop_lag_max, elapsed)
+
+
+def describe_in_flight():
+    # 'commands lb (1.2s), tasks task_print_matchlist (3.0s)' - called from the watchdog thread, so copies before iterating
+    now = time.perf_counter()
+    commands = [f'{stats.name} ({now - stats.started:.1f}s)' for stats in list(in_flight_commands.values())]
+    tasks = [f'{name} ({now - started:.1f}s)' for name, started in list(in_flight_tasks.items())]
+    return ', '.join(filter(None, [f'commands {", ".join(commands)}' if commands else '', f'tasks {", ".join(tasks)}' if tasks else ''])) or 'no command or task'
+
+
+def top_commands(sort_by: str = 'wall', limit: int = 10):
+    # [(command name, CommandSummary)] by total wall time, total db time or call count
+    sort_keys = {'wall': lambda s: s.wall.total, 'db': lambda s: s.db.total, 'count': lambda s: s.count}
+    return sorted(summaries.items(), key=lambda item: sort_keys[sort_by](item[1]), reverse=True)[:limit]
+
+
+def reset():
+    global summaries_since
+    summaries.clear()
+    summaries_since = time.time()
@@ -0,0 +1,191 @@
+import datetime
+import importlib
+import logging
+import pkgutil
+import time
+from peewee import *
+import modules.models as models
+import migrations
+
+logger = logging.getLogger('polybot.' + __name__)
+db = models.db
+
+# Versioned schema migrations. Each module in migrations/ named vNNN_description.py defines a list of steps, applied in
+# version order by migrator.py and recorded in the schemamigration table. The bot itself only checks the recorded version.
+#
+# Steps should be safe to re-run (IF NOT EXISTS, CREATE OR REPLACE...). Consecutive Sql/Python steps run in a single
+# transaction, but ConcurrentIndex and Backfill steps run outside one, so a migration that fails after one of those
+# will run again from the start.
+
+
+class SchemaMigration(models.BaseModel):
+    version = IntegerField(primary_key=True)
+    name = TextField(null=False)
+    applied_ts = DateTimeField(default=datetime.datetime.now)
+
+
+class Sql:
+    transactional = True
+
+    def __init__(self, sql: str):
+        self.sql = sql
+
+    def describe(self):
+        return ' '.join(self.sql.split())
+
+    def run(self, db):
+        db.execute_sql(self.sql)
+
+
+class Python:
+    # Arbitrary schema work that is easier through peewee, ie. create_tables()
+
+    transactional = True
+
+    def __init__(self, func, description: str, transactional: bool = True):
+        self.func, self.description, self.transactional = func, description, transactional
+
+    def describe(self):
+        return self.description
+
+    def run(self, db):
+        self.func(db)
+
+
+class ConcurrentIndex:
+    # CREATE INDEX CONCURRENTLY, which does not block writes while it builds but cannot run inside a transaction.
+    # A failed concurrent build leaves an invalid index behind, which is dropped and rebuilt.
+
+    transactional = False
+
+    def __init__(self, name: str, definition: str, unique: bool = False):
+        self.name, self.definition, self.unique = name, definition, unique
+
+    def describe(self):
+        return f'CREATE {"UNIQUE " if self.unique else ""}INDEX CONCURRENTLY IF NOT EXISTS {self.name} ON {self.definition};'
+
+    def run(self, db):
+        # CREATE INDEX CONCURRENTLY refuses to run inside a transaction. Depending on the peewee version the connection
+        # may already be in autocommit mode, so whatever mode it was in is put back afterwards
+        conn = db.connection()
+        prev = conn.autocommit
+        conn.autocommit = True
+        try:
+            self.build(db)
+        finally:
+            conn.autocommit = prev
+
+    def build(self, db):
+        invalid = db.execute_sql('SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid AND c.relname = %s;', (self.name,))
+        if invalid.fetchone():
+            logger.warning(f'Dropping invalid index {self.name} left by an earlier failed build')
+            db.execute_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {self.name};')
+        db.execute_sql(self.describe())
+
+
+class Backfill:
+    # UPDATE table SET assignments [WHERE where] in primary key ranges of batch_size rows. Each batch commits on its own and is
+    # followed by a pause, so row locks are only held on one batch at a time and the bot's own writes can go through in between.
+    # Literal % in assignments/where must be written %%
+
+    transactional = False
+
+    def __init__(self, table: str, assignments: str, where: str = None, batch_size: int = 5000, pause: float = 0.25):
+        self.table, self.assignments, self.where = table, assignments, where
+        self.batch_size, self.pause = batch_size, pause
+
+    def describe(self):
+        where_str = f' AND ({self.where})' if self.where else ''
+        return ' '.join(f'UPDATE {self.table} SET {self.assignments} WHERE id >= %s AND id < %s{where_str};'.split()) + f' -- in batches of {self.batch_size}'
+
+    def run(self, db):
+        low, high = db.execute_sql(f'SELECT MIN(id), MAX(id) FROM {self.table};').fetchone()
+        if low is None:
+            return
+        where_str = f' AND ({self.where})' if self.where else ''
+        sql = f'UPDATE {self.table} SET {self.assignments} WHERE id >= %s AND id < %s{where_str};'
+        updated, started = 0, time.time()
+        for batch_start in range(low, high + 1, self.batch_size):
+            with db.atomic():
+                updated += db.execute_sql(sql, (batch_start, batch_start + self.batch_size)).rowcount
+            if batch_start + self.batch_size <= high:
+                logger.debug(f'Backfill {self.table}: {batch_start + self.batch_size - low} of {high - low + 1} ids, {updated} rows updated')
+                time.sleep(self.pause)
+        logger.info(f'Backfill {self.table}: {updated} rows updated in {time.time() - started:.0f}s')
+
+
+class Migration:
+    def __init__(self, version: int, name: str, steps):
+        self.version, self.name, self.steps = version, name, steps
+
+    def __repr__(self):
+        return f'v{self.version:03} {self.name}'
+
+
+def load_migrations():
+    # all migrations/vNNN_*.py modules, ordered by version
+    found = []
+    for module_info in pkgutil.iter_modules(migrations.__path__):
+        if not module_info.name.startswith('v'):
+            continue
+        version, _, name = module_info.name[1:].partition('_')
+        module = importlib.import_module(f'migrations.{module_info.name}')
+        found.append(Migration(version=int(version), name=name, steps=module.steps))
+    found.sort(key=lambda m: m.version)
+
+    versions = [m.version for m in found]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f'Duplicate migration versions in {versions}')
+    return found
+
+
+def latest_version():
+    return load_migrations()[-1].version
+
+
+def current_version():
+    # highest applied migration, or 0 for a database that predates versioned migrations (or is empty)
+    if not SchemaMigration.table_exists():
+        return 0
+    return SchemaMigration.select(fn.MAX(SchemaMigration.version)).scalar() or 0
+
+
+def apply(migration: Migration, dry_run: bool = False):
+    logger.info(f'{"Dry run of" if dry_run else "Applying"} migration {migration}')
+    if dry_run:
+        for step in migration.steps:
+            print(f'    {"" if step.transactional else "(outside transaction) "}{step.describe()}')
+        return
+
+    steps = list(migration.steps)
+    while steps:
+        if steps[0].transactional:
+            batch = []
+            while steps and steps[0].transactional:
+                batch.append(steps.pop(0))
+            with db.atomic():
+                for step in batch:
+                    step.run(db)
+        else:
+            steps.pop(0).run(db)
+
+    with db.atomic():
+        SchemaMigration.create_table(safe=True)
+        SchemaMigration.insert(version=migration.version, name=migration.name).on_conflict_ignore().execute()
+
+
+def migrate(target: int = None, dry_run: bool = False):
+    # Applies pending migrations up to target (default latest). Returns the list of migrations applied
+    pending = [m for m in load_migrations() if m.version > current_version() and (target is None or m.version <= target)]
+    for migration in pending:
+        started = time.time()
+        apply(migration, dry_run=dry_run)
+        if not dry_run:
+            logger.info(f'Applied migration {migration} in {time.time() - started:.1f}s')
+    return pending
+
+
+def verify_schema_version():
+    # Returns (current version, latest version). The bot refuses to start unless they match
+    with db.connection_context():
+        return current_version(), latest_version()
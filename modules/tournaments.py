@@ -0,0 +1,291 @@
+from discord.ext import commands
+import modules.models as models
+import modules.utilities as utilities
+import modules.pairings as pairings
+import settings
+import peewee
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+
+class PolyTournament(commands.Converter):
+    async def convert(self, ctx, tournament_id: int):
+
+        tournament_id = tournament_id.strip('#')
+
+        try:
+            tournament = models.Tournament.get(id=tournament_id)
+        except peewee.DoesNotExist:
+            await ctx.send(f'Tournament with ID {tournament_id} cannot be found. Use `{ctx.prefix}tournaments` to list tournaments.')
+            raise commands.UserInputError()
+        except (ValueError, peewee.DataError):
+            await ctx.send(f'Invalid Tournament ID "**{tournament_id}**".')
+            raise commands.UserInputError()
+
+        if tournament.guild_id != ctx.guild.id:
+            await ctx.send(f'Tournament with ID {tournament_id} is associated with a different Discord server.')
+            raise commands.UserInputError()
+        return tournament
+
+
+def build_round(tournament):
+    # Works out the next round of tournament. Returns (pairings, byes) as taken by Tournament.create_round(),
+    # or (None, None) if the tournament is over. Seeds and bracket positions are assigned and saved as a side effect.
+
+    alive = tournament.alive_participants()
+
+    with models.db.atomic():
+        if tournament.current_round == 0:
+            alive.sort(key=lambda p: p.player.elo, reverse=True)
+            bracket_positions = pairings.initial_bracket_positions([p.player_id for p in alive])
+            for seed, participant in enumerate(alive, start=1):
+                participant.seed = seed
+                if tournament.format != 'swiss':
+                    participant.bracket_position = bracket_positions[participant.player_id]
+                participant.save()
+
+    by_player = {p.player_id: p for p in alive}
+    played = tournament.played_signatures()
+    had_bye = {p.player_id for p in alive if p.byes}
+
+    if tournament.format == 'swiss':
+        if tournament.current_round >= tournament.rounds or len(alive) < 2:
+            return None, None
+        standings = [p.player_id for p, _, _ in tournament.standings() if p.player_id in by_player]
+        pairs, bye = pairings.swiss_pairings(standings, played, had_bye)
+        return [(by_player[a], by_player[b], 'W') for a, b in pairs], [by_player[bye]] if bye else []
+
+    if len(alive) < 2:
+        return None, None
+
+    winners_bracket = [p for p in alive if p.losses == 0]
+    losers_bracket = [p for p in alive if p.losses > 0]
+    round_pairings, byes = [], []
+
+    if len(winners_bracket) == 1 and len(losers_bracket) == 1:
+        # grand final. If the winners bracket champion loses, both have one loss and the losers bracket pairing below plays the decider
+        return [(winners_bracket[0], losers_bracket[0], 'F')], []
+
+    if len(winners_bracket) > 1:
+        pairs, bracket_byes = pairings.elimination_pairings({p.player_id: p.bracket_position for p in winners_bracket})
+        round_pairings += [tuple(sorted((by_player[a], by_player[b]), key=lambda p: p.seed)) + ('W',) for a, b in pairs]
+        byes += [by_player[p] for p in bracket_byes]
+        with models.db.atomic():
+            for participant in winners_bracket:
+                participant.bracket_position = participant.bracket_position // 2  # position in next round if they win this one
+                participant.save()
+
+    if len(losers_bracket) > 1:
+        pairs, bye = pairings.swiss_pairings([p.player_id for p in losers_bracket], played, had_bye)
+        round_pairings += [(by_player[a], by_player[b], 'L') for a, b in pairs]
+        byes += [by_player[bye]] if bye else []
+
+    return round_pairings, byes
+
+
+class tournaments(commands.Cog):
+    """
+    Run Swiss and elimination tournaments
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @settings.in_bot_channel()
+    @settings.is_staff_check()
+    @commands.command(usage='format [rounds] [unranked] [steam] Name of Tournament', aliases=['tournament_create'])
+    async def newtournament(self, ctx, *args):
+        """
+        *Staff:* Create a tournament
+        Formats are *swiss* (give the number of rounds), *single* elimination, and *double* elimination. Games are 1v1.
+        Players join with `[p]tjoin`. When signups are done use `[p]nextround` to seed players by ELO and create the first round of games.
+
+        **Examples:**
+        `[p]newtournament swiss 5 Summer Swiss` - 5 round Swiss tournament
+        `[p]newtournament double unranked Winter Cup` - Unranked double elimination tournament
+        `[p]newtournament single steam Steam Showdown` - Single elimination tournament of Steam games
+        """
+        syntax = f'**Example:** `{ctx.prefix}newtournament swiss 5 Summer Swiss`'
+        args = list(args)
+        if not args or args[0].lower() not in models.Tournament.formats:
+            return await ctx.send(f'Tournament format is required - one of: {", ".join(models.Tournament.formats)}\n{syntax}')
+        tournament_format = args.pop(0).lower()
+
+        rounds = None
+        if tournament_format == 'swiss':
+            if not args or not args[0].isdigit() or not 0 < int(args[0]) < 20:
+                return await ctx.send(f'Number of rounds (1-19) is required for a Swiss tournament.\n{syntax}')
+            rounds = int(args.pop(0))
+
+        is_ranked, is_mobile, name_args = True, True, []
+        for arg in args:
+            if arg.lower() == 'unranked':
+                is_ranked = False
+            elif arg.lower() == 'steam':
+                is_mobile = False
+            else:
+                name_args.append(arg)
+
+        name = utilities.escape_everyone_here_roles(' '.join(name_args)[:60].strip())
+        if not name:
+            return await ctx.send(f'Tournament name is required.\n{syntax}')
+
+        host, _ = models.Player.get_by_discord_id(discord_id=ctx.author.id, discord_name=ctx.author.name, discord_nick=ctx.author.nick, guild_id=ctx.guild.id)
+        tournament = models.Tournament.create(name=name, guild_id=ctx.guild.id, host=host, format=tournament_format, rounds=rounds, is_ranked=is_ranked, is_mobile=is_mobile)
+        models.GameLog.write(guild_id=ctx.guild.id, message=f'{models.GameLog.member_string(ctx.author)} created tournament {tournament.id} *{name}*')
+        await ctx.send(f'Created {tournament_format} tournament **{name}** with ID {tournament.id}. Players can join with `{ctx.prefix}tjoin {tournament.id}`.')
+
+    @settings.in_bot_channel()
+    @commands.command(usage='tournament_id [player]', aliases=['jointournament'])
+    async def tjoin(self, ctx, tournament: PolyTournament, *, target: str = None):
+        """
+        Join a tournament before it starts
+        Staff can add someone else to a tournament.
+        **Example:**
+        `[p]tjoin 5`
+        """
+        if tournament.current_round or tournament.is_completed:
+            return await ctx.send(f'Tournament {tournament.id} has already started.')
+
+        if target and not settings.is_staff(ctx):
+            return await ctx.send(f'Only server staff can add another player to a tournament.')
+        guild_matches = await utilities.get_guild_member(ctx, target) if target else [ctx.author]
+        if len(guild_matches) != 1:
+            return await ctx.send(f'Could not match *{target}* to exactly one server member. Try using an @Mention.')
+        member = guild_matches[0]
+
+        player, _ = models.Player.get_by_discord_id(discord_id=member.id, discord_name=member.name, discord_nick=member.nick, guild_id=ctx.guild.id)
+        if not player:
+            return await ctx.send(f'*{member.name}* is not registered. Players can register themselves with `{ctx.prefix}setcode POLYTOPIA_CODE`.')
+        if player.is_banned or player.discord_member.is_banned:
+            return await ctx.send(f'**{player.name}** has been **ELO Banned** and cannot join tournaments. :cry:')
+
+        _, created = models.TournamentParticipant.get_or_create(tournament=tournament, player=player)
+        if not created:
+            return await ctx.send(f'**{player.name}** is already in tournament {tournament.id}.')
+        await ctx.send(f'**{player.name}** has joined tournament **{tournament.name}**.')
+
+    @settings.in_bot_channel()
+    @commands.command(usage='tournament_id [player]', aliases=['leavetournament', 'tdrop'])
+    async def tleave(self, ctx, tournament: PolyTournament, *, target: str = None):
+        """
+        Leave a tournament
+        Leaving after the tournament has started drops you from future rounds. Staff can drop someone else.
+        **Example:**
+        `[p]tleave 5`
+        """
+        if target and not settings.is_staff(ctx):
+            return await ctx.send(f'Only server staff can drop another player from a tournament.')
+        guild_matches = await utilities.get_guild_member(ctx, target) if target else [ctx.author]
+        if len(guild_matches) != 1:
+            return await ctx.send(f'Could not match *{target}* to exactly one server member. Try using an @Mention.')
+
+        participant = models.TournamentParticipant.select().join(models.Player).join(models.DiscordMember).where(
+            (models.TournamentParticipant.tournament == tournament) & (models.DiscordMember.discord_id == guild_matches[0].id)
+        ).first()
+        if not participant:
+            return await ctx.send(f'*{guild_matches[0].name}* is not in tournament {tournament.id}.')
+
+        if not tournament.current_round:
+            participant.delete_instance()
+            return await ctx.send(f'*{guild_matches[0].name}* has left tournament **{tournament.name}**.')
+        participant.is_active = False
+        participant.save()
+        await ctx.send(f'*{guild_matches[0].name}* has been dropped from future rounds of tournament **{tournament.name}**.')
+
+    @settings.in_bot_channel()
+    @commands.command(aliases=['tourneys'])
+    async def tournaments(self, ctx):
+        """
+        List this server's tournaments that are not finished
+        """
+        tournament_list = models.Tournament.select().where(
+            (models.Tournament.guild_id == ctx.guild.id) & (models.Tournament.is_completed == 0)
+        ).order_by(-models.Tournament.id)
+        if not tournament_list:
+            return await ctx.send(f'There are no tournaments in progress. Staff can create one with `{ctx.prefix}newtournament`.')
+
+        lines = []
+        for tournament in tournament_list:
+            status = f'round {tournament.current_round}' if tournament.current_round else 'signups open'
+            lines.append(f'`{tournament.id:<5}` **{tournament.name}** - {tournament.format} - {status}')
+        await utilities.buffered_send(destination=ctx, content='\n'.join(lines))
+
+    @settings.in_bot_channel()
+    @commands.command(usage='tournament_id', aliases=['tourney', 'standings'])
+    async def tournament(self, ctx, tournament: PolyTournament):
+        """
+        Show a tournament's standings and current round
+        **Example:**
+        `[p]tournament 5`
+        """
+        rounds_str = f' of {tournament.rounds}' if tournament.rounds else ''
+        status = 'Completed' if tournament.is_completed else (f'Round {tournament.current_round}{rounds_str}' if tournament.current_round else 'Signups open')
+        lines = [f'__**{tournament.name}**__ - {tournament.format} - {"ranked" if tournament.is_ranked else "unranked"} - {status}']
+
+        max_losses = models.Tournament.max_losses[tournament.format]
+        standings = tournament.standings()
+        for count, (participant, points, buchholz) in enumerate(standings, start=1):
+            eliminated = ' *eliminated*' if max_losses and participant.losses >= max_losses else ''
+            dropped = ' *dropped*' if not participant.is_active else ''
+            if tournament.format == 'swiss':
+                lines.append(f'`{count:>3}.` **{participant.player.name}** {points} pts ({participant.wins}-{participant.losses}, buchholz {buchholz}){dropped}')
+            else:
+                lines.append(f'`{count:>3}.` **{participant.player.name}** {participant.wins}-{participant.losses}{eliminated}{dropped}')
+
+        if tournament.current_round:
+            lines.append(f'\n__Round {tournament.current_round} games__')
+            round_games = models.TournamentGame.select(models.TournamentGame, models.TournamentRound).join(models.TournamentRound).where(
+                (models.TournamentRound.tournament == tournament) & (models.TournamentRound.number == tournament.current_round)
+            ).order_by(models.TournamentGame.position)
+            names = {p.id: p.player.name for p, _, _ in standings}
+            for tournament_game in round_games:
+                result = f' - won by **{names[tournament_game.winner_id]}**' if tournament_game.winner_id else ''
+                lines.append(f'Game {tournament_game.game_id}: {names[tournament_game.side1_id]} vs {names[tournament_game.side2_id]}{result}')
+
+        await utilities.buffered_send(destination=ctx, content='\n'.join(lines).replace('@', '@\u200b'))
+
+    @settings.in_bot_channel()
+    @commands.command(usage='tournament_id', aliases=['tnext'])
+    async def nextround(self, ctx, tournament: PolyTournament):
+        """
+        Create the next round of a tournament
+        Can be used by the tournament host or server staff once every game of the current round has a confirmed winner.
+        The first use closes signups, seeds players by ELO and creates round 1.
+        **Example:**
+        `[p]nextround 5`
+        """
+        if not settings.is_staff(ctx) and not (tournament.host and tournament.host.discord_member.discord_id == ctx.author.id):
+            return await ctx.send('Only the tournament host or server staff can do this.')
+        if tournament.is_completed:
+            return await ctx.send(f'Tournament {tournament.id} is already completed.')
+        if not tournament.round_is_complete():
+            return await ctx.send(f'Round {tournament.current_round} still has games without a confirmed winner. See `{ctx.prefix}tournament {tournament.id}`.')
+
+        round_pairings, byes = build_round(tournament)
+        if round_pairings is None:
+            tournament.is_completed = True
+            tournament.save()
+            models.GameLog.write(guild_id=ctx.guild.id, message=f'Tournament {tournament.id} *{tournament.name}* completed.')
+            await ctx.send(f'Tournament **{tournament.name}** is complete! Final standings:')
+            return await ctx.invoke(self.tournament, tournament=tournament)
+        if not round_pairings:
+            return await ctx.send(f'There are not enough active players to create another round of tournament {tournament.id}.')
+
+        game_ids = tournament.create_round(round_pairings, byes=byes)
+        for game_id in game_ids:
+            self.bot.dispatch('pending_game_change', game_id)
+
+        lines = [f'__**{tournament.name}** round {tournament.current_round}__']
+        for game_id, (p1, p2, bracket) in zip(game_ids, round_pairings):
+            bracket_str = {'L': ' *(losers bracket)*', 'F': ' *(final)*'}.get(bracket, '')
+            lines.append(f'Game {game_id}: <@{p1.player.discord_member.discord_id}> vs <@{p2.player.discord_member.discord_id}>{bracket_str}')
+        for participant in byes:
+            lines.append(f'Bye: **{participant.player.name}**')
+        lines.append(f'\nThe first player listed creates each game in Polytopia and then uses `{ctx.prefix}start GAME_ID Name of Game`.')
+        await utilities.buffered_send(destination=ctx, content='\n'.join(lines))
+
+
+def setup(bot):
+    bot.add_cog(tournaments(bot))
@@ -4,19 +4,18 @@
 import asyncio
 import settings
 import modules.models as models
+from modules import dbexecutor
+from modules import perf
 import re
 # import peewee
 
 logger = logging.getLogger('polybot.' + __name__)
 
 
-def connect():
-    if models.db.connect(reuse_if_open=True):
-        logger.debug('new db connection opened')
-        return True
-    else:
-        # logger.debug('reusing db connection')
-        return False
+async def run_in_db_thread(func, *args, guild_id: int = None):
+    # Run blocking database work on the DB executor, queued fairly alongside other work for the same guild.
+    # Raises exceptions.ServerBusyError if that guild already has too much work waiting
+    return await dbexecutor.db_executor.submit(guild_id, func, *args)
 
 
 def guild_role_by_name(guild, name: str, allow_partial: bool = False):
@@ -99,13 +98,109 @@ def string_to_user_id(input):
         return None
 
 
+class GuildMemberIndex:
+    # In-memory lookup tables of one guild's member names/nicks, so get_guild_member() does not have to scan guild.members
+    # Built on first use for a guild and then kept current by index_member() / unindex_member() from the member listeners in games.py
+
+    def __init__(self, guild):
+        self.members = {}  # member_id: (NAME, NICK or None, NICKNAME) - upper-cased, last value is what substring matches are checked against
+        self.names = {}  # NAME: set of member ids
+        self.nicks = {}  # NICK: set of member ids
+        self.trigrams = {}  # 3-character chunk of any NICKNAME: set of member ids
+        for member in guild.members:
+            self.add(member.id, member.name, member.nick)
+
+    def add(self, member_id, name, nick):
+        if member_id in self.members:
+            self.remove(member_id)
+
+        name_upper = name.upper()
+        nick_upper = nick.upper() if nick else None
+        full_name_str = nick_upper + name_upper if nick_upper else name_upper
+
+        self.members[member_id] = (name_upper, nick_upper, full_name_str)
+        self.names.setdefault(name_upper, set()).add(member_id)
+        if nick_upper:
+            self.nicks.setdefault(nick_upper, set()).add(member_id)
+        for trigram in self.string_trigrams(full_name_str):
+            self.trigrams.setdefault(trigram, set()).add(member_id)
+
+    def remove(self, member_id):
+        entry = self.members.pop(member_id, None)
+        if not entry:
+            return
+        name_upper, nick_upper, full_name_str = entry
+
+        self.discard(self.names, name_upper, member_id)
+        if nick_upper:
+            self.discard(self.nicks, nick_upper, member_id)
+        for trigram in self.string_trigrams(full_name_str):
+            self.discard(self.trigrams, trigram, member_id)
+
+    def discard(self, lookup, key, member_id):
+        ids = lookup.get(key)
+        if ids is None:
+            return
+        ids.discard(member_id)
+        if not ids:
+            del lookup[key]
+
+    def string_trigrams(self, string):
+        return {string[i:i + 3] for i in range(len(string) - 2)}
+
+    def search(self, input_upper):
+        # returns (name_match_ids, nick_match_ids, substring_match_ids) with the same precedence as the old linear scan:
+        # a member only counts as a nick match if they were not a name match, and as a substring match if neither
+        name_ids = self.names.get(input_upper, set())
+        nick_ids = self.nicks.get(input_upper, set()) - name_ids
+
+        if len(input_upper) >= 3:
+            # only members sharing every trigram of the input can contain it, so just those need checking
+            candidates = None
+            for trigram in self.string_trigrams(input_upper):
+                trigram_ids = self.trigrams.get(trigram)
+                if not trigram_ids:
+                    candidates = set()
+                    break
+                candidates = set(trigram_ids) if candidates is None else candidates & trigram_ids
+        else:
+            candidates = self.members.keys()
+
+        substring_ids = {m for m in candidates if input_upper in self.members[m][2]} - name_ids - nick_ids
+        return name_ids, nick_ids, substring_ids
+
+
+guild_member_indexes = {}  # guild_id: GuildMemberIndex
+
+
+def index_member(member):
+    # add or refresh a guild member in its guild's index, if that index has been built
+    index = guild_member_indexes.get(member.guild.id)
+    if index:
+        index.add(member.id, member.name, member.nick)
+
+
+def unindex_member(member):
+    index = guild_member_indexes.get(member.guild.id)
+    if index:
+        index.remove(member.id)
+
+
+def reindex_user(user):
+    # discord name change applies to every guild the user shares with the bot
+    for guild_id, index in guild_member_indexes.items():
+        if user.id in index.members:
+            guild = discord.utils.get(settings.bot.guilds, id=guild_id)
+            member = guild.get_member(user.id) if guild else None
+            if member:
+                index.add(member.id, member.name, member.nick)
+
+
 async def get_guild_member(ctx, input):
 
     # Find matching Guild member by @Mention or Name. Fall back to case-insensitive search
     # TODO: use exceptions.NoSingleMatch etc like Player.get_or_except()
 
-    name_matches, nick_matches, substring_matches = [], [], []
-
     user_id_match = string_to_user_id(input)
     if user_id_match:
         result = ctx.guild.get_member(user_id_match) or discord.utils.get(ctx.message.mentions, id=user_id_match)
@@ -127,25 +222,18 @@ async def get_guild_member(ctx, input):
     # No matches by user ID or Name#Discriminator. Move on to name/nick matches
 
     input = input.strip('@')  # Attempt to handle fake @Mentions that sometimes slip through
-    for p in ctx.guild.members:
 
-        if p.name.upper() == input.upper():
-            name_matches.append(p)
-        elif p.nick and p.nick.upper() == input.upper():
-            nick_matches.append(p)
-        else:
-            full_name_str = p.nick.upper() + p.name.upper() if p.nick else p.name.upper()
-            if input.upper() in full_name_str:
-                substring_matches.append(p)
+    index = guild_member_indexes.get(ctx.guild.id)
+    perf.record_cache_lookup('guild_member_index', hit=index is not None)
+    if not index:
+        index = guild_member_indexes[ctx.guild.id] = GuildMemberIndex(ctx.guild)
+        logger.debug(f'Built member name index for guild {ctx.guild.id} with {len(index.members)} members')
+
+    name_ids, nick_ids, substring_ids = index.search(input.upper())
 
-    if name_matches:
-        # prioritize exact name matches first
-        return name_matches
-    if nick_matches:
-        # prioritize exact nick matches second
-        return nick_matches
-    # lastly, partial matches against nick or name equally weighted
-    return substring_matches
+    # prioritize exact name matches first, exact nick matches second, lastly partial matches against nick or name equally weighted
+    match_ids = name_ids or nick_ids or substring_ids
+    return [m for m in (ctx.guild.get_member(member_id) for member_id in match_ids) if m]
 
 
 def get_matching_roles(discord_member, list_of_role_names):
@@ -201,7 +289,6 @@ def export_game_data(query=None):
     import gzip
 
     filename = 'games_export.csv.gz'
-    connect()
     with gzip.open(filename, mode='wt') as export_file:
         game_writer = csv.writer(export_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
@@ -235,7 +322,6 @@ def export_game_data_brief(query):
     # only supports two-sided games, one winner and one loser
 
     filename = 'games_export-brief.csv.gz'
-    connect()
     with gzip.open(filename, mode='wt') as export_file:
         game_writer = csv.writer(export_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
@@ -276,7 +362,6 @@ def export_player_data(player_list, member_list):
     # only supports two-sided games, one winner and one loser
 
     filename = 'player-export.csv'
-    connect()
     with open(filename, mode='w') as export_file:
 
         game_writer = csv.writer(export_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
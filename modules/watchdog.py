@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from modules import perf
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# Event loop lag monitor. A coroutine wakes every interval and records how late it was, which covers anything that
+# blocks the loop - a peewee query run directly in a command, a matplotlib render, a long synchronous loop.
+# A separate thread watches the coroutine's heartbeat, and if the loop has not come back within threshold seconds it
+# logs the loop thread's current stack while the loop is still stuck, along with the commands and tasks in flight.
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = 0.5, interval: float = 0.25):
+        self.threshold, self.interval = threshold, interval
+        self.heartbeat = time.monotonic()
+        self.reported_heartbeat = None  # heartbeat of the stall that has already been logged, so each stall is logged once
+        self.loop_thread_id = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name='polybot-watchdog', daemon=True)
+
+    async def run(self, bot):
+        self.loop_thread_id = threading.get_ident()
+        self.thread.start()
+        try:
+            while not bot.is_closed():
+                started = time.perf_counter()
+                await asyncio.sleep(self.interval)
+                lag = max(time.perf_counter() - started - self.interval, 0)
+                self.heartbeat = time.monotonic()
+                perf.record_loop_lag(lag)
+                if lag >= self.threshold:
+                    logger.warning(f'Event loop was blocked for {lag:.2f}s')
+        finally:
+            self.stopped.set()
+
+    def watch(self):
+        # runs in its own thread, since the loop cannot report on itself while it is blocked
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or heartbeat == self.reported_heartbeat:
+                continue
+            self.reported_heartbeat = heartbeat
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack_str = ''.join(traceback.format_stack(frame)) if frame else '(event loop thread not found)\n'
+            logger.warning(f'Event loop blocked for {stalled:.2f}s and counting, while running {perf.describe_in_flight()}. '
+                           f'Event loop thread stack:\n{stack_str}')
+
+
+def enable_asyncio_debug(loop, slow_callback_duration: float):
+    # asyncio's debug mode logs every callback slower than slow_callback_duration to the 'asyncio' logger, and checks for
+    # unawaited coroutines and cross-thread loop calls. It slows everything down, so is meant for a staging bot only
+    loop.set_debug(True)
+    loop.slow_callback_duration = slow_callback_duration
+    logger.warning(f'asyncio debug mode is on - callbacks slower than {slow_callback_duration}s will be logged')
@@ -20,6 +20,12 @@
     exit(0)
 
 pastebin_key = config['DEFAULT'].get('pastebin_key', None)
+psql_max_connections = int(config['DEFAULT'].get('psql_max_connections', 20))
+psql_stale_timeout = int(config['DEFAULT'].get('psql_stale_timeout', 300))
+metrics_port = int(config['DEFAULT'].get('metrics_port', 0))  # 0 leaves the metrics endpoint off
+loop_lag_threshold = float(config['DEFAULT'].get('loop_lag_threshold', 0.5))  # seconds the event loop can be blocked before the watchdog logs it
+asyncio_debug = config['DEFAULT'].getboolean('asyncio_debug', False)
+peewee_log_sample_rate = float(config['DEFAULT'].get('peewee_log_sample_rate', 1.0))  # fraction of SQL statements written to full_bot.log
 
 server_ids = server_settings.server_shortcut_ids
 # server_ids = {'main': 283436219780825088, 'polychampions': 447883341463814144, 'test': 478571892832206869, 'beta': 274660262873661442}